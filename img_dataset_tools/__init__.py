@@ -8,17 +8,29 @@ from .webscrapers import (
     url_image_scrape_neuroglancer,
 )
 
+from .downloaders import (
+    DownloadEngine,
+    make_session,
+)
+
 from .metadata_utils import (
     flatten_dm3_dict,
     extract_zarr_metadata,
+    extract_precomputed_metadata,
 )
 
+from .volumes import open_volume
+
 __all__ = [
     "url_image_scrape_dynamic",
     "url_image_scrape_static",
     "url_image_scrape_selenium",
     "url_image_scrape_zarr",
     "url_image_scrape_neuroglancer",
+    "DownloadEngine",
+    "make_session",
     "flatten_dm3_dict",
     "extract_zarr_metadata",
+    "extract_precomputed_metadata",
+    "open_volume",
 ]
\ No newline at end of file
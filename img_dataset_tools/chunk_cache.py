@@ -0,0 +1,281 @@
+"""
+img_dataset_tools.chunk_cache
+
+This script contains a persistent on-disk chunk cache shared by every process on a node, so
+repeated experiments over overlapping regions of a remote volume only pay the network cost once.
+Entries are written to a temporary file and renamed into place, reads refresh the entry's
+modification time, and when the cache grows past its size cap the least recently used entries
+are evicted under an exclusive file lock.
+
+Two adapters put the cache under the remote access paths: CachedVolume wraps a CloudVolume and
+caches decoded chunks of its chunk grid (compressed with Blosc zstd, as a JPEG or compressed
+segmentation chunk decodes to many times its stored size), and CachedMapping wraps an fsspec
+mapper and caches the raw stored chunks.
+
+The bytes written by every process sharing a cache directory are counted in one file there, so
+the cache is rescanned after RESCAN_SHARE of its cap has been written in total, not per process.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import fcntl
+import hashlib
+import io
+import logging
+import os
+import struct
+import threading
+from collections.abc import Mapping
+
+import numpy as np
+from numcodecs import Blosc
+
+from .neuroglancer_utils import crop_chunks, volume_grid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "img_dataset_tools", "chunks")
+DEFAULT_CACHE_BYTES = 20 * 1024 ** 3
+EVICT_TO = 0.9              # eviction stops at this share of max_bytes
+RESCAN_SHARE = 0.05         # rescan disk usage after writing this share of max_bytes
+ENTRY_SUFFIX = ".chunk"
+LOCK_NAME = ".lock"
+WRITTEN_NAME = ".written"   # bytes written since the last scan, by every process
+NPY_MAGIC = b"\x93NUMPY"    # uncompressed entries of earlier versions
+CHUNK_CODEC = Blosc(cname="zstd", clevel=3, shuffle=Blosc.SHUFFLE)
+
+
+class ChunkCache:
+    """
+    Size-capped LRU store of byte strings in directory, safe to share between threads and
+    processes. Counters for this instance are available from stats().
+    """
+
+    def __init__(self, directory=DEFAULT_CHUNK_CACHE_DIR, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "bytes_hit": 0, "bytes_stored": 0, "evicted": 0}
+        self._evict()
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ENTRY_SUFFIX)
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._counters[name] += amount
+
+    def get(self, key):
+        """
+        This function returns the bytes cached under key, or None on a miss. A hit marks
+        the entry as most recently used.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # never stored, or evicted by another process between open and utime
+            self._count(misses=1)
+            return None
+        self._count(hits=1, bytes_hit=len(data))
+        return data
+
+    def put(self, key, data):
+        """
+        This function stores data under key. The entry appears atomically, so concurrent
+        readers see either nothing or the whole entry.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self._count(bytes_stored=len(data))
+        if self._add_written(len(data)):
+            self._evict()
+
+    def _add_written(self, nbytes):
+        # adds nbytes to the counter shared by every process and tells whether it is time to
+        # rescan (which resets it)
+        with open(os.path.join(self.directory, WRITTEN_NAME), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                data = f.read(8)
+                written = (struct.unpack("<q", data)[0] if len(data) == 8 else 0) + nbytes
+                rescan = written >= self.max_bytes * RESCAN_SHARE
+                f.truncate(0)
+                f.write(struct.pack("<q", 0 if rescan else written))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return rescan
+
+    def _evict(self):
+        # one process at a time walks the cache; other writers keep going meanwhile
+        with open(os.path.join(self.directory, LOCK_NAME), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                entries, total = [], 0
+                for sub in os.scandir(self.directory):
+                    if not sub.is_dir():
+                        continue
+                    for entry in os.scandir(sub.path):
+                        if entry.name.endswith(ENTRY_SUFFIX):
+                            try:
+                                stat = entry.stat()
+                            except FileNotFoundError:
+                                continue
+                            entries.append((stat.st_mtime, stat.st_size, entry.path))
+                            total += stat.st_size
+                if total <= self.max_bytes:
+                    return
+                entries.sort()
+                evicted = 0
+                for _, size, path in entries:
+                    if total <= self.max_bytes * EVICT_TO:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    evicted += 1
+                self._count(evicted=evicted)
+                logger.info(f"Evicted {evicted} chunks from {self.directory}")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+def open_chunk_cache(cache):
+    """
+    This function returns cache as a ChunkCache: a ChunkCache is returned as is, a directory
+    path opens one there, and None disables caching.
+    """
+    if cache is None or isinstance(cache, ChunkCache):
+        return cache
+    return ChunkCache(cache)
+
+
+def encode_chunk(data):
+    """
+    This function serializes a decoded chunk for the cache: the .npy bytes, compressed
+    with CHUNK_CODEC and shuffled by the item size (the .npy header is padded to 64 bytes,
+    so the array data stays aligned).
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(data))
+    itemsize = data.dtype.itemsize
+    return CHUNK_CODEC.encode(np.frombuffer(buffer.getvalue(), f"u{itemsize}" if itemsize in (1, 2, 4, 8) else "u1"))
+
+
+def decode_chunk(payload):
+    """
+    This function reads a chunk written by encode_chunk (or an uncompressed .npy entry).
+    """
+    if not payload.startswith(NPY_MAGIC):
+        payload = CHUNK_CODEC.decode(payload)
+    return np.load(io.BytesIO(payload))
+
+
+class CachedVolume:
+    """
+    Wraps a CloudVolume so that (x, y, z) slicing is served chunk by chunk from a ChunkCache.
+    The chunks a cutout needs that are not cached are fetched together in one call over their
+    bounding box and cached; everything else is passed through to the wrapped volume.
+    """
+
+    def __init__(self, volume, cache):
+        self.volume = volume
+        self.cache = cache
+        self._prefix = f"{volume.cloudpath}|{volume.mip}"
+
+    def __getattr__(self, name):
+        return getattr(self.volume, name)
+
+    def _key(self, index):
+        return f"{self._prefix}|{index[0]}_{index[1]}_{index[2]}"
+
+    def __getitem__(self, slices):
+        if (not isinstance(slices, tuple) or len(slices) != 3
+                or any(not isinstance(s, slice) or s.step not in (None, 1)
+                       or s.start is None or s.stop is None for s in slices)):
+            return self.volume[slices]
+        chunk_size, voxel_offset, upper = volume_grid(self.volume)
+        start = np.array([s.start for s in slices], dtype=int)
+        stop = np.array([s.stop for s in slices], dtype=int)
+        out = np.empty(tuple(stop - start) + (self.volume.num_channels,), dtype=self.volume.dtype)
+
+        def place(chunk_start, data):
+            lo = np.maximum(chunk_start, start)
+            hi = np.minimum(chunk_start + np.array(data.shape[:3]), stop)
+            out[tuple(slice(a, b) for a, b in zip(lo - start, hi - start))] = \
+                data[tuple(slice(a, b) for a, b in zip(lo - chunk_start, hi - chunk_start))]
+
+        missing = []
+        for index in crop_chunks(start, stop - start, chunk_size, voxel_offset):
+            chunk_start = voxel_offset + np.array(index) * chunk_size
+            cached = self.cache.get(self._key(index))
+            if cached is None:
+                missing.append((index, chunk_start))
+            else:
+                place(chunk_start, decode_chunk(cached))
+
+        if missing:
+            lo = np.min([s for _, s in missing], axis=0)
+            hi = np.minimum(np.max([s for _, s in missing], axis=0) + chunk_size, upper)
+            block = np.asarray(self.volume[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+            for index, chunk_start in missing:
+                a = chunk_start - lo
+                b = np.minimum(chunk_start + chunk_size, upper) - lo
+                data = np.ascontiguousarray(block[a[0]:b[0], a[1]:b[1], a[2]:b[2]])
+                self.cache.put(self._key(index), encode_chunk(data))
+                place(chunk_start, data)
+        return out
+
+
+class CachedMapping(Mapping):
+    """
+    Read-through wrapper of an fsspec mapper: stored objects are read from the ChunkCache,
+    or from the mapper and then cached. Keys are listed by the mapper itself.
+    """
+
+    def __init__(self, mapper, cache, namespace):
+        self.mapper = mapper
+        self.cache = cache
+        self.namespace = namespace.rstrip("/")
+
+    def __getitem__(self, key):
+        cache_key = f"{self.namespace}/{key}"
+        data = self.cache.get(cache_key)
+        if data is None:
+            data = self.mapper[key]
+            self.cache.put(cache_key, data)
+        return data
+
+    def __iter__(self):
+        return iter(self.mapper)
+
+    def __len__(self):
+        return len(self.mapper)
+
+    def __contains__(self, key):
+        return key in self.mapper
+
+
+__all__ = ["ChunkCache", "CachedVolume", "CachedMapping", "open_chunk_cache", "encode_chunk", "decode_chunk",
+           "DEFAULT_CHUNK_CACHE_DIR", "DEFAULT_CACHE_BYTES"]
@@ -0,0 +1,145 @@
+"""
+img_dataset_tools.crawler
+
+This script contains a concurrent crawler for static directory listings such as the EMPIAR
+FTP/HTTP pages. Listing pages are fetched by a bounded worker pool, subdirectories are followed
+up to a maximum depth, and every file whose name matches one of the patterns is handed to the
+download engine the moment it is discovered, so listing latency overlaps with the transfers.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import fnmatch
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import unquote, urldefrag, urljoin
+
+from bs4 import BeautifulSoup
+from tqdm import tqdm
+
+from .downloaders import DownloadEngine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_DEPTH = 3
+DEFAULT_LIST_WORKERS = 4
+
+
+def _parse_listing(html, dir_url, root):
+    """
+    Split the links of one listing page into subdirectory and file urls below root.
+    Sort links (?C=N;O=D), anchors and parent directories are dropped.
+    """
+    subdirs, files = [], []
+    for link in BeautifulSoup(html, "html.parser").find_all("a"):
+        href = link.get("href")
+        if not href or href.startswith(("?", "#", "mailto:")):
+            continue
+        absolute = urldefrag(urljoin(dir_url, href.strip()))[0].split("?")[0]
+        if not absolute.startswith(root) or absolute == dir_url:
+            continue
+        (subdirs if absolute.endswith("/") else files).append(absolute)
+    return subdirs, files
+
+
+def crawl_listing(url, patterns=("*",), max_depth=DEFAULT_MAX_DEPTH,
+                  workers=DEFAULT_LIST_WORKERS, fetch=None):
+    """
+    This function crawls the directory listing at url and yields (file_url, relative_path)
+    for every file whose name matches one of the fnmatch patterns, as soon as the listing
+    it appears in has been parsed. Each directory and file is visited once; subdirectories
+    deeper than max_depth below url are not listed.
+    """
+    root = url if url.endswith("/") else url + "/"
+    own_engine = DownloadEngine(max_workers=workers) if fetch is None else None
+    fetch = fetch or own_engine.get_text
+    seen = {root}
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(fetch, root): (root, 0)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_url, depth = pending.pop(future)
+                    try:
+                        html = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to list {dir_url}: {e}", exc_info=True)
+                        continue
+
+                    subdirs, files = _parse_listing(html, dir_url, root)
+                    for file_url in files:
+                        name = unquote(file_url.rsplit("/", 1)[-1])
+                        if file_url in seen or not any(fnmatch.fnmatch(name.lower(), p.lower())
+                                                       for p in patterns):
+                            continue
+                        seen.add(file_url)
+                        yield file_url, unquote(file_url[len(root):])
+
+                    if depth < max_depth:
+                        for subdir in subdirs:
+                            if subdir not in seen:
+                                seen.add(subdir)
+                                pending[executor.submit(fetch, subdir)] = (subdir, depth + 1)
+    finally:
+        # also when the crawl fails or the caller stops iterating early
+        if own_engine is not None:
+            own_engine.close()
+
+
+def listing_path(dataset_folder, rel_path, create=True):
+    """
+    This function returns the local path for a file at rel_path below the crawled url,
+    keeping its subdirectories (but never leaving dataset_folder), and with create makes
+    its folder.
+    """
+    parts = [p for p in rel_path.split("/") if p not in ("", ".", "..")]
+    filepath = os.path.join(dataset_folder, *parts)
+    if create:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    return filepath
+
+
+def crawl_and_download(url, dataset_folder, patterns=("*",), max_depth=DEFAULT_MAX_DEPTH,
+                       list_workers=DEFAULT_LIST_WORKERS, engine=None, manifest=None, desc=None,
+                       download=None):
+    """
+    This function crawls url and downloads every matching file into dataset_folder, keeping
+    the subdirectory layout of the listing. Downloads start while the crawl is still running.
+    download(url, filepath, manifest) can replace engine.download. Returns the download
+    result dicts in discovery order.
+    """
+    own_engine = engine is None
+    engine = engine or DownloadEngine()
+    download = download or engine.download
+    futures = []
+    progress = tqdm(total=0, desc=desc, unit="file")
+    progress_lock = threading.Lock()
+
+    def _done(_):
+        with progress_lock:
+            progress.update(1)
+
+    try:
+        with ThreadPoolExecutor(max_workers=engine.max_workers) as executor:
+            for file_url, rel_path in crawl_listing(url, patterns, max_depth, list_workers,
+                                                    fetch=engine.get_text):
+                filepath = listing_path(dataset_folder, rel_path)
+                with progress_lock:
+                    progress.total += 1
+                    progress.refresh()
+                future = executor.submit(download, file_url, filepath, manifest)
+                future.add_done_callback(_done)
+                futures.append(future)
+            results = [future.result() for future in futures]
+    finally:
+        progress.close()
+        if own_engine:
+            engine.close()
+    return results
+
+
+__all__ = ["crawl_listing", "crawl_and_download", "listing_path"]
@@ -0,0 +1,354 @@
+"""
+img_dataset_tools.dataset_tasks
+
+This script contains the task expanders that turn each supported dataset source into work for
+the shared scheduler in scheduler.py: one task per file for the static and Selenium listings
+(sized with a HEAD request), one task per batch of stored chunks for Zarr stores, one task per
+(t, c) stack for OMERO datasets and one task for a Neuroglancer crop. The tasks reuse the same
+download engine, manifest, writers and folder layout as the functions in webscrapers.py, so a
+dataset fetched either way ends up identical on disk.
+
+Expanding a source only reads from the remote side; folders are created and old copies removed
+by the tasks themselves, so a source can be expanded for a dry-run plan without touching disk.
+
+Each task carries an estimate of its peak memory, worked out from the sizes, shapes and dtypes
+known when it is created, which the scheduler's memory admission uses.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+import fsspec
+import numpy as np
+import zarr
+from cloudvolume import CloudVolume
+
+from .chunk_cache import CachedMapping, open_chunk_cache
+from .crawler import DEFAULT_MAX_DEPTH, crawl_listing, listing_path
+from .downloaders import WRITE_BEHIND_DEPTH, part_bytes
+from .link_discovery import DEFAULT_TTL, LINK_CACHE_NAME, discover_links
+from .manifest import DownloadManifest, disk_size
+from .omero_fetch import DEFAULT_BATCH_SIZE, DEFAULT_POOL_SIZE, OmeroConnectionPool, fetch_stack, \
+    pixels_dtype, stream_stack
+from .neuroglancer_utils import DEFAULT_MEMORY_BUDGET
+from .plane_writers import PLANE_WRITERS, open_plane_writer
+from .scheduler import Source, Task
+from .tiff_transcode import download_transcoded
+from .tiff_writer import DEFAULT_TIFF_COMPRESSION, write_tiff
+from .transfer_budget import BudgetedMapping
+from .webscrapers import _idr_connection, url_image_scrape_neuroglancer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HEAD_WORKERS = 8
+DEFAULT_ZARR_BATCH_BYTES = 64 * 1024 ** 2   # stored bytes per Zarr copy task
+MAX_ZARR_BATCH_KEYS = 256
+TRANSCODE_SLAB_MEMORY = 512 * 1024 ** 2     # assumed z-slab buffer of a transcode (at most the file)
+CROP_COPIES = 3                             # cutout, cache assembly and (z, y, x) copy of a crop
+
+
+def download_memory(engine, size=None, transcode=False):
+    """
+    This function estimates the peak memory of one engine download: the read buffers
+    queued for the disk, plus the z-slab a transcode to Zarr holds.
+    """
+    memory = (WRITE_BEHIND_DEPTH + engine.segments) * engine.chunk_size
+    if transcode:
+        memory += min(size or TRANSCODE_SLAB_MEMORY, TRANSCODE_SLAB_MEMORY)
+    return memory
+
+
+def _download_to(download, url, filepath, manifest):
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    return download(url, filepath, manifest)
+
+
+def _up_to_date(filepath):
+    return {"path": filepath, "bytes": 0, "skipped": True, "error": None}
+
+
+def _sized_file_tasks(engine, pairs, manifest, download, transcode=False, head_workers=DEFAULT_HEAD_WORKERS):
+    """
+    Yield a Task for every (url, filepath) in pairs, sized by a HEAD request. HEADs run
+    concurrently and pairs is consumed lazily, so tasks come out while a crawl still runs.
+    A file the manifest records as current is sized 0, and a .part left by an earlier run
+    only counts with its missing tail; the bytes already on disk go to the task's present.
+    """
+    def sized(pair):
+        file_url, filepath = pair
+        head = engine.head(file_url)
+        if head is None:
+            return pair, None, 0, False
+        if manifest.is_current(filepath, size=head["size"], etag=head["etag"],
+                               last_modified=head["last_modified"]):
+            return pair, head["size"], os.path.getsize(filepath), True
+        return pair, head["size"], part_bytes(file_url, filepath, head), False
+
+    def task(future):
+        (file_url, filepath), size, present, current = future.result()
+        if current:
+            size, memory = 0, 0
+        else:
+            memory = download_memory(engine, size, transcode)
+            size = size - present if size is not None else None
+        return Task(os.path.basename(filepath), size, partial(_download_to, download, file_url, filepath, manifest),
+                    group=urlparse(file_url).netloc, memory=memory, present=present)
+
+    with ThreadPoolExecutor(max_workers=head_workers) as executor:
+        pending = []
+        for pair in pairs:
+            pending.append(executor.submit(sized, pair))
+            while pending and pending[0].done():
+                yield task(pending.pop(0))
+        for future in pending:
+            yield task(future)
+
+
+def _host_limits(engine, url):
+    return {urlparse(url).netloc: engine.per_host}
+
+
+def static_source(url, save_directory, engine, patterns=("*.dm3",), max_depth=DEFAULT_MAX_DEPTH,
+                  transcode=False, keep_original=True):
+    """
+    This function returns the Source for an EMPIAR-style static listing (see
+    url_image_scrape_static): one task per matching file, downloaded with engine.
+    """
+    dataset_id = url.split("/")[-3]
+    dataset_folder = os.path.join(save_directory, "empiar_" + dataset_id)
+
+    def expand():
+        manifest = DownloadManifest(dataset_folder)
+        download = partial(download_transcoded, engine, keep_original=keep_original) if transcode \
+            else engine.download
+        pairs = ((file_url, listing_path(dataset_folder, rel_path, create=False))
+                 for file_url, rel_path in crawl_listing(url, patterns, max_depth, fetch=engine.get_text))
+        return _sized_file_tasks(engine, pairs, manifest, download, transcode)
+
+    return Source("empiar_" + dataset_id, expand, limits=_host_limits(engine, url))
+
+
+def selenium_source(url, save_directory, engine, use_browser="auto", link_cache_ttl=DEFAULT_TTL,
+                    transcode=False, keep_original=True):
+    """
+    This function returns the Source for a page with dynamic .tif links (see
+    url_image_scrape_selenium): one task per linked file, downloaded with engine.
+    """
+    dataset_id = "mitochondria-" + url.split("/")[-2]
+    dataset_folder = os.path.join(save_directory, dataset_id)
+
+    def expand():
+        manifest = DownloadManifest(dataset_folder)
+        download = partial(download_transcoded, engine, keep_original=keep_original) if transcode \
+            else engine.download
+        links = discover_links(url, (".tif",), cache_path=os.path.join(save_directory, LINK_CACHE_NAME),
+                               ttl=link_cache_ttl, use_browser=use_browser)
+        pairs = [(link, os.path.join(dataset_folder, os.path.basename(link))) for link in links]
+        return _sized_file_tasks(engine, pairs, manifest, download, transcode)
+
+    return Source(dataset_id, expand, limits=_host_limits(engine, url))
+
+
+def _copy_keys(prepare, source, store, keys):
+    # one batch of stored objects, copied as they are (no decompression)
+    prepare()
+    copied = 0
+    for key in keys:
+        data = source[key]
+        store[key] = data
+        copied += len(data)
+    return {"bytes": copied, "error": None}
+
+
+def _remove_tree(path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+
+def _once(func):
+    # runs func the first time the returned callable is called; later callers wait for it
+    lock, done = threading.Lock(), []
+
+    def call():
+        with lock:
+            if not done:
+                func()
+                done.append(True)
+    return call
+
+
+def zarr_source(url, save_directory, chunk_cache=None,
+                batch_bytes=DEFAULT_ZARR_BATCH_BYTES):
+    """
+    This function returns the Source for a Zarr store in an S3 bucket (see
+    url_image_scrape_zarr): the stored objects of every array, listed with their sizes,
+    are copied in tasks of about batch_bytes each. chunk_cache is off by default, as there.
+    """
+    dataset_id = url.split("/")[-1]
+    dataset_folder = os.path.join(save_directory, dataset_id)
+
+    def expand():
+        cache = open_chunk_cache(chunk_cache)
+        fs = fsspec.filesystem("s3", anon=True)
+        base = url.replace("s3://", "").rstrip("/")
+        objects = fs.find(url, detail=True)
+        arrays = sorted(os.path.dirname(path[len(base) + 1:]) for path in objects if path.endswith(".zarray"))
+        if not arrays:
+            raise ValueError("No .zarray datasets found")
+        logger.info(f"Found {len(arrays)} arrays under {url}")
+
+        for key in arrays:
+            online_path = os.path.join(url, key)
+            local_path = os.path.join(dataset_folder, key)
+            online_mapper = BudgetedMapping(fsspec.get_mapper(online_path, anon=True), online_path)
+            if cache is not None:
+                online_mapper = CachedMapping(online_mapper, cache, online_path)
+            local_store = zarr.DirectoryStore(local_path)
+            prepare = _once(partial(_remove_tree, local_path))
+
+            prefix = f"{base}/{key}/" if key else f"{base}/"
+            # objects are copied one at a time, so a batch holds its largest object
+            batch, size, largest, index = [], 0, 0, 0
+            for path, info in objects.items():
+                if not path.startswith(prefix):
+                    continue
+                batch.append(path[len(prefix):])
+                size += info.get("size") or 0
+                largest = max(largest, info.get("size") or 0)
+                if size >= batch_bytes or len(batch) >= MAX_ZARR_BATCH_KEYS:
+                    yield Task(f"{key} [{index}]", size, partial(_copy_keys, prepare, online_mapper, local_store, batch),
+                               memory=largest)
+                    batch, size, largest, index = [], 0, 0, index + 1
+            if batch:
+                yield Task(f"{key} [{index}]", size, partial(_copy_keys, prepare, online_mapper, local_store, batch),
+                           memory=largest)
+
+    return Source(dataset_id, expand, outputs=[dataset_folder])
+
+
+def dynamic_source(url, save_directory, num_workers=DEFAULT_POOL_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                   output="stack", compression=DEFAULT_TIFF_COMPRESSION):
+    """
+    This function returns the Source for an OMERO/IDR dataset (see url_image_scrape_dynamic):
+    one task per (t, c) stack, at most num_workers at once over a pool of as many
+    connections, which is closed when the last stack is done. Stacks already saved become
+    tasks of size 0 that only report their path.
+    """
+    dataset_id = url.split("=")[-1]
+    dataset_folder = os.path.join(save_directory, "omero_" + dataset_id)
+    group = "omero_" + dataset_id
+    pool = OmeroConnectionPool(_idr_connection, size=num_workers)
+    opened = []
+
+    def save_stack(manifest, image_id, t, c, shape, dtype, filepath, source):
+        os.makedirs(dataset_folder, exist_ok=True)
+        with pool.acquire() as slot:
+            pixels = pool.pixels(slot, image_id)
+            if output == "stack":
+                stack = fetch_stack(pixels, c, t, shape, dtype, batch_size)
+                write_tiff(filepath, stack, compression)
+                file_size, checksum = os.path.getsize(filepath), hashlib.sha256(stack).hexdigest()
+            else:
+                kwargs = {"compression": compression} if output == "bigtiff" else {}
+                writer = open_plane_writer(output, os.path.splitext(filepath)[0], shape, dtype, **kwargs)
+                checksum = stream_stack(pixels, c, t, shape, writer, batch_size)
+                file_size = writer.file_size()
+        manifest.record(filepath, url=source, shape=list(shape), dtype=str(dtype), file_size=file_size,
+                        checksum=checksum, checksum_algorithm="sha256-pixels")
+        return {"bytes": int(np.prod(shape)) * dtype.itemsize, "error": None, "path": filepath}
+
+    def expand():
+        manifest = DownloadManifest(dataset_folder)
+        conn = _idr_connection()
+        opened.append(conn)
+        dataset = conn.getObject("Dataset", int(dataset_id))
+        ext = ".tiff" if output == "stack" else PLANE_WRITERS[output][1]
+        for img in dataset.listChildren():
+            name, image_id, dtype = img.getName(), img.getId(), pixels_dtype(img)
+            shape = (img.getSizeZ(), img.getSizeY(), img.getSizeX())
+            stack_bytes = int(np.prod(shape)) * dtype.itemsize
+            # a whole stack plus its compressed copy, or a batch of planes when streaming
+            memory = 2 * stack_bytes if output == "stack" else \
+                2 * min(batch_size, shape[0]) * shape[1] * shape[2] * dtype.itemsize
+            for t in range(img.getSizeT()):
+                for c in range(img.getSizeC()):
+                    stem = f"{name.replace('/', '_')}_t{t:03}_c{c:02}"
+                    filepath = os.path.join(dataset_folder, stem + ext)
+                    source = f"omero://idr.openmicroscopy.org/Image/{image_id}?t={t}&c={c}"
+                    if manifest.is_current(filepath, url=source, shape=list(shape), dtype=str(dtype)):
+                        # still a (free) task, so the pipeline catalogs the stack it already has
+                        logger.info(f"Up to date, skipped: {filepath}")
+                        yield Task(stem, 0, partial(_up_to_date, filepath), present=disk_size(filepath))
+                        continue
+                    yield Task(stem, stack_bytes,
+                               partial(save_stack, manifest, image_id, t, c, shape, dtype, filepath, source),
+                               group=group, memory=memory)
+
+    def close():
+        pool.close()
+        for conn in opened:
+            conn.close()
+
+    return Source(group, expand, close=close, limits={group: num_workers})
+
+
+def neuroglancer_source(url, save_directory, crop_region=(1000, 1000, 1000), **kwargs):
+    """
+    This function returns the Source for a Neuroglancer crop (see
+    url_image_scrape_neuroglancer) as a single task sized by the crop's voxels. kwargs are
+    passed on to url_image_scrape_neuroglancer. A TIFF crop is held in memory a few times
+    over; a streamed crop stays within its memory_budget.
+    """
+    dataset_id = url.split("/")[-4]
+    output = kwargs.get("output", "tiff")
+    output_path = os.path.join(save_directory, dataset_id, f"{dataset_id}_crop" + (".zarr" if output == "zarr" else ".tif"))
+
+    def crop(size):
+        # the scraper logs its own failures; a missing or stale output is what tells the caller
+        start_time = time.time()
+        url_image_scrape_neuroglancer(url, save_directory, crop_region, **kwargs)
+        if not os.path.exists(output_path) or os.path.getmtime(output_path) < start_time - 1:
+            return {"bytes": 0, "error": RuntimeError(f"No crop written to {output_path}"), "path": output_path}
+        return {"bytes": size, "error": None, "path": output_path}
+
+    def expand():
+        volume = CloudVolume(url, mip=0, use_https=True)
+        size = int(np.prod(crop_region)) * np.dtype(volume.dtype).itemsize * volume.num_channels
+        if output == "tiff":
+            memory = CROP_COPIES * size
+        else:
+            memory = min(size, kwargs.get("memory_budget", DEFAULT_MEMORY_BUDGET))
+        yield Task(f"{dataset_id} crop", size, partial(crop, size), memory=memory)
+
+    return Source(dataset_id, expand)
+
+
+def dataset_source(url, save_directory, engine):
+    """
+    This function returns the Source for any url supported by the webscrapers, picking the
+    expander from the host the same way multiprocessing_image_datasets.py picks a scraper.
+    """
+    if "idr.openmicroscopy.org" in url:
+        return dynamic_source(url, save_directory)
+    elif "ftp.ebi.ac.uk" in url:
+        return static_source(url, save_directory, engine)
+    elif "cvlab.epfl.ch" in url:
+        return selenium_source(url, save_directory, engine)
+    elif "neuroglancer" in url:
+        return neuroglancer_source(url, save_directory)
+    elif "janelia-cosem-datasets" in url:
+        return zarr_source(url, save_directory)
+    raise ValueError(f"This function does not support this url: {url}")
+
+
+__all__ = ["static_source", "selenium_source", "zarr_source", "dynamic_source", "neuroglancer_source",
+           "dataset_source", "download_memory"]
@@ -626,6 +626,10 @@ class DM3(object):
         """Returns all image Tags."""
         return self._tagDict
 
+    def close(self):
+        """Closes the file; the Tags stay available, image data can no longer be read."""
+        self._f.close()
+
     def dumpTags(self, dump_dir='/tmp'):
         """Dumps image Tags in a txt file."""
         dump_file = os.path.join(dump_dir,
@@ -6,8 +6,7 @@ import numpy as np
 
 def calcHistogram(imdata, bins_=256):
     '''Compute image histogram.'''
-    im_values =  np.ravel(imdata)
-    hh, bins_ = np.histogram( im_values, bins=bins_ )
+    hh, bins_ = np.histogram( imdata, bins=bins_ )
     return hh, bins_
 
 def calcDisplayRange(imdata, cutoff=.1, bins_=512):
@@ -22,14 +21,11 @@ def calcDisplayRange(imdata, cutoff=.1, bins_=512):
         bb = bins_[:-1]    # 'bins' == bin_edges
        # number of pixels
     Npx = np.sum(hh)
-    # calc. lower limit : 
-    i = 1
-    while np.sum( hh[:i] ) < Npx*cutoff/100.:
-        i += 1
+    # calc. lower limit : first i with sum(hh[:i]) >= Npx*cutoff/100
+    # (cumulative-sum search instead of re-summing the histogram for every i)
+    i = int(np.searchsorted(np.cumsum(hh), Npx*cutoff/100., side='left')) + 1
     cut0 = round( bb[i] )
-    # calc. higher limit
-    j = 1
-    while np.sum( hh[-j:] ) < Npx*cutoff/100.:
-        j += 1
+    # calc. higher limit : first j with sum(hh[-j:]) >= Npx*cutoff/100
+    j = int(np.searchsorted(np.cumsum(hh[::-1]), Npx*cutoff/100., side='left')) + 1
     cut1 = round( bb[-j] )
     return cut0,cut1
@@ -0,0 +1,631 @@
+"""
+img_dataset_tools.downloaders
+
+This script contains the shared HTTP download engine used by the webscrapers in webscrapers.py.
+It keeps one pooled requests session with keep-alive connections, caps the number of concurrent
+transfers per host, reads in large buffers and hands the writes to a background thread so the
+network is never waiting on the disk. Files are written as *.part and resumed with HTTP Range
+requests after an interruption, and very large files are split into byte ranges that are
+fetched over several connections at once. An observer can follow the bytes as they land in the
+.part, e.g. to transcode a file while it is still downloading.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+from .transfer_budget import default_budget
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024   # 1 MiB reads instead of 8 KB
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_PER_HOST = 4
+WRITE_BEHIND_DEPTH = 16            # buffered chunks waiting for the disk
+PART_SUFFIX = ".part"
+PART_STATE_SUFFIX = ".json"        # sidecar next to the .part with the resume validators
+RESUME_ATTEMPTS = 5
+DEFAULT_SEGMENT_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+SEGMENTS_PER_CONNECTION = 16       # small pieces balance slow connections and limit lost work
+# sizes, ranges and checksums are of the stored bytes, so servers must not gzip the body
+IDENTITY_ENCODING = {"Accept-Encoding": "identity"}
+
+
+class IncompleteDownload(IOError):
+    """Raised when a response body ends before the advertised number of bytes."""
+
+
+class RangeNotSupported(IOError):
+    """Raised when a server ignores or mangles a Range request during a segmented download."""
+
+
+RESUMABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, IncompleteDownload)
+
+
+def make_session(pool_size=DEFAULT_MAX_WORKERS, retries=3):
+    """
+    This function creates a requests session whose connection pool is large enough for
+    pool_size concurrent keep-alive connections per host, with retries on transient errors.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("HEAD", "GET"))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _read_part_state(part_path):
+    try:
+        with open(part_path + PART_STATE_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_part_state(part_path, state):
+    tmp_path = part_path + PART_STATE_SUFFIX + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, part_path + PART_STATE_SUFFIX)
+
+
+def _remove_part_state(part_path):
+    try:
+        os.remove(part_path + PART_STATE_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def _if_range_validator(state):
+    # If-Range needs a strong validator; weak ETags (W/"...") fall back to Last-Modified
+    etag = state.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return state.get("last_modified")
+
+
+def _content_length(headers):
+    value = headers.get("Content-Length")
+    return int(value) if value is not None and value.isdigit() else None
+
+
+def _parse_content_range(value):
+    """Parse 'bytes start-end/total' into (start, total); total is None for '*'."""
+    if not value or not value.startswith("bytes "):
+        raise ValueError(f"Unexpected Content-Range header: {value!r}")
+    span, _, total = value[len("bytes "):].partition("/")
+    start = int(span.split("-")[0])
+    return start, (int(total) if total.isdigit() else None)
+
+
+def _discard_part(part_path):
+    for path in (part_path, part_path + PART_STATE_SUFFIX):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _split_ranges(size, connections):
+    """Split [0, size) into inclusive [start, end] byte ranges for a segmented download."""
+    piece = max(MIN_SEGMENT_SIZE, -(-size // (connections * SEGMENTS_PER_CONNECTION)))
+    return [[start, min(start + piece, size) - 1] for start in range(0, size, piece)]
+
+
+def _preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # macOS and some filesystems lack fallocate; a sparse file works for pwrite too
+        os.ftruncate(fd, size)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _hash_file(path, length):
+    """sha256 of the first length bytes of path, used when resuming a .part."""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while length > 0:
+            data = f.read(min(DEFAULT_CHUNK_SIZE, length))
+            if not data:
+                break
+            hasher.update(data)
+            length -= len(data)
+    return hasher
+
+
+def part_bytes(url, filepath, head):
+    """
+    This function returns how many bytes of url an unfinished filepath + ".part" already
+    holds that a resume would keep: the finished segments of a segmented .part, or the
+    length of a single-stream .part, as long as the remote validators in head still match
+    the ones the .part was started with. Anything else is fetched again from byte 0.
+    """
+    part_path = filepath + PART_SUFFIX
+    state = _read_part_state(part_path)
+    if head is None or state is None or state.get("url") != url or not os.path.exists(part_path):
+        return 0
+    if any(state.get(k) != head[k] for k in ("size", "etag", "last_modified") if head[k] is not None):
+        return 0
+    if state.get("segments"):
+        return sum(state["segments"][i][1] - state["segments"][i][0] + 1 for i in state.get("done", []))
+    if not _if_range_validator(state):
+        return 0
+    return min(os.path.getsize(part_path), head["size"] or 0)
+
+
+class _WriteBehind:
+    """
+    Background writer: chunks read from the network are queued here and written to the
+    open file by a separate thread, which also feeds the optional hasher so the checksum
+    is ready when the last byte lands. The queue is bounded so memory stays at
+    depth * chunk_size per transfer. With an observer, each chunk is flushed and reported
+    as observer.received(start, end), counting from offset.
+    """
+
+    def __init__(self, fileobj, depth=WRITE_BEHIND_DEPTH, hasher=None, observer=None, offset=0):
+        self.fileobj = fileobj
+        self.hasher = hasher
+        self.observer = observer
+        self.offset = offset
+        self.bytes_written = 0
+        self._queue = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self.fileobj.write(chunk)
+                if self.hasher is not None:
+                    self.hasher.update(chunk)
+                if self.observer is not None:
+                    self.fileobj.flush()
+                    start = self.offset + self.bytes_written
+                    self.observer.received(start, start + len(chunk))
+                self.bytes_written += len(chunk)
+            except Exception as e:
+                self._error = e
+
+    def write(self, chunk):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(chunk)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+class DownloadEngine:
+    """
+    Pooled, bounded-concurrency HTTP downloader shared by the static and Selenium scrapers.
+
+    max_workers is the total number of concurrent transfers, per_host caps how many of them
+    may hit the same server at once and chunk_size is the socket read size. A transfer that
+    drops mid-way is resumed up to resume_attempts times before it is reported as failed.
+    Files of segment_threshold bytes or more are fetched over up to `segments` connections
+    (still bounded by per_host); set segment_threshold=None to always use one stream.
+
+    Every request also takes a slot from budget (default: the process-wide TransferBudget),
+    which caps connections across all engines and scrapers and optionally bytes/sec.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, per_host=DEFAULT_PER_HOST,
+                 chunk_size=DEFAULT_CHUNK_SIZE, session=None, resume_attempts=RESUME_ATTEMPTS,
+                 segment_threshold=DEFAULT_SEGMENT_THRESHOLD, segments=DEFAULT_SEGMENTS, budget=None):
+        self.max_workers = max(1, max_workers)
+        self.resume_attempts = resume_attempts
+        self.per_host = max(1, per_host)
+        self.chunk_size = chunk_size
+        self.segment_threshold = segment_threshold
+        self.segments = segments
+        self.session = session or make_session(
+            pool_size=max(self.max_workers, self.per_host, self.segments))
+        self._host_slots = defaultdict(lambda: threading.BoundedSemaphore(self.per_host))
+        self._host_lock = threading.Lock()
+        self.budget = budget or default_budget()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    @contextmanager
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._host_lock:
+            slot = self._host_slots[host]
+        with slot, self.budget.connection(url):
+            yield
+
+    def head(self, url):
+        """
+        This function returns the size, ETag, Last-Modified and Accept-Ranges of url from a
+        HEAD request, or None if the server doesn't answer HEAD.
+        """
+        return self._head(url)
+
+    def get_text(self, url):
+        """
+        This function fetches a small text resource (e.g. a directory listing page) over the
+        pooled session. It does not take one of this engine's per-host transfer slots, so a
+        crawl is never stuck behind the large downloads it has already started on the same
+        server, but it does count against the transfer budget.
+        """
+        with self.budget.connection(url):
+            r = self.session.get(url, timeout=(10, 60))
+        r.raise_for_status()
+        return r.text
+
+    def download(self, url, filepath, manifest=None, observer=None):
+        """
+        This function streams one url to filepath over the pooled session and returns a
+        result dict with the url, path, number of bytes, elapsed seconds and any error.
+
+        Bytes go to filepath + ".part" and the file is renamed into place only when complete.
+        An interrupted transfer is resumed with a Range request (validated with If-Range
+        against the ETag or Last-Modified seen when the .part was started), both within
+        this call and on the next run, so only the missing tail is fetched again.
+
+        Files of at least segment_threshold bytes on servers that accept Range requests are
+        split into byte ranges fetched over several connections at once; anything else
+        falls back to a single stream.
+
+        With a DownloadManifest, a file whose remote ETag (or size) still matches its
+        manifest entry is skipped after a single HEAD request, and every completed file is
+        recorded together with the checksum computed while it streamed to disk.
+
+        An observer is told about the .part as it fills: observer.restart() whenever the
+        .part is started again from nothing (earlier bytes are void), and
+        observer.received(start, end) once bytes [start, end) are on disk, including the
+        part a previous run left behind. Ranges may arrive out of order in segmented mode.
+        """
+        start_time = time.time()
+        result = {"url": url, "path": filepath, "bytes": 0, "transferred": 0,
+                  "resumed_from": 0, "segments": 0, "skipped": False, "checksum": None,
+                  "checksum_algorithm": None, "etag": None, "last_modified": None,
+                  "seconds": 0.0, "error": None}
+        part_path = filepath + PART_SUFFIX
+        try:
+            head = self._head(url) if manifest is not None or self._can_segment() else None
+            if manifest is not None and head is not None and manifest.is_current(
+                    filepath, size=head["size"], etag=head["etag"],
+                    last_modified=head["last_modified"]):
+                result.update(skipped=True, bytes=os.path.getsize(filepath))
+                result["seconds"] = time.time() - start_time
+                return result
+
+            probe = self._probe_segmented(url, part_path, head)
+            if probe is not None:
+                try:
+                    self._segmented_download(url, part_path, probe, result, observer)
+                except RangeNotSupported as e:
+                    logger.info(f"{url}: {e}, falling back to a single stream")
+                    _discard_part(part_path)
+                    result["segments"] = 0
+                    probe = None
+            if probe is None:
+                state = _read_part_state(part_path)
+                if state is not None and state.get("segments"):
+                    # a preallocated segmented .part can't be resumed as a stream
+                    _discard_part(part_path)
+                with self._host_slot(url):
+                    self._stream_with_resume(url, part_path, result, observer)
+            os.replace(part_path, filepath)
+            _remove_part_state(part_path)
+            if manifest is not None:
+                manifest.record(filepath, url=url, size=result["bytes"], file_size=result["bytes"],
+                                etag=result["etag"], last_modified=result["last_modified"],
+                                checksum=result["checksum"],
+                                checksum_algorithm=result["checksum_algorithm"])
+        except Exception as e:
+            result["error"] = e
+            logger.error(f"Failed to download {url}: {e}", exc_info=True)
+        result["seconds"] = time.time() - start_time
+        return result
+
+    def _stream_with_resume(self, url, part_path, result, observer=None):
+        attempt = 0
+        while True:
+            try:
+                self._fetch_to_part(url, part_path, result, observer)
+                return
+            except RESUMABLE_ERRORS as e:
+                attempt += 1
+                if attempt > self.resume_attempts:
+                    raise
+                have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                logger.warning(f"Transfer of {url} interrupted ({e}), "
+                               f"resuming from byte {have} (attempt {attempt})")
+                time.sleep(min(0.5 * 2 ** attempt, 30))
+
+    def _can_segment(self):
+        return bool(self.segment_threshold) and self.segments >= 2 and hasattr(os, "pwrite")
+
+    def _head(self, url):
+        """
+        HEAD the url and return its size, validators and Range support, or None if the
+        server doesn't answer HEAD.
+        """
+        try:
+            with self._host_slot(url):
+                r = self.session.head(url, allow_redirects=True, headers=IDENTITY_ENCODING, timeout=(10, 60))
+            r.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"HEAD {url} failed: {e}")
+            return None
+        return {"size": _content_length(r.headers), "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "accept_ranges": r.headers.get("Accept-Ranges", "").lower()}
+
+    def _probe_segmented(self, url, part_path, head):
+        """
+        Return the size and validators from head if the url is worth downloading in
+        segments, otherwise None.
+        """
+        if head is None or not self._can_segment():
+            return None
+        state = _read_part_state(part_path)
+        if state is not None and not state.get("segments") and os.path.exists(part_path):
+            # an unfinished single-stream .part is cheaper to resume as it is
+            return None
+        size = head["size"]
+        if size is None or size < self.segment_threshold or head["accept_ranges"] == "none":
+            return None
+        return {"url": url, "size": size, "etag": head["etag"],
+                "last_modified": head["last_modified"]}
+
+    def _segmented_download(self, url, part_path, probe, result, observer=None):
+        """
+        Fetch the byte ranges of a large file concurrently and pwrite each one into its
+        place in a preallocated .part. Finished segments are recorded in the sidecar so a
+        later run only fetches the ones still missing.
+        """
+        size = probe["size"]
+        state = _read_part_state(part_path)
+        resumable = (state is not None and state.get("segments") and "digests" in state
+                     and all(state.get(k) == probe[k] for k in ("url", "size", "etag", "last_modified"))
+                     and os.path.exists(part_path) and os.path.getsize(part_path) == size)
+        if not resumable:
+            state = dict(probe, segments=_split_ranges(size, self.segments), done=[], digests={})
+            if observer is not None:
+                observer.restart()
+            fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                _preallocate(fd, size)
+            finally:
+                os.close(fd)
+            _write_part_state(part_path, state)
+
+        done = set(state["done"])
+        if observer is not None:
+            for i in sorted(done):
+                observer.received(state["segments"][i][0], state["segments"][i][1] + 1)
+        todo = [i for i in range(len(state["segments"])) if i not in done]
+        result["resumed_from"] = sum(state["segments"][i][1] - state["segments"][i][0] + 1 for i in done)
+        result["segments"] = len(state["segments"])
+        validator = _if_range_validator(state)
+        state_lock = threading.Lock()
+        stop = threading.Event()
+
+        def fetch_segment(i):
+            start, end = state["segments"][i]
+            pos = start
+            attempt = 0
+            hasher = hashlib.sha256()
+            while pos <= end:
+                if stop.is_set():
+                    return
+                headers = dict(IDENTITY_ENCODING, Range=f"bytes={pos}-{end}")
+                if validator:
+                    headers["If-Range"] = validator
+                try:
+                    with self._host_slot(url):
+                        with self.session.get(url, stream=True, headers=headers, timeout=(10, 60)) as r:
+                            r.raise_for_status()
+                            if r.status_code != 206:
+                                raise RangeNotSupported(f"server answered {r.status_code} to a Range request")
+                            range_start, total = _parse_content_range(r.headers.get("Content-Range"))
+                            if range_start != pos or (total is not None and total != size):
+                                raise RangeNotSupported(f"server sent {r.headers.get('Content-Range')} "
+                                                        f"for bytes {pos}-{end}")
+                            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                                if stop.is_set():
+                                    return
+                                chunk = chunk[:end + 1 - pos]
+                                self.budget.throttle(len(chunk))
+                                _pwrite_all(fd, chunk, pos)
+                                hasher.update(chunk)
+                                if observer is not None:
+                                    observer.received(pos, pos + len(chunk))
+                                pos += len(chunk)
+                                with state_lock:
+                                    result["transferred"] += len(chunk)
+                    if pos <= end:
+                        raise IncompleteDownload(f"segment {start}-{end} ended at byte {pos}")
+                except RESUMABLE_ERRORS as e:
+                    attempt += 1
+                    if attempt > self.resume_attempts:
+                        raise
+                    logger.warning(f"Segment {start}-{end} of {url} interrupted ({e}), "
+                                   f"resuming from byte {pos} (attempt {attempt})")
+                    time.sleep(min(0.5 * 2 ** attempt, 30))
+            with state_lock:
+                state["done"].append(i)
+                state["digests"][str(i)] = hasher.hexdigest()
+                _write_part_state(part_path, state)
+
+        fd = os.open(part_path, os.O_RDWR)
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.segments, max(1, len(todo)))) as executor:
+                futures = [executor.submit(fetch_segment, i) for i in todo]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    stop.set()
+                    raise
+        finally:
+            os.close(fd)
+        result["bytes"] = size
+        result["etag"], result["last_modified"] = state["etag"], state["last_modified"]
+        # ranges finish out of order, so the file digest is the sha256 of the per-segment
+        # sha256 digests, in byte order (like a multipart ETag)
+        combined = hashlib.sha256()
+        for i in range(len(state["segments"])):
+            combined.update(bytes.fromhex(state["digests"][str(i)]))
+        result["checksum"] = combined.hexdigest()
+        result["checksum_algorithm"] = f"sha256-segments:{state['segments'][0][1] + 1}"
+
+    def _fetch_to_part(self, url, part_path, result, observer=None):
+        """
+        One GET attempt: resume part_path if it has a usable validator, otherwise start
+        from byte 0. Raises IncompleteDownload if the body ends short.
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        state = _read_part_state(part_path) if offset else None
+        headers = dict(IDENTITY_ENCODING)
+        if state is not None and state.get("url") == url:
+            validator = _if_range_validator(state)
+            if validator:
+                headers.update({"Range": f"bytes={offset}-", "If-Range": validator})
+
+        with self.session.get(url, stream=True, headers=headers, timeout=(10, 60)) as r:
+            if r.status_code == 416 and state is not None and state.get("size") == offset:
+                # the previous run got every byte but stopped before the rename
+                result["bytes"] = offset
+                result["etag"], result["last_modified"] = state.get("etag"), state.get("last_modified")
+                result["checksum"] = _hash_file(part_path, offset).hexdigest()
+                result["checksum_algorithm"] = "sha256"
+                if observer is not None:
+                    observer.received(0, offset)
+                return
+            r.raise_for_status()
+
+            if "Range" in headers and r.status_code == 206:
+                range_start, total = _parse_content_range(r.headers.get("Content-Range"))
+                if range_start != offset:
+                    raise ValueError(f"Server resumed {url} at byte {range_start}, expected {offset}")
+                mode = "ab"
+                etag, last_modified = state.get("etag"), state.get("last_modified")
+                # the only re-read: the prefix a previous attempt already wrote
+                hasher = _hash_file(part_path, offset)
+                if observer is not None:
+                    observer.received(0, offset)
+            else:
+                # no partial file, no validator, or the remote file changed: start over
+                offset = 0
+                total = _content_length(r.headers)
+                _write_part_state(part_path, {
+                    "url": url,
+                    "size": total,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                })
+                mode = "wb"
+                etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+                hasher = hashlib.sha256()
+                if observer is not None:
+                    observer.restart()
+
+            result["resumed_from"] = offset
+            with open(part_path, mode) as f:
+                writer = _WriteBehind(f, hasher=hasher, observer=observer, offset=offset)
+                try:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        if chunk:
+                            self.budget.throttle(len(chunk))
+                            writer.write(chunk)
+                finally:
+                    writer.close()
+                    result["transferred"] += writer.bytes_written
+
+        written = offset + writer.bytes_written
+        if total is not None and written != total:
+            raise IncompleteDownload(f"got {written} of {total} bytes")
+        result["bytes"] = written
+        result["etag"], result["last_modified"] = etag, last_modified
+        result["checksum"] = hasher.hexdigest()
+        result["checksum_algorithm"] = "sha256"
+
+    def download_many(self, tasks, desc=None, manifest=None, download=None):
+        """
+        This function downloads a list of (url, filepath) tasks concurrently and returns the
+        result dicts in the same order as the tasks. download(url, filepath, manifest) can
+        replace self.download, e.g. to transcode files as they arrive.
+        """
+        download = download or self.download
+
+        def _download(task):
+            return download(*task, manifest)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(tqdm(executor.map(_download, tasks), total=len(tasks),
+                                desc=desc, unit="file"))
+        return results
+
+
+def format_result(result):
+    """
+    This function turns a download result dict into a one-line log message.
+    """
+    name = os.path.basename(result["path"])
+    if result["error"] is not None:
+        return f"{name}: {result['error']}"
+    if result.get("skipped"):
+        return f"{name}: up to date, skipped"
+    mb = result["bytes"] / 1e6
+    rate = mb / result["seconds"] if result["seconds"] > 0 else float("inf")
+    message = f"{name}: {mb:.2f} MB in {result['seconds']:.2f} s ({rate:.2f} MB/s)"
+    if result.get("segments"):
+        message += f", {result['segments']} segments"
+    if result.get("resumed_from"):
+        message += f", resumed at byte {result['resumed_from']}"
+    if result.get("transcode"):
+        message += f", {result['transcode']['planes']} planes transcoded to {os.path.basename(result['zarr_path'])}"
+    return message
+
+
+__all__ = ["DownloadEngine", "IncompleteDownload", "RangeNotSupported", "make_session", "part_bytes",
+           "format_result"]
@@ -0,0 +1,742 @@
+"""
+img_dataset_tools.intensity_stats
+
+This script contains the streaming intensity statistics engine. A volume opened with
+open_volume() (TIFF, DM3, Zarr) is read block by block and every block is folded into an
+IntensityStats accumulator: count, min, max, mean and variance (merged with Chan's parallel
+update) and a histogram from which percentiles and display ranges are found with a
+cumulative-sum search. 8- and 16-bit integer data get one bin per value, so their
+percentiles are exact; other data is binned on a power-of-two grid that widens as values
+arrive, so accumulators built from different blocks merge without a second pass. Blocks are
+spread over a process pool and the partial results merged, and add_intensity_stats() puts
+the result of every file into its metadata catalog row. A volume is never held in memory
+at once.
+
+For volumes too large for a full pass, sampled_stats() reads a seeded, stratified random
+sample of units (chunks or pages) into mergeable QuantileSketches, one per random group of
+strata, and reports confidence intervals from the spread between the groups and the rank
+error of the sketch.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .volumes import open_volume, worker_volume
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATS_BINS = 65536
+DEFAULT_STATS_BLOCK_BYTES = 64 * 1024 ** 2     # largest block of voxels one worker reads at once
+PIECE_VOXELS = 4 * 1024 ** 2                   # voxels folded in at a time, bounds the temporaries
+DEFAULT_CUTOFF = 0.1                           # percent ignored at each end of the display range
+CATALOG_PERCENTILES = (0.1, 1, 50, 99, 99.9)
+DEFAULT_SKETCH_K = 4096                        # values kept per level of a QuantileSketch
+DEFAULT_SAMPLE_FRACTION = 0.01
+DEFAULT_SAMPLE_GROUPS = 10
+DEFAULT_SAMPLE_UNIT_BYTES = 1024 ** 2          # smallest unit a volume is sampled in
+DEFAULT_SAMPLE_MAX_BYTES = 256 * 1024 ** 2     # most a sample reads, whatever the fraction
+# two-sided 95 % Student t critical values by degrees of freedom (the random groups less one)
+T_95 = {1: 12.71, 2: 4.30, 3: 3.18, 4: 2.78, 5: 2.57, 6: 2.45, 7: 2.36, 8: 2.31, 9: 2.26, 10: 2.23,
+        12: 2.18, 15: 2.13, 20: 2.09, 30: 2.04, 60: 2.00}
+
+
+def _merge_moments(count, mean, m2, other_count, other_mean, other_m2):
+    # Chan et al. parallel update of the count, mean and sum of squared deviations
+    total = count + other_count
+    delta = other_mean - mean
+    return total, mean + delta * other_count / total, m2 + other_m2 + delta * delta * count * other_count / total
+
+
+def _piece_moments(values):
+    # count, mean and sum of squared deviations of a 1D array, in float64
+    mean = float(values.mean(dtype=np.float64))
+    deviation = values - np.float64(mean)
+    return int(values.size), mean, float(np.dot(deviation, deviation))
+
+
+class IntensityStats:
+    """
+    Mergeable intensity statistics of a stream of arrays of one dtype. update() folds in an
+    array, merge() another accumulator (e.g. of another block); count, min, max, mean, std,
+    percentile() and display_range() read the result at any time.
+    """
+
+    def __init__(self, dtype, bins=DEFAULT_STATS_BINS):
+        self.dtype = np.dtype(dtype)
+        self.exact = self.dtype.kind in "biu" and self.dtype.itemsize <= 2
+        self.count = 0
+        self.nonfinite = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        if self.exact:
+            # one bin per value of the dtype
+            self.low = int(np.iinfo(self.dtype).min) if self.dtype.kind != "b" else 0
+            self.width = 1
+            self.bins = 2 if self.dtype.kind == "b" else 2 ** (8 * self.dtype.itemsize)
+        else:
+            self.low = self.width = None
+            self.bins = bins
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self._min = self._max = None
+
+    # ---- accumulation ----
+
+    def update(self, data):
+        """
+        This function folds the values of array data into the statistics; NaN and infinite
+        values are only counted, in nonfinite.
+        """
+        data = np.asarray(data).reshape(-1)
+        for start in range(0, data.size, PIECE_VOXELS):
+            self._update_piece(data[start:start + PIECE_VOXELS])
+        return self
+
+    def _update_piece(self, values):
+        if self.dtype.kind == "f":
+            finite = np.isfinite(values)
+            if not finite.all():
+                self.nonfinite += int(values.size - np.count_nonzero(finite))
+                values = values[finite]
+        if values.size == 0:
+            return
+        if self.exact:
+            self.counts += np.bincount(values if self.low == 0 else values.astype(np.int64) - self.low,
+                                       minlength=self.bins)
+            self.count += int(values.size)
+            return
+        lo, hi = values.min(), values.max()
+        self._min = lo if self._min is None else min(self._min, lo)
+        self._max = hi if self._max is None else max(self._max, hi)
+        self._add_moments(*_piece_moments(values))
+        self._cover(float(lo), float(hi))
+        index = ((values - np.float64(self.low)) / self.width).astype(np.int64)
+        np.minimum(index, self.bins - 1, out=index)
+        self.counts += np.bincount(index, minlength=self.bins)
+
+    def _add_moments(self, count, mean, m2):
+        self.count, self._mean, self._m2 = _merge_moments(self.count, self._mean, self._m2, count, mean, m2)
+
+    def _cover(self, lo, hi, min_width=None):
+        # widens the power-of-two bin grid (rebinning the counts) until it holds [lo, hi]
+        if self.low is None:
+            span = (hi - lo) / self.bins
+            width = 2.0 ** math.ceil(math.log2(span)) if span > 0 else \
+                2.0 ** (math.floor(math.log2(abs(lo))) - 20 if lo else -20)
+            if self.dtype.kind in "iu":
+                width = max(width, 1.0)
+            width = max(width, min_width or 0.0)
+            low = math.floor(lo / width) * width
+            # flooring lo moves the grid down, which can push hi past the top bin
+            while hi >= low + width * self.bins:
+                width *= 2
+                low = math.floor(lo / width) * width
+            self.width, self.low = width, low
+            return
+        width, low = self.width, self.low
+        top = low + width * self.bins
+        lo, hi = min(lo, low), max(hi, top - width)
+        while lo < low or hi >= low + width * self.bins or width < (min_width or 0.0):
+            width *= 2
+            low = math.floor(lo / width) * width
+        if width != self.width:
+            self.counts = _rebin(self.counts, self.low, self.width, low, width, self.bins)
+            self.low, self.width = low, width
+
+    def merge(self, other):
+        """
+        This function adds the statistics of other, an IntensityStats of the same dtype
+        and bins, to these ones.
+        """
+        if other.dtype != self.dtype or other.bins != self.bins:
+            raise ValueError(f"Can't merge statistics of {other.dtype} with {other.bins} bins into "
+                             f"{self.dtype} with {self.bins} bins")
+        self.nonfinite += other.nonfinite
+        if other.count == 0:
+            return self
+        if self.exact:
+            self.counts += other.counts
+            self.count += other.count
+            return self
+        self._min = other._min if self._min is None else min(self._min, other._min)
+        self._max = other._max if self._max is None else max(self._max, other._max)
+        self._add_moments(other.count, other._mean, other._m2)
+        self._cover(float(other._min), float(other._max), other.width)
+        self.counts += _rebin(other.counts, other.low, other.width, self.low, self.width, self.bins)
+        return self
+
+    # ---- results ----
+
+    def _values(self):
+        return self.low + self.width * np.arange(self.bins, dtype=np.float64)
+
+    @property
+    def min(self):
+        if self.count == 0:
+            return None
+        if self.exact:
+            return self.low + int(np.flatnonzero(self.counts)[0])
+        return self._min.item()
+
+    @property
+    def max(self):
+        if self.count == 0:
+            return None
+        if self.exact:
+            return self.low + int(np.flatnonzero(self.counts)[-1])
+        return self._max.item()
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        if self.exact:
+            return float(np.dot(self.counts, self._values()) / self.count)
+        return self._mean
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return None
+        if self.exact:
+            deviation = self._values() - self.mean
+            return float(np.sqrt(np.dot(self.counts, deviation * deviation) / self.count))
+        return math.sqrt(self._m2 / self.count)
+
+    def percentile(self, q):
+        """
+        This function returns the q-th percentile (0-100) of the values: the smallest value
+        with at least q percent of the values at or below it, exact for 8- and 16-bit
+        integers (and wider ones while the bins are 1 wide) and interpolated within one bin
+        (bin_width) otherwise, rounded to an integer for integer data.
+        """
+        if self.count == 0:
+            return None
+        target = q / 100.0 * self.count
+        if target <= 0:
+            return self.min
+        cumulative = np.cumsum(self.counts)
+        index = min(int(np.searchsorted(cumulative, target, side="left")), self.bins - 1)
+        if self.exact:
+            return self.low + index
+        integer = self.dtype.kind in "iu"
+        if integer and self.width == 1:
+            return int(self.low) + index
+        before = cumulative[index - 1] if index else 0
+        fraction = (target - before) / self.counts[index] if self.counts[index] else 0.0
+        value = min(max(self.low + (index + fraction) * self.width, self.min), self.max)
+        return int(round(value)) if integer else float(value)
+
+    def display_range(self, cutoff=DEFAULT_CUTOFF):
+        """
+        This function returns the display range (cuts) that leaves out the cutoff percent
+        lowest and highest values.
+        """
+        return self.percentile(cutoff), self.percentile(100.0 - cutoff)
+
+    @property
+    def bin_width(self):
+        return self.width
+
+    def histogram(self):
+        """
+        This function returns the counts and bin edges of the occupied part of the histogram,
+        as numpy.histogram would.
+        """
+        occupied = np.flatnonzero(self.counts)
+        if occupied.size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(1)
+        first, last = occupied[0], occupied[-1] + 1
+        return self.counts[first:last].copy(), self.low + self.width * np.arange(first, last + 1, dtype=np.float64)
+
+    def result(self, percentiles=CATALOG_PERCENTILES):
+        """
+        This function returns the statistics as a dict.
+        """
+        return {"count": self.count, "nonfinite": self.nonfinite, "min": self.min, "max": self.max,
+                "mean": self.mean, "std": self.std, "bin_width": self.bin_width,
+                "percentiles": {q: self.percentile(q) for q in percentiles}}
+
+    def __repr__(self):
+        return (f"<IntensityStats {self.dtype} count={self.count} min={self.min} max={self.max} "
+                f"mean={self.mean} std={self.std}>")
+
+
+def _rebin(counts, low, width, new_low, new_width, bins):
+    # counts of a (low, width) grid moved onto a coarser, aligned (new_low, new_width) grid
+    factor = int(round(new_width / width))
+    offset = int(round((low - new_low) / width))
+    index = (offset + np.arange(counts.size)) // factor
+    occupied = counts != 0
+    return np.bincount(index[occupied], weights=counts[occupied], minlength=bins)[:bins].astype(np.int64)
+
+
+def stat_blocks(shape, chunks, itemsize, block_bytes=DEFAULT_STATS_BLOCK_BYTES):
+    """
+    This function splits a volume into blocks of about block_bytes for the workers: slabs
+    of whole chunks along the first axis spanning the others or, where one chunk layer is
+    larger, rows of whole chunks along the second axis.
+    """
+    shape, chunks = tuple(shape), tuple(chunks)
+    if not shape:
+        yield ()
+        return
+    rest = tuple(slice(0, n) for n in shape[1:])
+    layer = int(np.prod(shape[1:])) * itemsize * chunks[0]
+    if layer <= block_bytes or len(shape) == 1:
+        step = max(1, block_bytes // max(1, layer)) * chunks[0]
+        for z in range(0, shape[0], step):
+            yield (slice(z, min(z + step, shape[0])),) + rest
+        return
+    row = chunks[0] * chunks[1] * int(np.prod(shape[2:])) * itemsize
+    step = max(1, block_bytes // max(1, row)) * chunks[1]
+    for z in range(0, shape[0], chunks[0]):
+        for y in range(0, shape[1], step):
+            yield (slice(z, min(z + chunks[0], shape[0])), slice(y, min(y + step, shape[1]))) + rest[1:]
+
+
+def _block_stats(path, level, slices, bins):
+    # runs in a pool process; the volume stays open between blocks of the same file
+    volume = worker_volume(path, level)
+    return IntensityStats(volume.dtype, bins).update(volume[slices])
+
+
+def volume_stats(path, level=0, bins=DEFAULT_STATS_BINS, workers=None, block_bytes=DEFAULT_STATS_BLOCK_BYTES,
+                 executor=None):
+    """
+    This function returns the IntensityStats of the volume at path (anything open_volume
+    reads; level picks the scale of a multiscale group). Blocks of about block_bytes are
+    spread over workers processes (default: every core) or over executor and their results
+    merged; with workers=1 they are read in this process.
+    """
+    with open_volume(path, level=level) as volume:
+        dtype, blocks = volume.dtype, list(stat_blocks(volume.shape, volume.chunks, volume.dtype.itemsize,
+                                                       block_bytes))
+        stats = IntensityStats(dtype, bins)
+        if executor is None and workers == 1:
+            for slices in blocks:
+                stats.update(volume[slices])
+            return stats
+    own_executor = executor is None
+    executor = executor or ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+    try:
+        n = len(blocks)
+        for partial in executor.map(_block_stats, [path] * n, [level] * n, blocks, [bins] * n):
+            stats.merge(partial)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return stats
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch of a stream of arrays of one dtype, in the style of a KLL
+    sketch: values are kept in levels of at most k sorted values, where a value at level h
+    stands for 2 ** h of them, and a full level is compacted into the next one by keeping
+    every other value from a random start. It keeps count, min, max, mean and std exactly,
+    answers percentile() and display_range() like IntensityStats, and tracks the variance
+    its compactions add to any rank, reported by rank_error.
+    """
+
+    def __init__(self, dtype, k=DEFAULT_SKETCH_K, seed=None):
+        self.dtype = np.dtype(dtype)
+        self.k = k
+        self.count = 0
+        self.nonfinite = 0
+        self.levels = []
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._min = self._max = None
+        self._variance = 0.0
+        self._rng = np.random.default_rng(seed)
+        self._sorted = None
+
+    def _sort(self, values):
+        # numpy's radix sort is far faster than the default one for one-byte values
+        return np.sort(values, kind="stable" if self.dtype.itemsize == 1 else None)
+
+    def update(self, data):
+        """
+        This function folds the values of array data into the sketch; NaN and infinite
+        values are only counted, in nonfinite.
+        """
+        data = np.asarray(data).reshape(-1)
+        for start in range(0, data.size, PIECE_VOXELS):
+            self._update_piece(data[start:start + PIECE_VOXELS])
+        return self
+
+    def _update_piece(self, values):
+        if self.dtype.kind == "f":
+            finite = np.isfinite(values)
+            if not finite.all():
+                self.nonfinite += int(values.size - np.count_nonzero(finite))
+                values = values[finite]
+        if values.size == 0:
+            return
+        values = self._sort(values)
+        self._min = values[0] if self._min is None else min(self._min, values[0])
+        self._max = values[-1] if self._max is None else max(self._max, values[-1])
+        self.count, self._mean, self._m2 = _merge_moments(self.count, self._mean, self._m2,
+                                                          *_piece_moments(values))
+        # a large piece goes straight to the level where it fits: every 2 ** h-th value from a
+        # random start, as h compactions in a row would keep
+        h = max(0, math.ceil(math.log2(values.size / self.k)))
+        if h:
+            step = 2 ** h
+            values = values[self._rng.integers(step):: step]
+            self._variance += step * step
+        self._add(h, values)
+        self._compact()
+
+    def _add(self, h, values):
+        while len(self.levels) <= h:
+            self.levels.append(np.empty(0, dtype=self.dtype))
+        self.levels[h] = np.concatenate([self.levels[h], values])
+        self._sorted = None
+
+    def _compact(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if level.size > self.k:
+                level = self._sort(level)
+                # an odd value out stays on this level
+                keep, level = (level[-1:], level[:-1]) if level.size % 2 else (level[:0], level)
+                self.levels[h] = keep
+                self._add(h + 1, level[self._rng.integers(2)::2])
+                self._variance += (2 ** (h + 1)) ** 2
+            h += 1
+
+    def merge(self, other):
+        """
+        This function adds the values summarized by other, a QuantileSketch of the same
+        dtype, to this sketch.
+        """
+        if other.dtype != self.dtype:
+            raise ValueError(f"Can't merge a sketch of {other.dtype} into one of {self.dtype}")
+        self.nonfinite += other.nonfinite
+        if other.count == 0:
+            return self
+        self._min = other._min if self._min is None else min(self._min, other._min)
+        self._max = other._max if self._max is None else max(self._max, other._max)
+        self.count, self._mean, self._m2 = _merge_moments(self.count, self._mean, self._m2,
+                                                          other.count, other._mean, other._m2)
+        self._variance += other._variance
+        for h, level in enumerate(other.levels):
+            if level.size:
+                self._add(h, level)
+        self._compact()
+        return self
+
+    # ---- results ----
+
+    @property
+    def min(self):
+        return None if self.count == 0 else self._min.item()
+
+    @property
+    def max(self):
+        return None if self.count == 0 else self._max.item()
+
+    @property
+    def mean(self):
+        return None if self.count == 0 else self._mean
+
+    @property
+    def std(self):
+        return None if self.count == 0 else math.sqrt(self._m2 / self.count)
+
+    @property
+    def rank_error(self):
+        """
+        This function returns the standard deviation, in values, of the rank the sketch
+        gives any value: the spread its compactions add.
+        """
+        return math.sqrt(self._variance)
+
+    def _cumulative(self):
+        if self._sorted is None:
+            values = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(level.size, 2 ** h, dtype=np.int64)
+                                      for h, level in enumerate(self.levels)])
+            order = np.argsort(values, kind="stable")
+            self._sorted = values[order], np.cumsum(weights[order])
+        return self._sorted
+
+    def percentile(self, q):
+        """
+        This function returns the q-th percentile (0-100) of the values: the smallest kept
+        value with at least q percent of the (weighted) values at or below it.
+        """
+        if self.count == 0:
+            return None
+        values, cumulative = self._cumulative()
+        target = q / 100.0 * cumulative[-1]
+        if target <= 0:
+            return self.min
+        index = min(int(np.searchsorted(cumulative, target, side="left")), values.size - 1)
+        return values[index].item()
+
+    def display_range(self, cutoff=DEFAULT_CUTOFF):
+        """
+        This function returns the display range (cuts) that leaves out the cutoff percent
+        lowest and highest values.
+        """
+        return self.percentile(cutoff), self.percentile(100.0 - cutoff)
+
+    def __repr__(self):
+        return (f"<QuantileSketch {self.dtype} count={self.count} kept={sum(l.size for l in self.levels)} "
+                f"rank_error={self.rank_error:.0f}>")
+
+
+def sample_units(shape, chunks, itemsize, unit_bytes=DEFAULT_SAMPLE_UNIT_BYTES):
+    """
+    This function returns the shape of the units a volume is sampled in: its chunks, grown
+    in whole chunks along the last axes (a TIFF page from its strips, say) until a unit
+    holds about unit_bytes.
+    """
+    unit = list(chunks)
+    for axis in reversed(range(len(shape))):
+        size = int(np.prod(unit)) * itemsize
+        if size >= unit_bytes:
+            break
+        unit[axis] = min(shape[axis], unit[axis] * max(1, unit_bytes // size))
+    return tuple(unit)
+
+
+def _sketch_units(volume, units, dtype, k, seed):
+    # one random group of sampled units into one sketch
+    sketch = QuantileSketch(dtype, k, seed)
+    for slices in units:
+        sketch.update(volume[slices])
+    return sketch
+
+
+def _sample_group(path, level, units, dtype, k, seed):
+    # runs in a pool process
+    return _sketch_units(worker_volume(path, level), units, dtype, k, seed)
+
+
+class SampledStats:
+    """
+    Intensity statistics estimated from a stratified random sample of a volume's units.
+    sketch summarizes every sampled value; groups holds one sketch per random group of
+    strata, whose spread gives the sampling error. percentile(), mean, std and
+    display_range() are the estimates, percentile_bounds() and mean_bounds() their
+    confidence intervals; min and max are those of the sample.
+    """
+
+    def __init__(self, sketch, groups, units_sampled, units_total, fraction, seed, seconds=0.0):
+        self.sketch = sketch
+        self.groups = [group for group in groups if group.count]
+        self.units_sampled = units_sampled
+        self.units_total = units_total
+        self.fraction = fraction
+        self.seed = seed
+        self.seconds = seconds
+
+    @property
+    def dtype(self):
+        return self.sketch.dtype
+
+    @property
+    def count(self):
+        return self.sketch.count
+
+    @property
+    def nonfinite(self):
+        return self.sketch.nonfinite
+
+    @property
+    def min(self):
+        return self.sketch.min
+
+    @property
+    def max(self):
+        return self.sketch.max
+
+    @property
+    def mean(self):
+        return self.sketch.mean
+
+    @property
+    def std(self):
+        return self.sketch.std
+
+    def percentile(self, q):
+        return self.sketch.percentile(q)
+
+    def display_range(self, cutoff=DEFAULT_CUTOFF):
+        return self.sketch.display_range(cutoff)
+
+    @property
+    def sampled_fraction(self):
+        return self.units_sampled / self.units_total if self.units_total else 1.0
+
+    def _sampling_error(self, estimates):
+        # random-groups standard error, with the finite population correction
+        if len(estimates) < 2:
+            return 0.0 if self.units_sampled >= self.units_total else float("nan")
+        estimates = np.asarray(estimates, dtype=np.float64)
+        error = estimates.std(ddof=1) / math.sqrt(len(estimates))
+        return float(error * math.sqrt(max(0.0, 1.0 - self.sampled_fraction)))
+
+    def percentile_error(self, q):
+        """
+        This function returns the standard error of percentile(q): the spread between the
+        random groups, combined with the rank error of the sketch turned into values.
+        """
+        sampling = self._sampling_error([group.percentile(q) for group in self.groups])
+        rank = 100.0 * self.sketch.rank_error / max(1, self.sketch.count)
+        sketching = (self.sketch.percentile(min(100.0, q + rank)) - self.sketch.percentile(max(0.0, q - rank))) / 2
+        return math.sqrt(sampling ** 2 + sketching ** 2)
+
+    @property
+    def critical_value(self):
+        """
+        This function returns how many standard errors a 95 % interval spans on each side:
+        the Student t value for the degrees of freedom of the random groups.
+        """
+        df = len(self.groups) - 1
+        return next((t for d, t in sorted(T_95.items()) if d >= df), 1.96) if df > 0 else 1.96
+
+    def percentile_bounds(self, q, z=None):
+        """
+        This function returns the (low, high) confidence interval of percentile(q), z
+        standard errors wide on each side (default: critical_value, about 95 %).
+        """
+        z = z or self.critical_value
+        estimate, error = self.percentile(q), self.percentile_error(q)
+        return estimate - z * error, estimate + z * error
+
+    def mean_bounds(self, z=None):
+        z = z or self.critical_value
+        error = self._sampling_error([group.mean for group in self.groups])
+        return self.mean - z * error, self.mean + z * error
+
+    def result(self, percentiles=CATALOG_PERCENTILES, z=None):
+        """
+        This function returns the estimates as a dict, with the bounds of the mean and of
+        every percentile and what the sample covered.
+        """
+        return {"count": self.count, "nonfinite": self.nonfinite, "min": self.min, "max": self.max,
+                "mean": self.mean, "mean_bounds": self.mean_bounds(z), "std": self.std,
+                "percentiles": {q: self.percentile(q) for q in percentiles},
+                "percentile_bounds": {q: self.percentile_bounds(q, z) for q in percentiles},
+                "units_sampled": self.units_sampled, "units_total": self.units_total,
+                "sampled_fraction": self.sampled_fraction, "seed": self.seed, "seconds": self.seconds}
+
+    def __repr__(self):
+        return (f"<SampledStats {self.sketch.dtype} {self.units_sampled}/{self.units_total} units "
+                f"count={self.count} mean={self.mean} std={self.std}>")
+
+
+def sampled_stats(path, fraction=DEFAULT_SAMPLE_FRACTION, seed=0, level=0, groups=DEFAULT_SAMPLE_GROUPS,
+                  max_bytes=DEFAULT_SAMPLE_MAX_BYTES, unit_bytes=DEFAULT_SAMPLE_UNIT_BYTES, k=DEFAULT_SKETCH_K,
+                  workers=None, executor=None):
+    """
+    This function returns SampledStats of the volume at path (anything open_volume reads),
+    estimated from fraction of its units (see sample_units), at most max_bytes of them and
+    at least two per group. The units are split into as many strata of neighbouring units
+    as are sampled and one unit is drawn at random from each, with seed; the strata are
+    dealt into groups random groups read by workers processes (default: every core) or by
+    executor, with workers=1 in this process. The same seed gives the same sample.
+    """
+    start_time = time.time()
+    with open_volume(path, level=level) as volume:
+        dtype = volume.dtype
+        unit = sample_units(volume.shape, volume.chunks, dtype.itemsize, unit_bytes)
+        units = list(volume.chunk_slices(unit))
+    unit_nbytes = int(np.prod(unit)) * dtype.itemsize
+    total = len(units)
+    wanted = max(math.ceil(fraction * total), 2 * groups)
+    sampled = max(1, min(total, wanted, max(2, max_bytes // max(1, unit_nbytes))))
+
+    rng = np.random.default_rng(seed)
+    edges = np.linspace(0, total, sampled + 1).astype(np.int64)
+    picks = rng.integers(edges[:-1], np.maximum(edges[1:], edges[:-1] + 1))
+    groups = max(1, min(groups, sampled))
+    # a random deal, so the groups are exchangeable samples of the volume and their spread
+    # estimates the sampling error; each group still reads its units in volume order
+    order = rng.permutation(sampled)
+    members = [[units[i] for i in np.sort(picks[order[g::groups]])] for g in range(groups)]
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(groups + 1)]
+
+    if executor is None and workers == 1:
+        with open_volume(path, level=level) as volume:
+            group_sketches = [_sketch_units(volume, member, dtype, k, s) for member, s in zip(members, seeds)]
+    else:
+        own_executor = executor is None
+        executor = executor or ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        try:
+            group_sketches = list(executor.map(_sample_group, [path] * groups, [level] * groups, members,
+                                               [dtype] * groups, [k] * groups, seeds[:groups]))
+        finally:
+            if own_executor:
+                executor.shutdown()
+    sketch = QuantileSketch(dtype, k, seeds[-1])
+    for group in group_sketches:
+        sketch.merge(group)
+    return SampledStats(sketch, group_sketches, sampled, total, fraction, seed, time.time() - start_time)
+
+
+def intensity_columns(stats, percentiles=CATALOG_PERCENTILES, cutoff=DEFAULT_CUTOFF):
+    """
+    This function turns IntensityStats (or SampledStats) into metadata catalog columns.
+    """
+    columns = {"intensity_min": stats.min, "intensity_max": stats.max, "intensity_mean": stats.mean,
+               "intensity_std": stats.std}
+    for q in percentiles:
+        columns[f"intensity_p{q:g}"] = stats.percentile(q)
+    columns["display_range"] = stats.display_range(cutoff)
+    return columns
+
+
+def add_intensity_stats(rows, workers=None, bins=DEFAULT_STATS_BINS, block_bytes=DEFAULT_STATS_BLOCK_BYTES,
+                        sample_fraction=None, seed=0):
+    """
+    This function adds the intensity columns to every catalog row whose file_path is a
+    local TIFF, DM3 or Zarr volume, with the blocks of each file spread over one process
+    pool of workers processes (workers=1: read in this thread). With sample_fraction the
+    statistics are estimated from that fraction of each volume (see sampled_stats, with
+    seed) and the fraction actually read goes into intensity_sampled_fraction. Files that
+    can't be read are logged and left without the columns. Returns rows.
+    """
+    executor = None if workers == 1 else ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+    try:
+        for row in rows:
+            path = row.get("file_path")
+            if not isinstance(path, str) or not os.path.exists(path):
+                continue
+            start_time = time.time()
+            try:
+                if sample_fraction:
+                    stats = sampled_stats(path, sample_fraction, seed, workers=workers, executor=executor)
+                else:
+                    stats = volume_stats(path, bins=bins, workers=workers, block_bytes=block_bytes,
+                                         executor=executor)
+            except Exception as e:
+                logger.error(f"Failed to compute the intensity statistics of {path}: {e}")
+                continue
+            row.update(intensity_columns(stats))
+            if sample_fraction:
+                row["intensity_sampled_fraction"] = stats.sampled_fraction
+            seconds = time.time() - start_time
+            logger.info(f"Intensity statistics of {path}: {stats.count:,} voxels in {seconds:.1f} s "
+                        f"({stats.count / max(seconds, 1e-9) / 1e6:.1f} Mvoxels/s)")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return rows
+
+
+__all__ = ["IntensityStats", "QuantileSketch", "SampledStats", "volume_stats", "sampled_stats", "add_intensity_stats",
+           "intensity_columns", "stat_blocks", "sample_units", "DEFAULT_STATS_BINS", "DEFAULT_CUTOFF",
+           "CATALOG_PERCENTILES", "DEFAULT_SAMPLE_FRACTION", "DEFAULT_SKETCH_K"]
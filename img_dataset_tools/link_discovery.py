@@ -0,0 +1,128 @@
+"""
+img_dataset_tools.link_discovery
+
+This script contains the link extractor used by the webscrapers to find the downloadable files
+on a dataset page. It first parses the plain HTML with BeautifulSoup, then runs a regex over the
+raw page (which also catches links built in embedded JavaScript), and only starts a headless
+Chrome through Selenium when neither finds anything. Discovered link lists are cached on disk
+with a time-to-live so repeat runs never need the browser.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+from bs4 import BeautifulSoup
+
+from .transfer_budget import default_budget
+
+logger = logging.getLogger(__name__)
+
+LINK_CACHE_NAME = ".link_cache.json"
+DEFAULT_TTL = 24 * 3600   # seconds
+
+_cache_lock = threading.Lock()
+
+
+def _link_pattern(extensions):
+    # quoted strings in the page (attributes, JS string literals) ending in one of the extensions
+    ext = "|".join(re.escape(e.lstrip(".")) for e in extensions)
+    return re.compile(r"""["']([^"'<>\s]+?\.(?:%s))["']""" % ext, re.IGNORECASE)
+
+
+def extract_links(html, base_url, extensions, scan_scripts=True):
+    """
+    This function returns the absolute links in an HTML page whose path ends in one of the
+    extensions, from <a href> tags and (if scan_scripts) from any quoted string in the page.
+    """
+    extensions = tuple(e.lower() for e in extensions)
+    soup = BeautifulSoup(html, "html.parser")
+
+    found = []
+    for link in soup.find_all("a"):
+        href = link.get("href")
+        if href and href.strip().lower().endswith(extensions):
+            found.append(href)
+    if scan_scripts:
+        found.extend(_link_pattern(extensions).findall(html))
+
+    # clean up the links list (absolute urls, no duplicates or empty spaces)
+    links = {urljoin(base_url, link.strip()).replace(" ", "%20") for link in found}
+    return sorted(links)
+
+
+def _browser_page_source(url):
+    # imported here so that nodes without Chrome/Selenium can still use the static path
+    from selenium import webdriver
+
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless=new")
+    driver = webdriver.Chrome(options=options)
+    try:
+        driver.get(url)
+        return driver.page_source
+    finally:
+        driver.quit()
+
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(cache_path, key, links, method):
+    with _cache_lock:
+        cache = _read_cache(cache_path)
+        cache[key] = {"links": links, "method": method, "fetched_at": time.time()}
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=1)
+        os.replace(tmp_path, cache_path)
+
+
+def discover_links(url, extensions, cache_path=None, ttl=DEFAULT_TTL, use_browser="auto",
+                   session=None):
+    """
+    This function returns the sorted list of file links with the given extensions on url.
+
+    use_browser is "auto" (Selenium only if the static passes find nothing), "never" or
+    "always". With a cache_path, a list discovered less than ttl seconds ago is returned
+    without touching the network.
+    """
+    key = f"{url} {','.join(sorted(extensions))}"
+    if cache_path is not None and ttl:
+        entry = _read_cache(cache_path).get(key)
+        if entry is not None and time.time() - entry["fetched_at"] < ttl:
+            logger.info(f"Using {len(entry['links'])} cached links for {url}")
+            return entry["links"]
+
+    links, method = [], None
+    if use_browser != "always":
+        with default_budget().connection(url):
+            resp = (session or requests).get(url, timeout=(10, 60))
+        resp.raise_for_status()
+        links = extract_links(resp.text, url, extensions)
+        method = "static"
+
+    if not links and use_browser != "never":
+        logger.info(f"No links found in the static HTML of {url}, rendering it with Selenium")
+        links = extract_links(_browser_page_source(url), url, extensions)
+        method = "browser"
+
+    logger.info(f"Found {len(links)} links on {url} ({method})")
+    if cache_path is not None and links:
+        _write_cache(cache_path, key, links, method)
+    return links
+
+
+__all__ = ["discover_links", "extract_links", "LINK_CACHE_NAME"]
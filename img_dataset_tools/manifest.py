@@ -0,0 +1,100 @@
+"""
+img_dataset_tools.manifest
+
+This script contains the per-dataset download manifest used by the webscrapers and the download
+engine. Each dataset folder gets a download_manifest.json that records, for every file fetched,
+the source URL, size, ETag/Last-Modified and a checksum computed while the bytes streamed to disk.
+A re-run compares that record against a HEAD request and skips files that are still current.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "download_manifest.json"
+
+
+def disk_size(path):
+    """
+    This function returns the size of path on disk: the file size, or for a directory
+    (e.g. a Zarr store written plane by plane) the total size of the files under it.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+class DownloadManifest:
+    """
+    JSON record of the files downloaded into one dataset folder, keyed by path relative to
+    the folder. Updates are thread-safe and every save is an atomic rename, so an
+    interrupted run never leaves a half-written manifest.
+    """
+
+    def __init__(self, dataset_folder):
+        self.dataset_folder = dataset_folder
+        self.path = os.path.join(dataset_folder, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f).get("files", {})
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable manifest {self.path}: {e}")
+
+    def _key(self, filepath):
+        return os.path.relpath(filepath, self.dataset_folder)
+
+    def get(self, filepath):
+        with self._lock:
+            return self.entries.get(self._key(filepath))
+
+    def record(self, filepath, **fields):
+        """
+        This function stores the entry for filepath (url, size, etag, last_modified,
+        checksum, ...) and saves the manifest.
+        """
+        entry = dict(fields, completed_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        with self._lock:
+            self.entries[self._key(filepath)] = entry
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def is_current(self, filepath, size=None, etag=None, last_modified=None, **expected):
+        """
+        This function returns True if filepath was fully downloaded before and the remote
+        copy still matches the record: same ETag when both sides have one, otherwise the
+        same size (and Last-Modified when known). Extra keyword arguments must equal the
+        recorded fields, which lets non-HTTP sources compare e.g. image shape and dtype.
+        """
+        entry = self.get(filepath)
+        if entry is None or not os.path.exists(filepath):
+            return False
+        if entry.get("file_size") is not None and disk_size(filepath) != entry["file_size"]:
+            return False
+        if any(entry.get(k) != v for k, v in expected.items()):
+            return False
+        if etag and entry.get("etag"):
+            return etag == entry["etag"]
+        if size is not None:
+            if size != entry.get("size"):
+                return False
+            if last_modified and entry.get("last_modified"):
+                return last_modified == entry["last_modified"]
+            return True
+        return bool(expected)
+
+
+__all__ = ["DownloadManifest", "MANIFEST_NAME", "disk_size"]
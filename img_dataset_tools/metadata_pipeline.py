@@ -0,0 +1,231 @@
+"""
+img_dataset_tools.metadata_pipeline
+
+This script contains the pipelined mode of multiprocessing_image_datasets.py, which builds the
+metadata table while the datasets download instead of in a separate extract_metadata.py pass.
+Every file a download task finishes is put on an in-process queue to a verification stage
+(TIFF IFDs consistent with the file, DM3 header and tags parse and match the image data), and
+the files that pass go on a second queue to the metadata extraction stage, which reads only
+the headers and adds the catalog row (with intensity_stats, also the intensity statistics of
+the file, read chunk by chunk). Both stages run on their own threads next to the
+download workers, so a row is ready moments after the last byte of its file lands and the
+run ends shortly after the last download.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+from .metadata_utils import extract_dm3_metadata, extract_tiff_metadata, extract_zarr_metadata, \
+    metadata_table, verify_dm3, verify_tiff
+from .intensity_stats import add_intensity_stats
+from .scheduler import Source
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VERIFY_WORKERS = 2
+DEFAULT_EXTRACT_WORKERS = 1
+
+
+def _verify_nothing(path):
+    return True
+
+
+def _extract_zarr(path, dataset_id=None):
+    rows = extract_zarr_metadata(path)
+    # a store that is itself one array (a crop, a stack, a transcode) is named after its
+    # dataset like a TIFF would be; arrays inside a group keep their path in the group
+    if dataset_id is not None and os.path.exists(os.path.join(path, ".zarray")):
+        for row in rows:
+            row["dataset_id"] = dataset_id
+    return rows
+
+
+# file kind: (verify, extract returning a row or a list of rows)
+STAGES = {
+    "tiff": (verify_tiff, extract_tiff_metadata),
+    "dm3": (verify_dm3, extract_dm3_metadata),
+    "zarr": (_verify_nothing, _extract_zarr),
+}
+
+
+def file_kind(path):
+    """
+    This function returns the kind of a saved file or folder as a key of STAGES
+    ("tiff", "dm3", "zarr"), or None for anything that isn't cataloged.
+    """
+    if os.path.isdir(path):
+        is_zarr = path.rstrip("/").endswith(".zarr") or any(
+            os.path.exists(os.path.join(path, name)) for name in (".zarray", ".zgroup"))
+        return "zarr" if is_zarr else None
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".tif", ".tiff"):
+        return "tiff"
+    if ext == ".dm3":
+        return "dm3"
+    return None
+
+
+class MetadataPipeline:
+    """
+    Verify and extract stages joined by queues. submit() hands a finished file to the
+    pipeline; attach() wraps Sources so their tasks submit what they saved. With
+    intensity_stats, rows also get the intensity columns of their file. close() waits
+    for the queues to drain and returns a report; the catalog rows collect in rows, and
+    the files that failed verification or extraction in failed.
+    """
+
+    def __init__(self, verify_workers=DEFAULT_VERIFY_WORKERS, extract_workers=DEFAULT_EXTRACT_WORKERS,
+                 intensity_stats=False):
+        self.intensity_stats = intensity_stats
+        self.rows = []
+        self.failed = []
+        self._lock = threading.Lock()
+        self._submitted = set()
+        self._latencies = []
+        self._last_landed = None
+        self._verify_queue = queue.Queue()
+        self._extract_queue = queue.Queue()
+        self._verifiers = [threading.Thread(target=self._verify_stage, daemon=True)
+                           for _ in range(max(1, verify_workers))]
+        self._extractors = [threading.Thread(target=self._extract_stage, daemon=True)
+                            for _ in range(max(1, extract_workers))]
+        for thread in self._verifiers + self._extractors:
+            thread.start()
+
+    def submit(self, path, dataset_id=None, landed=None):
+        """
+        This function queues path, saved at time landed (default: now), for verification
+        and extraction. Paths that aren't cataloged, or were already submitted, are ignored.
+        """
+        kind = file_kind(path)
+        if kind is None:
+            return False
+        landed = landed or time.time()
+        with self._lock:
+            if path in self._submitted:
+                return False
+            self._submitted.add(path)
+            self._last_landed = max(self._last_landed or landed, landed)
+        self._verify_queue.put((kind, path, dataset_id, landed))
+        return True
+
+    def _fail(self, path, dataset_id, stage, error):
+        logger.error(f"{stage.capitalize()} of {path} failed: {error}")
+        with self._lock:
+            self.failed.append({"dataset_id": dataset_id, "file_path": path, "stage": stage, "error": str(error)})
+
+    def _verify_stage(self):
+        while True:
+            item = self._verify_queue.get()
+            if item is None:
+                return
+            kind, path, dataset_id, landed = item
+            try:
+                STAGES[kind][0](path)
+            except Exception as e:
+                self._fail(path, dataset_id, "verification", e)
+                continue
+            self._extract_queue.put(item)
+
+    def _extract_stage(self):
+        while True:
+            item = self._extract_queue.get()
+            if item is None:
+                return
+            kind, path, dataset_id, landed = item
+            try:
+                rows = STAGES[kind][1](path, dataset_id)
+            except Exception as e:
+                self._fail(path, dataset_id, "extraction", e)
+                continue
+            rows = rows if isinstance(rows, list) else [rows]
+            if self.intensity_stats:
+                # in this thread, next to the downloads, rather than on a process pool
+                add_intensity_stats(rows, workers=1)
+            with self._lock:
+                self.rows.extend(rows)
+                self._latencies.append(time.time() - landed)
+
+    def _wrap_task(self, task):
+        run = task.run
+
+        def run_and_catalog():
+            result = run()
+            if isinstance(result, dict) and result.get("error") is None:
+                for key in ("path", "zarr_path"):
+                    if result.get(key) and os.path.exists(result[key]):
+                        self.submit(result[key], task.source)
+            return result
+
+        task.run = run_and_catalog
+        return task
+
+    def attach(self, sources):
+        """
+        This function returns Sources that run the tasks of sources and submit every file
+        a task saved (the "path" and "zarr_path" of its result) as soon as the task is done.
+        A source's outputs are submitted once all its tasks have finished.
+        """
+        def wrap(source):
+            def expand():
+                for task in source.expand():
+                    yield self._wrap_task(task)
+
+            def close():
+                try:
+                    if source.close is not None:
+                        source.close()
+                finally:
+                    for path in source.outputs:
+                        if os.path.exists(path):
+                            self.submit(path, source.name)
+
+            return Source(source.name, expand, close=close, limits=source.limits, outputs=source.outputs)
+
+        return [wrap(source) for source in sources]
+
+    def close(self):
+        """
+        This function waits until every submitted file is verified and extracted, stops
+        the stages and returns a report: the number of files, rows and failures, the mean
+        and largest time from a file landing to its row being ready, and the time the
+        pipeline ran on after the last file landed.
+        """
+        for _ in self._verifiers:
+            self._verify_queue.put(None)
+        for thread in self._verifiers:
+            thread.join()
+        for _ in self._extractors:
+            self._extract_queue.put(None)
+        for thread in self._extractors:
+            thread.join()
+        latencies = self._latencies
+        return {
+            "files": len(self._submitted),
+            "rows": len(self.rows),
+            "failed": len(self.failed),
+            "mean_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+            "max_latency": max(latencies, default=0.0),
+            "seconds_after_last_file": time.time() - self._last_landed if self._last_landed else 0.0,
+        }
+
+    def table(self):
+        return metadata_table(self.rows)
+
+
+def format_pipeline_report(report):
+    """
+    This function turns a MetadataPipeline.close() report into a log line.
+    """
+    return (f"Cataloged {report['files']} files into {report['rows']} rows, {report['failed']} failed; "
+            f"rows ready {report['mean_latency']:.2f} s (max {report['max_latency']:.2f} s) after their file "
+            f"landed, {report['seconds_after_last_file']:.2f} s after the last one")
+
+
+__all__ = ["MetadataPipeline", "format_pipeline_report", "file_kind", "STAGES",
+           "DEFAULT_VERIFY_WORKERS", "DEFAULT_EXTRACT_WORKERS"]
@@ -1,15 +1,28 @@
 """
 img_dataset_tools.metadata_utils
 
-This script contains two metadata extraction functions to be used in extract_metadata.py.
+This script contains the metadata extraction functions to be used in extract_metadata.py and
+by the download pipeline in metadata_pipeline.py. Precomputed (Neuroglancer) volumes are cataloged
+straight from their remote info file, one row per scale level, without downloading any voxels.
+TIFF and DM3 rows are built from the file headers only, and both formats can be verified
+(TIFF IFDs and DM3 tags consistent with the file on disk) before they are cataloged.
 
 The overall goal of this project is to download 3D microscopy image datasets from different
 sources accessible and create an entry table of the various image metadata. 
 """
 
+import json
 import logging
 import zarr
 import os
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import requests
+import tifffile
+
+from . import dm3_lib as dm3
 
 logger = logging.getLogger(__name__)
 
@@ -72,4 +85,272 @@ def extract_zarr_metadata(zarr_root_folder):
 
     return metadata
 
-__all__ = ["flatten_dm3_dict", "extract_zarr_metadata"]
+# FUNCTION 8: NEUROGLANCER PRECOMPUTED METADATA FROM THE REMOTE INFO FILE
+
+def precomputed_info_url(url):
+    """
+    This function returns the http(s) or file url of the info file of a precomputed volume
+    given as precomputed://, gs://, s3://, http(s):// or file:// url.
+    """
+    url = url.replace("precomputed://", "", 1).rstrip("/")
+    parsed = urlparse(url)
+    if parsed.scheme == "gs":
+        return f"https://storage.googleapis.com/{parsed.netloc}{parsed.path}/info"
+    if parsed.scheme == "s3":
+        return f"https://{parsed.netloc}.s3.amazonaws.com{parsed.path}/info"
+    if parsed.scheme in ("http", "https", "file"):
+        return f"{url}/info"
+    raise ValueError(f"Unsupported precomputed url: {url}")
+
+
+def read_precomputed_info(url, session=None):
+    """
+    This function fetches and parses the info JSON of the precomputed volume at url.
+    """
+    info_url = precomputed_info_url(url)
+    if info_url.startswith("file://"):
+        with open(urlparse(info_url).path) as f:
+            return json.load(f)
+    resp = (session or requests).get(info_url, timeout=(10, 60))
+    resp.raise_for_status()
+    return resp.json()
+
+
+def precomputed_metadata_rows(info, url, dataset_id=None):
+    """
+    This function turns a precomputed info dict into one catalog row per scale level.
+    Shapes, chunks, offsets and resolutions are in the volume's (x, y, z) order, with the
+    channel count appended to the shape of multi-channel volumes.
+    """
+    if dataset_id is None:
+        parsed = urlparse(url.replace("precomputed://", "", 1))
+        dataset_id = parsed.netloc if parsed.scheme in ("gs", "s3") else parsed.path.rstrip("/").split("/")[-1]
+
+    num_channels = info.get("num_channels", 1)
+    rows = []
+    for mip, scale in enumerate(info["scales"]):
+        size = tuple(scale["size"])
+        shape = size if num_channels == 1 else size + (num_channels,)
+        precomputed_rows_dict = {
+            "dataset_id": dataset_id,
+            "format": "PRECOMPUTED",
+            "mip": mip,
+            "scale_key": scale["key"],
+            "shape": shape,
+            "ndims": len(shape),
+            "dtype": info["data_type"],
+            "layer_type": info.get("type"),
+            "num_channels": num_channels,
+            "resolution_nm": tuple(scale["resolution"]),
+            "voxel_offset": tuple(scale.get("voxel_offset", (0, 0, 0))),
+            "chunks": tuple(scale["chunk_sizes"][0]),
+            "encoding": scale["encoding"],
+            "size": size[0] * size[1] * size[2] * num_channels,
+            "sharded": "sharding" in scale,
+            "file_path": url,
+        }
+        if "compressed_segmentation_block_size" in scale:
+            precomputed_rows_dict["compressed_segmentation_block_size"] = tuple(scale["compressed_segmentation_block_size"])
+        if "jpeg_quality" in scale:
+            precomputed_rows_dict["jpeg_quality"] = scale["jpeg_quality"]
+        rows.append(precomputed_rows_dict)
+    return rows
+
+
+def extract_precomputed_metadata(url, dataset_id=None, session=None):
+    """
+    This function reads the remote info file of the precomputed volume at url and returns
+    its catalog rows, one per scale level. No voxel data is downloaded.
+    """
+    try:
+        return precomputed_metadata_rows(read_precomputed_info(url, session), url, dataset_id)
+    except Exception as e:
+        logger.error(f"Failed to read precomputed info of {url}: {e}", exc_info=True)
+        return []
+
+
+
+# FUNCTION 9: KNOWN RESOLUTIONS, TIFF AND DM3 ROWS FROM THE FILE HEADERS
+
+# resolutions (nm) known from outside sources, matched against the file path
+KNOWN_TIFF_RESOLUTIONS_NM = {
+    "neuroglancer-janelia-flyem-hemibrain/neuroglancer-janelia-flyem-hemibrain_crop.tif": (8, 8, 8),
+    "omero_10740": (20, 20, 20),
+    "mitochondria-data-em": (5, 5, 5),
+}
+KNOWN_DM3_RESOLUTIONS_NM = {
+    "empiar_11759": (8, 8),
+}
+
+# numpy dtypes of the DM3 image data types dm3_lib can read
+DM3_DTYPES = {1: "<i2", 2: "<f4", 6: "u1", 7: "<i4", 9: "i1", 10: "<u2", 11: "<u4", 14: "u1"}
+
+
+def _known_resolution(path, known):
+    for pattern, resolution in known.items():
+        if pattern in path:
+            return resolution
+    return None
+
+
+def _tag_resolution(tag):
+    if not tag:
+        return None
+    return tag.value[0] / tag.value[1] if isinstance(tag.value, tuple) else tag.value
+
+
+def tiff_resolution_nm(path, page):
+    """
+    This function returns the (x, y, z) resolution of a TIFF file as cataloged: x and y
+    from the tags of page, unless the resolution is known from an outside source.
+    """
+    known = _known_resolution(path, KNOWN_TIFF_RESOLUTIONS_NM)
+    if known is not None:
+        return known
+    return (_tag_resolution(page.tags.get("XResolution")), _tag_resolution(page.tags.get("YResolution")), None)
+
+
+def dm3_resolution_nm(path, dm3_flattened):
+    """
+    This function returns the (x, y) resolution of a DM3 image as cataloged, from its
+    flattened tags unless it is known from an outside source.
+    """
+    known = _known_resolution(path, KNOWN_DM3_RESOLUTIONS_NM)
+    if known is not None:
+        return known
+    pixel_size = dm3_flattened.get("Pixel size")
+    try:
+        return (int(float(pixel_size)), int(float(pixel_size)))
+    except (TypeError, ValueError):
+        return (None, None)
+
+
+def verify_tiff(path):
+    """
+    This function checks that a TIFF file is complete: the first series has IFDs (or
+    contiguous data) for its whole shape, every IFD has the same shape and dtype as the
+    first one, and all strips and tiles lie inside the file. Raises ValueError otherwise.
+    """
+    with tifffile.TiffFile(path) as tif:
+        file_size = tif.filehandle.size
+        if not tif.series:
+            raise ValueError("no image series")
+        series = tif.series[0]
+        pages = [page for page in series.pages if page is not None]
+        if not pages:
+            raise ValueError("no image pages")
+        first = pages[0]
+        if series.dataoffset is not None:
+            # contiguous image data, possibly described by the first IFD alone
+            if series.dataoffset + series.nbytes > file_size:
+                raise ValueError(f"image data ends at byte {series.dataoffset + series.nbytes}, "
+                                 f"the file has {file_size}")
+        elif len(pages) * int(np.prod(first.shape)) != int(np.prod(series.shape)):
+            raise ValueError(f"{len(pages)} IFDs of shape {first.shape} for a {series.shape} image")
+        for index, page in enumerate(pages):
+            if page.shape != first.shape or page.dtype != first.dtype:
+                raise ValueError(f"page {index} is {page.shape} {page.dtype}, "
+                                 f"page 0 is {first.shape} {first.dtype}")
+            for offset, count in zip(page.dataoffsets, page.databytecounts):
+                if count and offset + count > file_size:
+                    raise ValueError(f"page {index} has data up to byte {offset + count}, "
+                                     f"the file has {file_size}")
+    return True
+
+
+def extract_tiff_metadata(path, dataset_id=None):
+    """
+    This function returns the catalog row of a TIFF file, read from its tags. dataset_id
+    defaults to the name of the folder the file is in.
+    """
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        series = tif.series[0]
+        return {
+            "dataset_id": dataset_id or os.path.basename(os.path.dirname(path)),
+            "format": "TIFF",
+            "shape": series.shape,
+            "dtype": series.dtype,
+            "ndims": series.ndim,
+            "resolution_nm": tiff_resolution_nm(path, page),
+            "file_size_MB": f"{os.path.getsize(path)/(1e6):.2f}",
+            "samples_per_pixel": page.samplesperpixel,
+            "file_path": path
+        }
+
+
+def dm3_image_layout(dm3_data):
+    """
+    This function returns the shape, numpy dtype, byte offset and byte size of the image
+    data of a parsed DM3 file, from its tags and without reading the pixels.
+    """
+    if dm3_data.data_type not in DM3_DTYPES:
+        raise ValueError(f"unsupported DM3 data type {dm3_data.data_type}")
+    shape = (dm3_data.height, dm3_data.width) if dm3_data.depth == 1 else \
+        (dm3_data.depth, dm3_data.height, dm3_data.width)
+    tag_root = "root.ImageList.1.ImageData.Data"
+    offset, size = int(dm3_data.tags[tag_root + ".Offset"]), int(dm3_data.tags[tag_root + ".Size"])
+    return shape, np.dtype(DM3_DTYPES[dm3_data.data_type]), offset, size
+
+
+def verify_dm3(path):
+    """
+    This function checks that a DM3 file is complete: the header and tag tree parse, the
+    image data type is supported, and the image data has the size its dimensions call for
+    and lies inside the file. Raises ValueError otherwise.
+    """
+    try:
+        dm3_data = dm3.DM3(path)
+    except Exception as e:
+        raise ValueError(f"DM3 header does not parse ({e})") from e
+    shape, dtype, offset, size = dm3_image_layout(dm3_data)
+    if size != int(np.prod(shape)) * dtype.itemsize:
+        raise ValueError(f"{size} bytes of image data for a {shape} {dtype} image")
+    if offset + size > os.path.getsize(path):
+        raise ValueError(f"image data ends at byte {offset + size}, "
+                         f"the file has {os.path.getsize(path)}")
+    return True
+
+
+def extract_dm3_metadata(path, dataset_id=None):
+    """
+    This function returns the catalog row of a DM3 file from its tags; the image itself
+    is not read. dataset_id defaults to the name of the folder the file is in.
+    """
+    dm3_data = dm3.DM3(path)
+    dm3_flattened = flatten_dm3_dict(dm3_data.tags)
+    shape, dtype = dm3_image_layout(dm3_data)[:2]
+
+    return {
+        "dataset_id": dataset_id or os.path.basename(os.path.dirname(path)),
+        "format": "DM3",
+        "shape": shape,
+        "dtype": str(dtype),
+        "resolution_nm": dm3_resolution_nm(path, dm3_flattened),
+        "file_size_MB": f"{os.path.getsize(path)/(1e6)}",
+        "size": dm3_flattened.get("Size"),
+        "channel": shape[-1] if len(shape) >= 3 else 1,
+        "zoom_ratio": dm3_flattened.get("Zoom ratio"),
+        "ndims": len(shape),
+        "chunks": dm3_flattened.get("chunking"),
+        "file_path": path
+    }
+
+# FUNCTION 10: METADATA TABLE
+
+def metadata_table(rows):
+    """
+    This function turns catalog rows into the metadata DataFrame, with file_path as the
+    last column.
+    """
+    table = pd.DataFrame(rows)
+    if "file_path" in table.columns:
+        cols = [col for col in table.columns if col != "file_path"] + ["file_path"]
+        table = table[cols]
+    return table
+
+
+__all__ = ["flatten_dm3_dict", "extract_zarr_metadata", "extract_precomputed_metadata",
+           "precomputed_metadata_rows", "read_precomputed_info", "precomputed_info_url",
+           "verify_tiff", "verify_dm3", "extract_tiff_metadata", "extract_dm3_metadata", "metadata_table",
+           "tiff_resolution_nm", "dm3_resolution_nm", "dm3_image_layout"]
@@ -0,0 +1,338 @@
+"""
+img_dataset_tools.neuroglancer_utils
+
+This script contains helpers used by url_image_scrape_neuroglancer to crop Neuroglancer
+precomputed volumes without holding the whole crop in memory. The crop is cut along the volume's
+native chunk grid into sub-blocks sized to a memory budget; blocks are fetched a few at a time
+with CloudVolume and written straight into a chunked Zarr array or a tiled BigTIFF. For training
+sets, sample_crops cuts many crops at once from the union of the chunks they touch, fetching each
+chunk only once.
+
+CloudVolume indexes volumes as (x, y, z[, channel]). Crop origins and sizes here follow that
+order; the files written are stored as (z, y, x), or (channel, z, y, x) for multi-channel data.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+import zarr
+
+from .tiff_writer import DEFAULT_TIFF_COMPRESSION, tiff_write_options
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024   # bytes for all blocks in flight
+DEFAULT_FETCH_WORKERS = 4
+
+
+def volume_grid(volume):
+    """
+    This function returns the chunk size, voxel offset and exclusive upper bound (all x, y, z)
+    of a CloudVolume at its current mip.
+    """
+    chunk_size = np.array(volume.chunk_size[:3], dtype=int)
+    voxel_offset = np.array(volume.voxel_offset[:3], dtype=int)
+    upper = voxel_offset + np.array(volume.shape[:3], dtype=int)
+    return chunk_size, voxel_offset, upper
+
+
+def snap_origin(origin, chunk_size, voxel_offset):
+    """
+    This function moves origin down onto the chunk grid, so a crop starting there does not
+    download chunks it only partly uses.
+    """
+    origin = np.asarray(origin, dtype=int)
+    return voxel_offset + (origin - voxel_offset) // chunk_size * chunk_size
+
+
+def random_crop_origin(volume, size, rng=None, snap=False):
+    """
+    This function draws a random (x, y, z) origin for a crop of the given size that lies
+    inside the volume; with snap=True the origin is drawn from chunk grid positions only.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    chunk_size, voxel_offset, upper = volume_grid(volume)
+    size = np.asarray(size, dtype=int)
+    last = upper - size
+    if np.any(last < voxel_offset):
+        raise ValueError(f"Crop {tuple(size)} does not fit in volume of shape {tuple(upper - voxel_offset)}")
+    if snap:
+        steps = (last - voxel_offset) // chunk_size
+        return voxel_offset + np.array([rng.integers(0, s + 1) for s in steps]) * chunk_size
+    return np.array([rng.integers(lo, hi + 1) for lo, hi in zip(voxel_offset, last)])
+
+
+def block_shape_for_budget(chunk_size, crop_size, itemsize, block_budget):
+    """
+    This function returns an (x, y, z) block shape made of whole chunks that fits in
+    block_budget bytes, growing along x, then y, then z (the on-disk order of chunks).
+    A single chunk is used even if it is larger than the budget.
+    """
+    block = np.array(chunk_size, dtype=int)
+    crop_size = np.asarray(crop_size, dtype=int)
+    for axis in range(3):
+        while block[axis] < crop_size[axis]:
+            grown = block.copy()
+            grown[axis] += chunk_size[axis]
+            if int(np.prod(grown)) * itemsize > block_budget:
+                break
+            block = grown
+    return block
+
+
+def iter_blocks(origin, size, block_shape, voxel_offset):
+    """
+    This function yields (start, stop) (x, y, z) boxes covering the crop [origin, origin+size),
+    with block boundaries on the volume's chunk grid so no chunk is fetched by two blocks.
+    Blocks are ordered z-slab by z-slab.
+    """
+    origin = np.asarray(origin, dtype=int)
+    end = origin + np.asarray(size, dtype=int)
+    first = snap_origin(origin, block_shape, voxel_offset)
+    for z in range(first[2], end[2], block_shape[2]):
+        for y in range(first[1], end[1], block_shape[1]):
+            for x in range(first[0], end[0], block_shape[0]):
+                start = np.maximum([x, y, z], origin)
+                stop = np.minimum(np.array([x, y, z]) + block_shape, end)
+                yield start, stop
+
+
+def cutout_to_zyx(cutout):
+    """
+    This function reorders a CloudVolume cutout from (x, y, z, c) to the (z, y, x) layout
+    files are stored in, or (c, z, y, x) for multi-channel data.
+    """
+    cutout = np.asarray(cutout)
+    if cutout.shape[3] == 1:
+        return np.ascontiguousarray(cutout[..., 0].transpose(2, 1, 0))
+    return np.ascontiguousarray(cutout.transpose(3, 2, 1, 0))
+
+
+def _fetch(volume, start, stop):
+    return cutout_to_zyx(volume[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]])
+
+
+def _fetch_in_order(volume, blocks, workers):
+    """Fetch blocks with a few threads and yield (start, stop, data) in block order."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = []
+        for start, stop in blocks:
+            in_flight.append((start, stop, executor.submit(_fetch, volume, start, stop)))
+            if len(in_flight) > workers:
+                start_, stop_, future = in_flight.pop(0)
+                yield start_, stop_, future.result()
+        for start_, stop_, future in in_flight:
+            yield start_, stop_, future.result()
+
+
+def stream_crop(volume, origin, size, output_path, output="zarr",
+                memory_budget=DEFAULT_MEMORY_BUDGET, workers=DEFAULT_FETCH_WORKERS,
+                compression=DEFAULT_TIFF_COMPRESSION):
+    """
+    This function copies the crop of size (x, y, z) at origin from a CloudVolume to
+    output_path without materialising it, and returns a dict of transfer stats.
+
+    output="zarr" writes a chunked Zarr array using the volume's chunk shape; finished blocks
+    are recorded in its attrs, so an interrupted crop of the same origin and size resumes
+    (see unfinished_crop_origin), and "complete" is set once every block is written.
+    output="bigtiff" writes a tiled BigTIFF one z-plane per page (compressed with
+    compression, see tiff_writer), fetching whole-xy z-slabs. Blocks in flight are kept
+    under memory_budget bytes (decoded data and CloudVolume's own buffers included).
+    """
+    start_time = time.time()
+    chunk_size, voxel_offset, _ = volume_grid(volume)
+    origin = np.asarray(origin, dtype=int)
+    size = np.asarray(size, dtype=int)
+    channels = volume.num_channels
+    itemsize = np.dtype(volume.dtype).itemsize * channels
+    # workers blocks being fetched plus one being written, each needing about 2x its size
+    block_budget = memory_budget // (2 * (workers + 1))
+
+    if output == "bigtiff":
+        # a TIFF page must be written whole, so blocks span the full crop in x and y
+        slab_plane = int(np.prod(size[:2])) * itemsize
+        depth = int(max(1, min(chunk_size[2], block_budget // max(slab_plane, 1))))
+        if depth < chunk_size[2]:
+            logger.warning(f"Memory budget allows {depth}-plane slabs, less than the chunk depth "
+                           f"{chunk_size[2]}; some chunks will be fetched more than once")
+        block_shape = np.array([size[0], size[1], depth])
+        first_z = voxel_offset[2] + (origin[2] - voxel_offset[2]) // depth * depth
+        end_z = origin[2] + size[2]
+        blocks = [(np.array([origin[0], origin[1], max(z, origin[2])]),
+                   np.array([origin[0] + size[0], origin[1] + size[1], min(z + depth, end_z)]))
+                  for z in range(first_z, end_z, depth)]
+    elif output == "zarr":
+        block_shape = block_shape_for_budget(chunk_size, size, itemsize, block_budget)
+        blocks = list(iter_blocks(origin, size, block_shape, voxel_offset))
+    else:
+        raise ValueError(f"Unknown streaming output {output!r}, use 'zarr' or 'bigtiff'")
+
+    zyx_shape = tuple(int(s) for s in size[::-1])
+    shape = zyx_shape if channels == 1 else (channels,) + zyx_shape
+    stats = {"blocks": len(blocks), "block_shape_xyz": tuple(int(b) for b in block_shape),
+             "bytes": int(np.prod(size)) * itemsize, "skipped_blocks": 0}
+
+    if output == "zarr":
+        chunks = tuple(int(min(c, s)) for c, s in zip(chunk_size[::-1], zyx_shape))
+        chunks = chunks if channels == 1 else (channels,) + chunks
+        array = zarr.open_array(output_path, mode="a", shape=shape, chunks=chunks,
+                                dtype=volume.dtype)
+        meta = {"origin_xyz": origin.tolist(), "size_xyz": size.tolist()}
+        if any(array.attrs.get(k) != v for k, v in meta.items()) or array.shape != shape:
+            array = zarr.open_array(output_path, mode="w", shape=shape, chunks=chunks,
+                                    dtype=volume.dtype)
+        array.attrs.update(meta, resolution_nm_xyz=list(map(float, volume.resolution)))
+        done = set(map(tuple, array.attrs.get("blocks_done", [])))
+        todo = [(a, b) for a, b in blocks if tuple(a.tolist()) not in done]
+        stats["skipped_blocks"] = len(blocks) - len(todo)
+
+        for start, stop, data in _fetch_in_order(volume, todo, workers):
+            lo, hi = (start - origin)[::-1], (stop - origin)[::-1]
+            region = tuple(slice(int(a), int(b)) for a, b in zip(lo, hi))
+            array[region if channels == 1 else (slice(None),) + region] = data
+            done.add(tuple(start.tolist()))
+            array.attrs["blocks_done"] = sorted(done)
+        array.attrs["complete"] = True
+    else:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        options = tiff_write_options((int(size[1]), int(size[0])), compression)
+        with tifffile.TiffWriter(output_path, bigtiff=True) as tif:
+            for start, stop, data in _fetch_in_order(volume, blocks, workers):
+                planes = data if channels == 1 else (p for zc in data.transpose(1, 0, 2, 3) for p in zc)
+                for plane in planes:
+                    tif.write(plane, metadata=None, **options)
+
+    stats["seconds"] = time.time() - start_time
+    return stats
+
+
+def unfinished_crop_origin(output_path, size):
+    """
+    This function returns the (x, y, z) origin of an interrupted stream_crop into the Zarr
+    array at output_path if it was of the same size, so a rerun without a seed resumes it
+    instead of drawing a new crop; otherwise None.
+    """
+    try:
+        attrs = zarr.open_array(output_path, mode="r").attrs.asdict()
+    except Exception:
+        return None
+    if attrs.get("complete") or attrs.get("size_xyz") != [int(s) for s in size] or "origin_xyz" not in attrs:
+        return None
+    return np.array(attrs["origin_xyz"], dtype=int)
+
+
+def crop_chunks(origin, size, chunk_size, voxel_offset):
+    """
+    This function returns the (i, j, k) chunk grid indices touched by the crop of size
+    (x, y, z) at origin.
+    """
+    lo = (np.asarray(origin) - voxel_offset) // chunk_size
+    hi = (np.asarray(origin) + np.asarray(size) - 1 - voxel_offset) // chunk_size
+    return [(i, j, k) for k in range(lo[2], hi[2] + 1)
+            for j in range(lo[1], hi[1] + 1) for i in range(lo[0], hi[0] + 1)]
+
+
+def random_crop_specs(volume, count, sizes, seed=None, snap=False, occupancy=None):
+    """
+    This function draws count (origin, size) crop specs inside the volume. Each crop takes
+    its (x, y, z) size from sizes in turn; seed makes the draw reproducible. With an
+    occupancy index (see img_dataset_tools.occupancy) origins are drawn in informative
+    regions only.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = [np.asarray(s, dtype=int) for s in sizes]
+    mask = occupancy.informative() if occupancy is not None else None
+    specs = []
+    for n in range(count):
+        size = sizes[n % len(sizes)]
+        if occupancy is not None:
+            origin = occupancy.sample_origin(volume, size, rng, snap, mask=mask)
+        else:
+            origin = random_crop_origin(volume, size, rng, snap)
+        specs.append((origin, size))
+    return specs
+
+
+def sample_crops(volume, specs, output_dir=None, workers=DEFAULT_FETCH_WORKERS):
+    """
+    This function cuts many crops from one CloudVolume while fetching every chunk at most
+    once. specs is a list of (origin, size) in (x, y, z). The union of chunks touched by all
+    crops is fetched in parallel, chunk by chunk, and each chunk is copied into every crop it
+    overlaps before it is released.
+
+    Crops are returned as (z, y, x) arrays, or with an output_dir written to
+    crop_0000.zarr, crop_0001.zarr, ... (with origin and size in the attrs) and returned as
+    Zarr arrays. The second return value holds the bytes fetched against the bytes that
+    len(specs) independent crops would have fetched.
+    """
+    start_time = time.time()
+    chunk_size, voxel_offset, upper = volume_grid(volume)
+    channels = volume.num_channels
+    itemsize = np.dtype(volume.dtype).itemsize * channels
+    specs = [(np.asarray(o, dtype=int), np.asarray(s, dtype=int)) for o, s in specs]
+
+    def chunk_box(index):
+        start = voxel_offset + np.array(index) * chunk_size
+        return start, np.minimum(start + chunk_size, upper)
+
+    users = {}
+    independent_chunks = independent_bytes = 0
+    for n, (origin, size) in enumerate(specs):
+        touched = crop_chunks(origin, size, chunk_size, voxel_offset)
+        independent_chunks += len(touched)
+        for index in touched:
+            start, stop = chunk_box(index)
+            # CloudVolume downloads whole chunks, so this is what an independent crop fetches
+            independent_bytes += int(np.prod(stop - start)) * itemsize
+            users.setdefault(index, []).append(n)
+
+    crops = []
+    for n, (origin, size) in enumerate(specs):
+        shape = tuple(int(v) for v in size[::-1])
+        shape = shape if channels == 1 else (channels,) + shape
+        if output_dir is None:
+            crops.append(np.zeros(shape, dtype=volume.dtype))
+        else:
+            chunks = tuple(int(min(c, s)) for c, s in zip(chunk_size[::-1], size[::-1]))
+            array = zarr.open_array(os.path.join(output_dir, f"crop_{n:04}.zarr"), mode="w",
+                                    shape=shape, dtype=volume.dtype,
+                                    chunks=chunks if channels == 1 else (channels,) + chunks)
+            array.attrs.update(origin_xyz=origin.tolist(), size_xyz=size.tolist())
+            crops.append(array)
+
+    # z-slab order matches the storage layout of the chunks
+    order = sorted(users, key=lambda i: (i[2], i[1], i[0]))
+    boxes = [chunk_box(index) for index in order]
+    bytes_fetched = 0
+    for index, (start, stop, data) in zip(order, _fetch_in_order(volume, boxes, workers)):
+        bytes_fetched += data.nbytes
+        for n in users[index]:
+            origin, size = specs[n]
+            lo = np.maximum(start, origin)
+            hi = np.minimum(stop, origin + size)
+            src = tuple(slice(int(a), int(b)) for a, b in zip((lo - start)[::-1], (hi - start)[::-1]))
+            dst = tuple(slice(int(a), int(b)) for a, b in zip((lo - origin)[::-1], (hi - origin)[::-1]))
+            if channels != 1:
+                src, dst = (slice(None),) + src, (slice(None),) + dst
+            crops[n][dst] = data[src]
+
+    stats = {
+        "crops": len(specs),
+        "chunks_fetched": len(users),
+        "bytes_fetched": bytes_fetched,
+        "independent_chunks": independent_chunks,
+        "independent_bytes": independent_bytes,
+        "seconds": time.time() - start_time,
+    }
+    return crops, stats
+
+
+__all__ = ["stream_crop", "sample_crops", "random_crop_specs", "random_crop_origin",
+           "crop_chunks", "cutout_to_zyx", "snap_origin", "volume_grid", "block_shape_for_budget",
+           "iter_blocks", "unfinished_crop_origin", "DEFAULT_MEMORY_BUDGET"]
@@ -0,0 +1,205 @@
+"""
+img_dataset_tools.occupancy
+
+This script contains the occupancy index used to place Neuroglancer crops where there is
+something to see. A coarse mip level of the volume is fetched once, in z-slabs, and reduced to a
+grid of cells holding the fraction of voxels with data and the intensity spread of each cell.
+The index is cached next to the dataset, so later runs sample crops without touching the coarse
+mip again, and crop origins are only drawn where most of the crop falls in informative cells.
+
+Coordinates follow CloudVolume's (x, y, z) order and are given at full resolution (mip 0).
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from cloudvolume import Bbox
+
+from .neuroglancer_utils import random_crop_origin, snap_origin, volume_grid
+
+logger = logging.getLogger(__name__)
+
+OCCUPANCY_CACHE_NAME = ".occupancy.npz"
+DEFAULT_MAX_COARSE_VOXELS = 32 * 1024 ** 2   # voxels of the coarse mip read to build the index
+DEFAULT_CELL = 8                             # coarse voxels per cell along each axis
+DEFAULT_MIN_FRACTION = 0.5                   # share of non-zero voxels for a cell to have data
+DEFAULT_MIN_SCORE = 0.5                      # share of a crop's cells that must be informative
+AUTO_STD_FACTOR = 0.25                       # min_std=None: this times the median std of cells with data
+
+
+def choose_coarse_mip(volume, max_voxels=DEFAULT_MAX_COARSE_VOXELS):
+    """
+    This function returns the finest mip level of volume with at most max_voxels voxels,
+    or the coarsest one available if every level is larger.
+    """
+    mips = sorted(volume.available_mips)
+    for mip in mips:
+        if int(np.prod(volume.meta.volume_size(mip))) <= max_voxels:
+            return mip
+    return mips[-1]
+
+
+class OccupancyIndex:
+    """
+    Per-cell statistics of a coarse mip level. fraction is the share of non-zero voxels
+    (fill_missing turns absent chunks into zeros) and std the intensity standard deviation
+    of each cell; both arrays are indexed (x, y, z). origin and extent give the full
+    resolution position of cell (0, 0, 0) and the size of one cell.
+    """
+
+    def __init__(self, fraction, std, origin, extent, meta=None):
+        self.fraction = np.asarray(fraction, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.origin = np.asarray(origin, dtype=int)
+        self.extent = np.asarray(extent, dtype=int)
+        self.meta = dict(meta or {})
+
+    @classmethod
+    def build(cls, volume, mip=None, cell=DEFAULT_CELL, max_voxels=DEFAULT_MAX_COARSE_VOXELS):
+        """
+        This function reads the coarse mip of volume one slab of cells at a time and returns
+        its OccupancyIndex. With mip=None the finest level under max_voxels is used.
+        """
+        start_time = time.time()
+        mip = choose_coarse_mip(volume, max_voxels) if mip is None else mip
+        bounds = volume.meta.bounds(mip)
+        lo, hi = np.array(bounds.minpt, dtype=int), np.array(bounds.maxpt, dtype=int)
+        grid = -(-(hi - lo) // cell)
+        count = np.zeros(grid, dtype=np.int64)
+        nonzero = np.zeros(grid, dtype=np.int64)
+        total = np.zeros(grid)
+        total_sq = np.zeros(grid)
+
+        # bboxes are given in coarse mip voxels rather than the volume's own mip
+        resolution = volume.meta.resolution(mip)
+        starts = [np.arange(0, n, cell) for n in hi[:2] - lo[:2]]
+        for k, z in enumerate(range(lo[2], hi[2], cell)):
+            z_stop = min(z + cell, hi[2])
+            slab = np.asarray(volume.download(Bbox((lo[0], lo[1], z), (hi[0], hi[1], z_stop)), mip=mip,
+                                              coord_resolution=resolution))
+            # channels are folded into the cell like extra voxels
+            values = slab.astype(np.float64).transpose(0, 1, 3, 2).reshape(slab.shape[0], slab.shape[1], -1)
+
+            def reduce(a):
+                a = np.add.reduceat(np.add.reduceat(a, starts[0], axis=0), starts[1], axis=1)
+                return a.sum(axis=2)
+
+            count[:, :, k] = reduce(np.full(values.shape[:2] + (1,), values.shape[2]))
+            nonzero[:, :, k] = reduce((values != 0).sum(axis=2, keepdims=True))
+            total[:, :, k] = reduce(values)
+            total_sq[:, :, k] = reduce(values * values)
+
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean * mean, 0))
+        factor = np.array(volume.meta.downsample_ratio(mip), dtype=int)
+        meta = {"cloudpath": volume.cloudpath, "mip": int(mip), "cell": int(cell),
+                "seconds": time.time() - start_time}
+        logger.info(f"Built occupancy index of {volume.cloudpath} from mip {mip}: "
+                    f"{int(np.prod(grid))} cells in {meta['seconds']:.1f} s")
+        return cls(nonzero / count, std, lo * factor, cell * factor, meta)
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, fraction=self.fraction, std=self.std, origin=self.origin,
+                            extent=self.extent, meta=json.dumps(self.meta))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["fraction"], f["std"], f["origin"], f["extent"], json.loads(str(f["meta"])))
+
+    def informative(self, min_fraction=DEFAULT_MIN_FRACTION, min_std=None):
+        """
+        This function returns the boolean (x, y, z) cell mask of cells with data and enough
+        intensity spread. min_std=None sets the threshold to AUTO_STD_FACTOR times the median
+        std of the cells with data, which leaves out flat resin or padding.
+        """
+        has_data = self.fraction >= min_fraction
+        if min_std is None:
+            min_std = AUTO_STD_FACTOR * float(np.median(self.std[has_data])) if has_data.any() else 0.0
+        return has_data & (self.std >= min_std) & (self.std > 0)
+
+    def _cell_range(self, origin, size):
+        lo = (np.asarray(origin) - self.origin) // self.extent
+        hi = -(-(np.asarray(origin) + np.asarray(size) - self.origin) // self.extent)
+        grid = np.array(self.fraction.shape)
+        return np.clip(lo, 0, grid), np.clip(hi, 0, grid)
+
+    def crop_score(self, origin, size, mask=None):
+        """
+        This function returns the share of cells under the crop of size (x, y, z) at origin
+        that are informative.
+        """
+        mask = self.informative() if mask is None else mask
+        lo, hi = self._cell_range(origin, size)
+        cells = mask[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        return float(cells.mean()) if cells.size else 0.0
+
+    def sample_origin(self, volume, size, rng=None, snap=False, min_score=DEFAULT_MIN_SCORE,
+                      max_tries=50, mask=None):
+        """
+        This function draws a crop origin for a crop of size (x, y, z) centred on a random
+        informative cell, keeping the first draw whose crop_score reaches min_score (or the
+        best of max_tries). Without any informative cell it falls back to a uniform draw.
+        """
+        rng = rng if rng is not None else np.random.default_rng()
+        mask = self.informative() if mask is None else mask
+        cells = np.argwhere(mask)
+        if not len(cells):
+            logger.warning("No informative cells in the occupancy index, drawing the crop uniformly")
+            return random_crop_origin(volume, size, rng, snap)
+
+        chunk_size, voxel_offset, upper = volume_grid(volume)
+        size = np.asarray(size, dtype=int)
+        last = upper - size
+        if np.any(last < voxel_offset):
+            raise ValueError(f"Crop {tuple(size)} does not fit in volume of shape {tuple(upper - voxel_offset)}")
+
+        best, best_score = None, -1.0
+        for _ in range(max_tries):
+            cell = cells[rng.integers(len(cells))]
+            centre = self.origin + (cell + rng.random(3)) * self.extent
+            origin = np.clip(np.floor(centre - size / 2).astype(int), voxel_offset, last)
+            if snap:
+                origin = snap_origin(origin, chunk_size, voxel_offset)
+            score = self.crop_score(origin, size, mask)
+            if score > best_score:
+                best, best_score = origin, score
+            if score >= min_score:
+                break
+        if best_score < min_score:
+            logger.warning(f"Best crop after {max_tries} draws is {best_score:.0%} informative")
+        return best
+
+
+def load_or_build_occupancy(volume, cache_path=None, mip=None, cell=DEFAULT_CELL,
+                            max_voxels=DEFAULT_MAX_COARSE_VOXELS):
+    """
+    This function returns the OccupancyIndex of volume, read from cache_path if it was built
+    for the same volume, mip and cell size, and otherwise built and written there.
+    """
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            index = OccupancyIndex.load(cache_path)
+            wanted = {"cloudpath": volume.cloudpath, "cell": cell}
+            if mip is not None:
+                wanted["mip"] = mip
+            if all(index.meta.get(k) == v for k, v in wanted.items()):
+                logger.info(f"Using cached occupancy index {cache_path}")
+                return index
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable occupancy cache {cache_path}: {e}")
+
+    index = OccupancyIndex.build(volume, mip, cell, max_voxels)
+    if cache_path is not None:
+        index.save(cache_path)
+    return index
+
+
+__all__ = ["OccupancyIndex", "load_or_build_occupancy", "choose_coarse_mip", "OCCUPANCY_CACHE_NAME"]
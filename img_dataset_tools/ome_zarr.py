@@ -0,0 +1,173 @@
+"""
+img_dataset_tools.ome_zarr
+
+This script contains the TIFF to OME-Zarr converter. A TIFF volume is streamed through
+open_volume() into the full-resolution level s0 of an OME-Zarr group, with configurable chunks
+and codec, and the coarser levels s1..sN are then added by the pyramid engine (pyramid.py) by
+2x downsampling: the mean for images and the most frequent value for label volumes such as
+testing_groundtruth.tif. s0 is split into blocks of whole chunk rows that the same process
+pool works through, so memory stays at a few blocks per worker whatever the size of the volume.
+The physical resolution of every level is recorded in the OME-Zarr multiscales metadata.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import zarr
+from numcodecs import Blosc, GZip
+
+from .pyramid import DEFAULT_BLOCK_BYTES, OME_ZARR_VERSION, build_pyramid, downsample_mean, downsample_mode, \
+    is_label_volume, level_blocks, multiscales_metadata, pyramid_shapes
+from .tiff_transcode import DEFAULT_TRANSCODE_CHUNKS, TIFF_EXTENSIONS
+from .volumes import open_volume, worker_volume
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OME_ZARR_CHUNKS = DEFAULT_TRANSCODE_CHUNKS   # (z, y, x)
+DEFAULT_CODEC = "zstd"
+DEFAULT_CODEC_LEVEL = 5
+OME_ZARR_SUFFIX = ".ome.zarr"
+BLOSC_CODECS = ("zstd", "lz4", "lz4hc", "zlib", "blosclz")
+
+
+def zarr_compressor(codec=DEFAULT_CODEC, level=DEFAULT_CODEC_LEVEL):
+    """
+    This function returns the numcodecs compressor for codec: a Blosc codec (zstd, lz4,
+    lz4hc, zlib, blosclz) with byte shuffling, gzip, or None for "none".
+    """
+    if codec in (None, "none"):
+        return None
+    if codec in BLOSC_CODECS:
+        return Blosc(cname=codec, clevel=level, shuffle=Blosc.SHUFFLE)
+    if codec == "gzip":
+        return GZip(level=level)
+    raise ValueError(f"Unknown codec {codec!r}, choose from {BLOSC_CODECS + ('gzip', 'none')}")
+
+
+def _copy_block(source_path, target_path, slices):
+    # runs in a pool process; the volume stays open between blocks of the same file
+    data = worker_volume(source_path)[slices]
+    zarr.open_array(target_path, mode="r+")[slices] = data
+    return data.size
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def is_converted(tiff_path, output_path):
+    """
+    This function tells whether output_path holds a complete conversion of the current
+    version of tiff_path.
+    """
+    try:
+        attrs = zarr.open_group(output_path, mode="r").attrs
+    except Exception:
+        return False
+    return bool(attrs.get("complete")) and attrs.get("source") == _source_stamp(tiff_path)
+
+
+def convert_tiff_to_ome_zarr(tiff_path, output_path=None, chunks=DEFAULT_OME_ZARR_CHUNKS, codec=DEFAULT_CODEC,
+                             level=DEFAULT_CODEC_LEVEL, levels=None, factors=None, labels=None,
+                             workers=None, block_bytes=DEFAULT_BLOCK_BYTES, overwrite=False):
+    """
+    This function converts a 2D or 3D grayscale TIFF volume into an OME-Zarr group at
+    output_path (default: next to it, with the .ome.zarr suffix) holding s0 and its
+    downsampled levels, and returns a report dict. chunks is given per (z, y, x) axis,
+    codec and level pick the compressor, levels the number of levels (default: down to
+    one chunk), factors the downsampling per axis (default 2), labels forces the mode
+    (True) or mean (False) reduction instead of guessing from the file name. Blocks are
+    processed by workers processes (default: every core). A conversion that is complete
+    for the current file is skipped unless overwrite is set.
+    """
+    start_time = time.time()
+    output_path = output_path or os.path.splitext(tiff_path)[0] + OME_ZARR_SUFFIX
+    report = {"source": tiff_path, "output": output_path, "skipped": False, "levels": 0, "bytes": 0,
+              "seconds": 0.0, "method": None, "error": None}
+    if not overwrite and is_converted(tiff_path, output_path):
+        report["skipped"] = True
+        return report
+
+    with open_volume(tiff_path) as volume:
+        shape, dtype, resolution = volume.shape, volume.dtype, volume.resolution_nm
+    if len(shape) not in (2, 3):
+        raise ValueError(f"{tiff_path}: only 2D and 3D grayscale volumes are converted, not {shape}")
+    ndim = len(shape)
+    chunks = tuple(min(c, n) for c, n in zip(tuple(chunks)[-ndim:], shape))
+    factors = tuple(factors or (2,) * ndim)
+    factors = tuple(f if n > 1 else 1 for f, n in zip(factors, shape))
+    labels = is_label_volume(tiff_path, dtype) if labels is None else labels
+    method = "mode" if labels else "mean"
+    shapes = pyramid_shapes(shape, chunks, factors, levels)
+    report["method"] = method
+
+    compressor = zarr_compressor(codec, level)
+    group = zarr.open_group(output_path, mode="w")
+    group.create_dataset("s0", shape=shape, chunks=chunks, dtype=dtype, compressor=compressor, fill_value=0,
+                         dimension_separator="/")
+    name = os.path.splitext(os.path.basename(tiff_path))[0]
+    axes = [{"name": axis, "type": "space", "unit": "nanometer"} for axis in "zyx"[3 - ndim:]]
+    scale = [r if r is not None else 1.0 for r in resolution]
+    group.attrs.update(multiscales=multiscales_metadata(name, axes, scale, shapes[:1], factors, method),
+                       resolution_nm=[r for r in resolution], source=_source_stamp(tiff_path), complete=False)
+    if labels:
+        group.attrs["image-label"] = {"version": OME_ZARR_VERSION}
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        target = os.path.join(output_path, "s0")
+        blocks = list(level_blocks(shape, chunks, dtype.itemsize, block_bytes))
+        report["bytes"] += dtype.itemsize * sum(executor.map(_copy_block, [tiff_path] * len(blocks),
+                                                             [target] * len(blocks), blocks))
+        logger.info(f"{name}: s0 {shape} written in {len(blocks)} blocks")
+        pyramid = build_pyramid(output_path, method=method, levels=len(shapes), factors=factors,
+                                block_bytes=block_bytes, overwrite=True, executor=executor)
+    report["bytes"] += dtype.itemsize * sum(int(np.prod(entry["shape"])) for entry in pyramid["levels"])
+
+    # reopened: build_pyramid rewrote the multiscales since this group cached its attrs
+    zarr.open_group(output_path, mode="r+").attrs["complete"] = True
+    report["levels"] = len(shapes)
+    report["seconds"] = time.time() - start_time
+    return report
+
+
+def convert_dataset(directory, output_directory=None, **kwargs):
+    """
+    This function converts every TIFF under directory with convert_tiff_to_ome_zarr (kwargs
+    are passed on), writing each next to its TIFF or, with output_directory, into the same
+    relative folder there. Returns one report per file; failures are logged and reported.
+    """
+    reports = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.endswith(".zarr") and not d.startswith("."))
+        for filename in sorted(files):
+            if not filename.lower().endswith(TIFF_EXTENSIONS):
+                continue
+            tiff_path = os.path.join(root, filename)
+            out_root = root if output_directory is None else \
+                os.path.join(output_directory, os.path.relpath(root, directory))
+            os.makedirs(out_root, exist_ok=True)
+            output_path = os.path.join(out_root, os.path.splitext(filename)[0] + OME_ZARR_SUFFIX)
+            try:
+                report = convert_tiff_to_ome_zarr(tiff_path, output_path, **kwargs)
+            except Exception as e:
+                logger.error(f"Failed to convert {tiff_path}: {e}", exc_info=True)
+                report = {"source": tiff_path, "output": output_path, "skipped": False, "levels": 0,
+                          "bytes": 0, "seconds": 0.0, "method": None, "error": e}
+            if report["skipped"]:
+                logger.info(f"Up to date, skipped: {output_path}")
+            elif report["error"] is None:
+                logger.info(f"Converted {tiff_path} into {report['levels']} levels in {report['seconds']:.1f} s "
+                            f"({report['bytes'] / 1e6 / max(report['seconds'], 1e-9):.1f} MB/s)")
+            reports.append(report)
+    return reports
+
+
+__all__ = ["convert_tiff_to_ome_zarr", "convert_dataset", "is_converted", "zarr_compressor", "is_label_volume",
+           "pyramid_shapes", "downsample_mean", "downsample_mode", "DEFAULT_OME_ZARR_CHUNKS", "DEFAULT_CODEC",
+           "OME_ZARR_SUFFIX"]
@@ -0,0 +1,263 @@
+"""
+img_dataset_tools.omero_fetch
+
+This script contains the plane fetch engine used by url_image_scrape_dynamic to pull z-stacks
+out of OMERO/IDR. Each connection keeps one pixels object per image, planes are requested in
+batches with getPlanes (or getTiles for very large planes), several (t, c) stacks are fetched at
+once over a small pool of connections, and stacks keep the image's native pixel type.
+In streaming mode each plane goes straight to a chunked Zarr array or BigTIFF page as it arrives.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import hashlib
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+import numpy as np
+
+from .transfer_budget import default_budget
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 16                  # planes per getPlanes call
+DEFAULT_POOL_SIZE = 3                    # concurrent (t, c) stacks / OMERO connections
+MAX_PLANE_PIXELS = 4096 * 4096           # larger planes are fetched as tiles
+DEFAULT_TILE_SIZE = 1024
+
+# OMERO pixel type names -> numpy dtypes
+PIXEL_TYPES = {
+    "bit": np.bool_,
+    "int8": np.int8,
+    "uint8": np.uint8,
+    "int16": np.int16,
+    "uint16": np.uint16,
+    "int32": np.int32,
+    "uint32": np.uint32,
+    "float": np.float32,
+    "double": np.float64,
+}
+
+
+def pixels_dtype(img):
+    """
+    This function returns the numpy dtype matching the pixel type stored in OMERO for img.
+    """
+    pixel_type = img.getPixelsType()
+    try:
+        return np.dtype(PIXEL_TYPES[pixel_type])
+    except KeyError:
+        raise ValueError(f"Unsupported OMERO pixel type: {pixel_type}")
+
+
+class _BudgetedPixels:
+    """Pixels object whose planes and tiles are charged against the bytes/sec limit."""
+
+    def __init__(self, pixels, budget):
+        self._pixels = pixels
+        self._budget = budget
+
+    def __getattr__(self, name):
+        return getattr(self._pixels, name)
+
+    def getPlanes(self, zct_list):
+        for plane in self._pixels.getPlanes(zct_list):
+            self._budget.throttle(plane.nbytes)
+            yield plane
+
+    def getTiles(self, zct_tile_list):
+        for tile in self._pixels.getTiles(zct_tile_list):
+            self._budget.throttle(tile.nbytes)
+            yield tile
+
+
+class OmeroConnectionPool:
+    """
+    Small pool of OMERO connections created on demand by connect(). A connection and the
+    pixels objects fetched through it are only ever used by one thread at a time.
+
+    A connection in use holds a slot for host in budget (default: the process-wide
+    TransferBudget) and the planes it fetches count against its bytes/sec limit.
+    """
+
+    def __init__(self, connect, size=DEFAULT_POOL_SIZE, budget=None, host="omero://idr.openmicroscopy.org"):
+        self.connect = connect
+        self.size = max(1, size)
+        self.budget = budget or default_budget()
+        self.host = host
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._all = []
+
+    @contextmanager
+    def acquire(self):
+        try:
+            slot = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                slot = {"conn": self.connect(), "pixels": {}}
+                with self._lock:
+                    self._all.append(slot)
+            else:
+                slot = self._idle.get()
+        try:
+            with self.budget.connection(self.host):
+                yield slot
+        finally:
+            self._idle.put(slot)
+
+    def pixels(self, slot, image_id):
+        """The primary pixels object of image_id on this connection, fetched once."""
+        if image_id not in slot["pixels"]:
+            img = slot["conn"].getObject("Image", image_id)
+            slot["pixels"][image_id] = _BudgetedPixels(img.getPrimaryPixels(), self.budget)
+        return slot["pixels"][image_id]
+
+    def close(self):
+        for slot in self._all:
+            try:
+                slot["conn"].close()
+            except Exception as e:
+                logger.warning(f"Failed to close OMERO connection: {e}")
+        self._all = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _tiles(y_size, x_size, tile_size):
+    for y in range(0, y_size, tile_size):
+        for x in range(0, x_size, tile_size):
+            yield x, y, min(tile_size, x_size - x), min(tile_size, y_size - y)
+
+
+def iter_planes(pixels, c, t, z_size, y_size, x_size, batch_size=DEFAULT_BATCH_SIZE,
+                tile_size=DEFAULT_TILE_SIZE, z_indices=None):
+    """
+    This function yields (z, plane) for every z of channel c at time t (or only the
+    z_indices given, in ascending order), requesting batch_size planes per getPlanes round
+    trip. Planes larger than MAX_PLANE_PIXELS are assembled from getTiles requests instead.
+    """
+    z_indices = sorted(z_indices) if z_indices is not None else list(range(z_size))
+    for i in range(0, len(z_indices), batch_size):
+        zs = z_indices[i:i + batch_size]
+        if y_size * x_size <= MAX_PLANE_PIXELS:
+            for z, plane in zip(zs, pixels.getPlanes([(z, c, t) for z in zs])):
+                yield z, plane
+        else:
+            for z in zs:
+                tiles = list(_tiles(y_size, x_size, tile_size))
+                plane = None
+                for (x, y, w, h), tile in zip(tiles, pixels.getTiles([(z, c, t, tl) for tl in tiles])):
+                    if plane is None:
+                        plane = np.empty((y_size, x_size), dtype=tile.dtype)
+                    plane[y:y + h, x:x + w] = tile
+                yield z, plane
+
+
+def fetch_stack(pixels, c, t, shape, dtype, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    This function returns the full (z, y, x) stack of channel c at time t in dtype.
+    """
+    z_size, y_size, x_size = shape
+    stack = np.empty(shape, dtype=dtype)
+    for z, plane in iter_planes(pixels, c, t, z_size, y_size, x_size, batch_size):
+        stack[z] = plane
+    return stack
+
+
+def fetch_image_stacks(pool, img, tcs=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    This function fetches the (t, c) z-stacks of img concurrently over the connection pool
+    and yields (t, c, stack) as each one completes. tcs restricts which stacks are fetched
+    (default: every t and c). pool.size stacks are in flight while the caller handles the
+    one just yielded, so memory stays at about pool.size + 1 stacks.
+    """
+    image_id = img.getId()
+    shape = (img.getSizeZ(), img.getSizeY(), img.getSizeX())
+    dtype = pixels_dtype(img)
+    if tcs is None:
+        tcs = [(t, c) for t in range(img.getSizeT()) for c in range(img.getSizeC())]
+
+    def _fetch(tc):
+        t, c = tc
+        with pool.acquire() as slot:
+            pixels = pool.pixels(slot, image_id)
+            return t, c, fetch_stack(pixels, c, t, shape, dtype, batch_size)
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        pending = iter(tcs)
+        futures = {executor.submit(_fetch, tc) for _, tc in zip(range(pool.size), pending)}
+        while futures:
+            future = next(as_completed(futures))
+            futures.remove(future)
+            # keep pool.size stacks in flight; the caller writes this one meanwhile
+            for tc in pending:
+                futures.add(executor.submit(_fetch, tc))
+                break
+            yield future.result()
+
+
+def stream_stack(pixels, c, t, shape, writer, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    This function fetches the planes of channel c at time t that writer doesn't hold yet
+    and hands each one to writer.write(z, plane) as it arrives, so only about batch_size
+    planes are in memory. Returns the sha256 of the whole stack in z order (planes that
+    were already on disk are read back locally for it), matching hashlib.sha256(stack).
+    """
+    z_size, y_size, x_size = shape
+    done = writer.done_planes()
+    missing = [z for z in range(z_size) if z not in done]
+    fetched = iter_planes(pixels, c, t, z_size, y_size, x_size, batch_size, z_indices=missing)
+    hasher = hashlib.sha256()
+    try:
+        for z in range(z_size):
+            if z in done:
+                plane = writer.read_plane(z)
+            else:
+                fetched_z, plane = next(fetched)
+                writer.write(fetched_z, plane)
+            hasher.update(np.ascontiguousarray(plane, dtype=writer.dtype))
+    finally:
+        writer.close()
+    return hasher.hexdigest()
+
+
+def stream_image_stacks(pool, img, open_writer, tcs=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    This function streams the (t, c) z-stacks of img to disk concurrently over the connection
+    pool. open_writer(t, c, shape, dtype) returns a plane writer for each stack. Yields
+    (t, c, writer, checksum) as each stack completes; a failed stack raises, leaving its
+    partial output on disk for the next run to resume.
+    """
+    image_id = img.getId()
+    shape = (img.getSizeZ(), img.getSizeY(), img.getSizeX())
+    dtype = pixels_dtype(img)
+    if tcs is None:
+        tcs = [(t, c) for t in range(img.getSizeT()) for c in range(img.getSizeC())]
+
+    def _stream(tc):
+        t, c = tc
+        writer = open_writer(t, c, shape, dtype)
+        with pool.acquire() as slot:
+            pixels = pool.pixels(slot, image_id)
+            return t, c, writer, stream_stack(pixels, c, t, shape, writer, batch_size)
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        for future in as_completed([executor.submit(_stream, tc) for tc in tcs]):
+            yield future.result()
+
+
+__all__ = ["OmeroConnectionPool", "fetch_image_stacks", "fetch_stack", "iter_planes",
+           "stream_image_stacks", "stream_stack", "pixels_dtype", "PIXEL_TYPES"]
@@ -0,0 +1,136 @@
+"""
+img_dataset_tools.plane_writers
+
+This script contains plane-by-plane writers used to stream z-stacks to disk as they are fetched,
+instead of assembling the whole stack in memory first. Each writer knows which planes it already
+holds, so a stack that was interrupted part-way stays readable and the next run only fetches the
+missing planes.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import logging
+import os
+
+import numpy as np
+import tifffile
+import zarr
+
+from .manifest import disk_size
+from .tiff_writer import DEFAULT_TIFF_COMPRESSION, tiff_write_options
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TILE = 1024
+
+
+class ZarrPlaneWriter:
+    """
+    Writes (z, y, x) planes into a chunked Zarr array with one z-plane per chunk. The set of
+    finished planes is kept in the array attrs ("planes_done"), so planes that are entirely
+    fill value (which Zarr does not store) are still counted as written.
+    """
+
+    def __init__(self, path, shape, dtype, tile=DEFAULT_TILE, compressor="default"):
+        self.path = path
+        z_size, y_size, x_size = shape
+        chunks = (1, min(tile, y_size), min(tile, x_size))
+        kwargs = {} if compressor == "default" else {"compressor": compressor}
+        existing = os.path.exists(os.path.join(path, ".zarray"))
+        self.array = zarr.open_array(path, mode="a", shape=tuple(shape), chunks=chunks,
+                                     dtype=dtype, **kwargs)
+        if existing and (self.array.shape != tuple(shape) or self.array.dtype != np.dtype(dtype)):
+            logger.warning(f"{path} has shape {self.array.shape} {self.array.dtype}, "
+                           f"expected {tuple(shape)} {np.dtype(dtype)}; starting over")
+            self.array = zarr.open_array(path, mode="w", shape=tuple(shape), chunks=chunks,
+                                         dtype=dtype, **kwargs)
+        self.dtype = self.array.dtype
+        self._done = set(self.array.attrs.get("planes_done", []))
+
+    def done_planes(self):
+        return set(self._done)
+
+    def read_plane(self, z):
+        return self.array[z]
+
+    def write(self, z, plane):
+        self.array[z] = plane
+        self._done.add(z)
+        self.array.attrs["planes_done"] = sorted(self._done)
+
+    def close(self):
+        pass
+
+    def file_size(self):
+        return disk_size(self.path)
+
+
+class TiffPlaneWriter:
+    """
+    Appends (y, x) planes as pages of a tiled, compressed BigTIFF (see tiff_writer). Pages
+    must arrive in z order; the pages already in the file count as done, so a partial file
+    is a valid shorter stack.
+    """
+
+    def __init__(self, path, shape, dtype, tile=DEFAULT_TILE, compression=DEFAULT_TIFF_COMPRESSION):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.options = tiff_write_options(self.shape, compression, tile=tile)
+        self._pages = self._count_pages()
+        self._writer = None
+
+    def _count_pages(self):
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            with tifffile.TiffFile(self.path) as tif:
+                pages = [p for p in tif.pages
+                         if p.shape == self.shape[1:] and p.dtype == self.dtype]
+                if len(pages) != len(tif.pages):
+                    raise ValueError("page shape or dtype differs")
+                return len(pages)
+        except Exception as e:
+            logger.warning(f"Can't resume {self.path} ({e}); starting over")
+            os.remove(self.path)
+            return 0
+
+    def done_planes(self):
+        return set(range(self._pages))
+
+    def read_plane(self, z):
+        return tifffile.imread(self.path, key=z)
+
+    def write(self, z, plane):
+        if z != self._pages:
+            raise ValueError(f"TIFF planes must be appended in order: got z={z}, expected {self._pages}")
+        if self._writer is None:
+            self._writer = tifffile.TiffWriter(self.path, bigtiff=True, append=self._pages > 0)
+        self._writer.write(np.asarray(plane, dtype=self.dtype), metadata=None, **self.options)
+        self._pages += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def file_size(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+
+PLANE_WRITERS = {"zarr": (ZarrPlaneWriter, ".zarr"), "bigtiff": (TiffPlaneWriter, ".tiff")}
+
+
+def open_plane_writer(kind, path_stem, shape, dtype, **kwargs):
+    """
+    This function opens a "zarr" or "bigtiff" plane writer at path_stem plus the format's
+    extension.
+    """
+    try:
+        writer_cls, ext = PLANE_WRITERS[kind]
+    except KeyError:
+        raise ValueError(f"Unknown plane writer {kind!r}, choose from {sorted(PLANE_WRITERS)}")
+    return writer_cls(path_stem + ext, shape, dtype, **kwargs)
+
+
+__all__ = ["ZarrPlaneWriter", "TiffPlaneWriter", "open_plane_writer", "PLANE_WRITERS"]
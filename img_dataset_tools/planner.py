@@ -0,0 +1,155 @@
+"""
+img_dataset_tools.planner
+
+This script contains the pre-flight planning pass of multiprocessing_image_datasets.py. Every
+source is expanded into its tasks before anything is downloaded, all sources at once: file sizes
+come from concurrent HEAD requests, Zarr object sizes from the bucket listing, crop sizes from the
+precomputed info file and OMERO stack sizes from the image dimensions. The plan reports the number
+of files and bytes per dataset, checks the free space on the target disk, estimates the duration
+for a given bandwidth, and hands the sized tasks to the scheduler so the largest ones start first.
+Files the download manifest records as current, and the parts of unfinished .part files that a
+resume keeps, are already on disk: they are reported separately and left out of the disk check.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .scheduler import Source
+
+logger = logging.getLogger(__name__)
+
+DISK_HEADROOM = 0.05   # share of the planned bytes kept free on top, for .part files and metadata
+
+
+class DownloadPlan:
+    """
+    The expanded tasks of a set of sources. datasets holds one dict per source with its
+    name, tasks, number of files, total and largest task bytes still to fetch, bytes already
+    on disk, tasks of unknown size, the largest task memory estimate and any expansion error.
+    """
+
+    def __init__(self, datasets, save_directory, seconds):
+        self.datasets = datasets
+        self.save_directory = save_directory
+        self.seconds = seconds
+        self.total_bytes = sum(d["bytes"] for d in datasets)
+        self.present_bytes = sum(d["present"] for d in datasets)
+        usage_path = save_directory
+        while not os.path.exists(usage_path):
+            usage_path = os.path.dirname(usage_path)
+        self.free_bytes = shutil.disk_usage(usage_path).free
+
+    @property
+    def required_bytes(self):
+        return int(self.total_bytes * (1 + DISK_HEADROOM))
+
+    @property
+    def fits_on_disk(self):
+        return self.required_bytes <= self.free_bytes
+
+    def sources(self):
+        """
+        This function returns Sources that run the planned tasks, with their sizes as the
+        scheduler's priorities. Sources that failed to expand are left out.
+        """
+        return [Source(d["name"], (lambda tasks=d["tasks"]: iter(tasks)), close=d["source"].close,
+                       limits=d["source"].limits, outputs=d["source"].outputs)
+                for d in self.datasets if d["error"] is None]
+
+    def close(self):
+        """
+        This function releases what the expansion opened (e.g. OMERO connections) when the
+        plan is not going to be run.
+        """
+        for dataset in self.datasets:
+            if dataset["source"].close is not None:
+                try:
+                    dataset["source"].close()
+                except Exception as e:
+                    logger.warning(f"Failed to close {dataset['name']}: {e}")
+
+    def to_dict(self, bandwidth=None):
+        return {
+            "save_directory": self.save_directory,
+            "total_bytes": self.total_bytes,
+            "present_bytes": self.present_bytes,
+            "required_bytes": self.required_bytes,
+            "free_bytes": self.free_bytes,
+            "fits_on_disk": self.fits_on_disk,
+            "estimated_seconds": self.total_bytes / bandwidth if bandwidth else None,
+            "planning_seconds": self.seconds,
+            "datasets": [{k: v for k, v in d.items() if k not in ("tasks", "source")}
+                         | {"error": None if d["error"] is None else str(d["error"])}
+                         for d in self.datasets],
+        }
+
+    def summary(self, bandwidth=None):
+        """
+        This function returns the plan as log lines. With bandwidth (bytes/sec) the
+        download time is estimated as total bytes over bandwidth.
+        """
+        lines = []
+        for d in self.datasets:
+            if d["error"] is not None:
+                lines.append(f"  {d['name']}: could not be planned ({d['error']})")
+                continue
+            line = (f"  {d['name']}: {d['files']} tasks, {d['bytes'] / 1e9:.2f} GB, "
+                    f"largest {d['largest'] / 1e9:.2f} GB")
+            if d["present"]:
+                line += f", {d['present'] / 1e9:.2f} GB already on disk"
+            if d["unknown"]:
+                line += f", {d['unknown']} of unknown size"
+            lines.append(line)
+        lines.append(f"  total {self.total_bytes / 1e9:.2f} GB to fetch ({self.present_bytes / 1e9:.2f} GB already "
+                     f"on disk), {self.free_bytes / 1e9:.2f} GB free in {self.save_directory}"
+                     + ("" if self.fits_on_disk else f" (NOT ENOUGH, {self.required_bytes / 1e9:.2f} GB needed)"))
+        if bandwidth:
+            lines.append(f"  estimated {self.total_bytes / bandwidth / 60:.1f} min at {bandwidth / 1e6:.0f} MB/s")
+        lines.append(f"  planned in {self.seconds:.1f} s")
+        return "\n".join(lines)
+
+    def save(self, path, bandwidth=None):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(bandwidth), f, indent=1)
+
+
+def _expand(source):
+    start_time = time.time()
+    dataset = {"name": source.name, "source": source, "tasks": [], "files": 0, "bytes": 0, "largest": 0,
+               "present": 0, "unknown": 0, "peak_memory": 0, "seconds": 0.0, "error": None}
+    try:
+        for task in source.expand():
+            task.source = source.name
+            dataset["tasks"].append(task)
+            dataset["bytes"] += task.size
+            dataset["largest"] = max(dataset["largest"], task.size)
+            dataset["present"] += task.present
+            dataset["unknown"] += not task.size and not task.present
+            dataset["peak_memory"] = max(dataset["peak_memory"], task.memory)
+        dataset["files"] = len(dataset["tasks"])
+    except Exception as e:
+        logger.error(f"Failed to plan {source.name}: {e}", exc_info=True)
+        dataset["error"] = e
+    dataset["seconds"] = time.time() - start_time
+    return dataset
+
+
+def plan_sources(sources, save_directory):
+    """
+    This function expands every Source concurrently, without downloading anything, and
+    returns the DownloadPlan.
+    """
+    start_time = time.time()
+    sources = list(sources)
+    with ThreadPoolExecutor(max_workers=max(1, len(sources))) as executor:
+        datasets = list(executor.map(_expand, sources))
+    return DownloadPlan(datasets, save_directory, time.time() - start_time)
+
+
+__all__ = ["DownloadPlan", "plan_sources"]
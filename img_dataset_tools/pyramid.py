@@ -0,0 +1,311 @@
+"""
+img_dataset_tools.pyramid
+
+This script contains the multiscale pyramid engine. Given any chunked Zarr array of the
+package (a downloaded COSEM array, a streamed Neuroglancer crop, the s0 of a converted
+OME-Zarr group) it computes the coarser levels s1..sN, each one from the level before it,
+block by block with vectorized NumPy reductions: the mean for images, the maximum for sparse
+signal and the most frequent value for labels. The blocks of a level are spread over a
+process pool, so memory stays at a few blocks per worker whatever the size of the volume.
+Every finished level is stamped with how it was made, so an interrupted run picks up at
+the first level that isn't complete, and each level reports its throughput in voxels per
+second.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import zarr
+
+from .volumes import ZarrVolume, open_volume
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_BYTES = 128 * 1024 ** 2   # largest block of source voxels one worker holds
+OME_ZARR_VERSION = "0.4"
+PYRAMID_SUFFIX = ".pyramid.zarr"
+LABEL_HINTS = ("groundtruth", "label", "mask", "seg")
+
+
+def is_label_volume(path, dtype):
+    """
+    This function guesses whether the volume at path holds labels rather than intensities:
+    an integer volume whose file name mentions ground truth, labels, masks or segmentation.
+    """
+    name = os.path.basename(path.rstrip("/")).lower()
+    return np.issubdtype(np.dtype(dtype), np.integer) and any(hint in name for hint in LABEL_HINTS)
+
+
+def pyramid_shapes(shape, chunks, factors, levels=None):
+    """
+    This function returns the shape of every pyramid level, s0 first. Each level divides
+    the previous one by factors (rounding up); without a level count, levels are added
+    until the coarsest fits in one chunk.
+    """
+    shapes = [tuple(shape)]
+    while levels is None or len(shapes) < levels:
+        last = shapes[-1]
+        if levels is None and all(n <= c for n, c in zip(last, chunks)):
+            break
+        following = tuple(-(-n // f) for n, f in zip(last, factors))
+        if following == last:
+            break
+        shapes.append(following)
+    return shapes
+
+
+def _windows(block, factors):
+    # block padded by repeating the last voxel and reshaped to (n0 // f0, f0, n1 // f1, f1, ...)
+    pad = [(0, -n % f) for n, f in zip(block.shape, factors)]
+    if any(p for _, p in pad):
+        block = np.pad(block, pad, mode="edge")
+    return block.reshape([d for n, f in zip(block.shape, factors) for d in (n // f, f)])
+
+
+def downsample_mean(block, factors):
+    """
+    This function averages block over factors-sized windows; edges are padded by
+    repeating the last voxel. Integer data is rounded back to its dtype.
+    """
+    windows = _windows(block, factors)
+    # summed in float64 window by window, without a float copy of the whole block
+    mean = windows.sum(axis=tuple(range(1, windows.ndim, 2)), dtype=np.float64) / int(np.prod(factors))
+    if np.issubdtype(block.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(block.dtype)
+
+
+def downsample_max(block, factors):
+    """
+    This function takes the largest value of every factors-sized window of block, which
+    keeps thin bright structures and sparse masks visible at coarse levels.
+    """
+    windows = _windows(block, factors)
+    return windows.max(axis=tuple(range(1, windows.ndim, 2)))
+
+
+def downsample_mode(block, factors):
+    """
+    This function takes the most frequent value of every factors-sized window of block
+    (the smallest one in a tie), so labels stay labels. Edges are padded by repeating the
+    last voxel.
+    """
+    ndim = block.ndim
+    windows = _windows(block, factors)
+    windows = windows.transpose(tuple(range(0, 2 * ndim, 2)) + tuple(range(1, 2 * ndim, 2)))
+    windows = np.sort(windows.reshape(windows.shape[:ndim] + (-1,)), axis=-1)
+    # in each sorted window, the position within its run of equal values; the longest run ends
+    # where that is largest
+    size = windows.shape[-1]
+    index = np.arange(size, dtype=np.int16 if size < 2 ** 15 else np.int64)
+    starts = np.empty(windows.shape, dtype=bool)
+    starts[..., 0] = True
+    np.not_equal(windows[..., 1:], windows[..., :-1], out=starts[..., 1:])
+    run = index - np.maximum.accumulate(np.where(starts, index, 0), axis=-1)
+    winner = run.argmax(axis=-1)[..., None]
+    return np.take_along_axis(windows, winner, axis=-1)[..., 0]
+
+
+DOWNSAMPLERS = {"mean": downsample_mean, "max": downsample_max, "mode": downsample_mode}
+
+
+def level_blocks(shape, chunks, itemsize, block_bytes, scale=None):
+    """
+    This function splits a level of shape into blocks of whole chunk rows (chunks[:-1] by
+    the full last axis), cut along the last axis in whole chunks where a row would need more
+    than block_bytes of input; scale is the input per output voxel along each axis.
+    """
+    scale = scale or (1,) * len(shape)
+    row = int(np.prod([c * s for c, s in zip(chunks[:-1], scale[:-1])])) * itemsize * scale[-1]
+    width = max(1, block_bytes // max(1, row * chunks[-1])) * chunks[-1]
+    grid = [range(0, n, c) for n, c in zip(shape[:-1], chunks[:-1])]
+    for start in np.ndindex(*(len(g) for g in grid)):
+        lead = tuple(slice(g[i], min(g[i] + c, n)) for g, i, c, n in zip(grid, start, chunks, shape))
+        for x in range(0, shape[-1], width):
+            yield lead + (slice(x, min(x + width, shape[-1])),)
+
+
+def _copy_block(source_path, target_path, slices):
+    # runs in a pool process
+    data = zarr.open_array(source_path, mode="r")[slices]
+    zarr.open_array(target_path, mode="r+")[slices] = data
+    return data.size
+
+
+def _downsample_block(source_path, target_path, slices, factors, method):
+    # runs in a pool process; returns the number of source voxels read
+    source = zarr.open_array(source_path, mode="r")
+    in_slices = tuple(slice(s.start * f, min(s.stop * f, n)) for s, f, n in zip(slices, factors, source.shape))
+    data = source[in_slices]
+    zarr.open_array(target_path, mode="r+")[slices] = DOWNSAMPLERS[method](data, factors)
+    return data.size
+
+
+def multiscales_metadata(name, axes, scale, shapes, factors, method):
+    """
+    This function returns the OME-Zarr multiscales attribute of a pyramid with levels of
+    shapes named s0, s1, ...: scale is the size of an s0 voxel along each of axes, and each
+    level is factors coarser than the one before it.
+    """
+    datasets = []
+    scale = [float(s) for s in scale]
+    for level in range(len(shapes)):
+        datasets.append({"path": f"s{level}", "coordinateTransformations": [{"type": "scale", "scale": list(scale)}]})
+        scale = [s * f for s, f in zip(scale, factors)]
+    return [{"version": OME_ZARR_VERSION, "name": name, "axes": axes, "datasets": datasets, "type": method,
+             "metadata": {"method": f"img_dataset_tools.pyramid.downsample_{method}", "factors": list(factors)}}]
+
+
+def _default_axes(ndim, resolution):
+    unit = {"unit": "nanometer"} if any(r is not None for r in resolution) else {}
+    return [dict({"name": axis, "type": "space"}, **unit) for axis in "zyx"[3 - ndim:]] if ndim <= 3 else \
+        [{"name": f"dim_{i}"} for i in range(ndim)]
+
+
+def _base(path, output_path, overwrite):
+    # (group, base array name, axes, s0 scale, name, method so far) of the pyramid to build: a multiscale group
+    # is extended in place, anything else gets a new group at output_path with a copy of its s0
+    with open_volume(path) as volume:
+        if not isinstance(volume, ZarrVolume):
+            raise ValueError(f"{path}: not a Zarr array or group")
+        source_path, resolution = volume.path, volume.resolution_nm
+    name = os.path.splitext(os.path.basename(path.rstrip("/")))[0]
+    scale = [r if r is not None else 1.0 for r in resolution]
+    node = zarr.open(path, mode="r")
+    multiscales = node.attrs.get("multiscales") if isinstance(node, zarr.hierarchy.Group) else None
+    if multiscales and output_path in (None, path):
+        base = multiscales[0]["datasets"][0]
+        scale = next((t["scale"] for t in base.get("coordinateTransformations", []) if t.get("type") == "scale"),
+                     scale)
+        axes = multiscales[0].get("axes") or _default_axes(len(scale), resolution)
+        return zarr.open_group(path, mode="r+"), base["path"], axes, scale, multiscales[0].get("name", name), \
+            multiscales[0].get("type")
+
+    output_path = output_path or path.rstrip("/").rsplit(".zarr", 1)[0] + PYRAMID_SUFFIX
+    group = zarr.open_group(output_path, mode="a")
+    source = zarr.open_array(source_path, mode="r")
+    stamp = {"copied_from": os.path.abspath(source_path)}
+    existing = group.get("s0")
+    if overwrite or not isinstance(existing, zarr.Array) or existing.shape != source.shape \
+            or existing.attrs.get("pyramid", {}).get("copied_from") != stamp["copied_from"]:
+        existing = group.create_dataset("s0", shape=source.shape, chunks=source.chunks, dtype=source.dtype,
+                                        compressor=source.compressor, fill_value=source.fill_value,
+                                        overwrite=True, dimension_separator="/")
+        existing.attrs["pyramid"] = dict(stamp, complete=False)
+    return group, "s0", _default_axes(source.ndim, resolution), scale, name, None
+
+
+def build_pyramid(path, output_path=None, method=None, levels=None, factors=None, workers=None,
+                  block_bytes=DEFAULT_BLOCK_BYTES, overwrite=False, executor=None):
+    """
+    This function builds the multiscale pyramid of the Zarr array or OME-Zarr group at path
+    and returns a report dict with one entry per level. A multiscale group gets its coarser
+    levels written next to its s0 and its multiscales metadata rewritten; an array (or a
+    group, given output_path) is copied into s0 of a new group at output_path (default: next
+    to it, with the .pyramid.zarr suffix). method is "mean", "max" or "mode" (default: the
+    one the group was made with, else mode for label volumes and mean otherwise), levels the number of levels including s0 (default:
+    down to one chunk), factors the downsampling per axis (default 2, 1 along axes of one
+    voxel). Blocks are spread over workers processes (default: every core) or over executor.
+    Levels already made the same way are kept unless overwrite is set; new levels use the
+    chunks and compressor of s0. A coarse level this function didn't make is only replaced
+    with overwrite.
+    """
+    start_time = time.time()
+    group, base, axes, scale, name, previous_method = _base(path, output_path, overwrite)
+    source = group[base]
+    shape, chunks, dtype, ndim = source.shape, source.chunks, source.dtype, source.ndim
+    if method is None:
+        method = previous_method if previous_method in DOWNSAMPLERS else \
+            "mode" if is_label_volume(path, dtype) else "mean"
+    if method not in DOWNSAMPLERS:
+        raise ValueError(f"Unknown method {method!r}, choose from {tuple(DOWNSAMPLERS)}")
+    factors = tuple(factors or (2,) * ndim)
+    factors = tuple(f if n > 1 else 1 for f, n in zip(factors, shape))
+    shapes = pyramid_shapes(shape, chunks, factors, levels)
+    store = group.store.path
+    report = {"source": path, "output": store, "method": method, "levels": [], "seconds": 0.0}
+
+    own_executor = executor is None
+    executor = executor or ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+    try:
+        copied = source.attrs.get("pyramid", {})
+        rebuilt = overwrite
+        if copied.get("copied_from") and not copied.get("complete"):
+            level_start = time.time()
+            blocks = list(level_blocks(shape, chunks, dtype.itemsize, block_bytes))
+            n = len(blocks)
+            voxels = sum(executor.map(_copy_block, [copied["copied_from"]] * n, [os.path.join(store, base)] * n,
+                                      blocks))
+            source.attrs["pyramid"] = dict(copied, complete=True)
+            report["levels"].append(_level_report(name, 0, shape, "copy", n, voxels, level_start))
+            rebuilt = True
+
+        previous = base
+        for index in range(1, len(shapes)):
+            level, level_start = f"s{index}", time.time()
+            stamp = {"source": previous, "factors": list(factors), "method": method}
+            existing = group.get(level)
+            if isinstance(existing, zarr.Array) and "pyramid" not in existing.attrs and not overwrite:
+                raise ValueError(f"{os.path.join(store, level)} wasn't built by build_pyramid, "
+                                 f"pass overwrite=True to replace it or an output_path")
+            if not rebuilt and isinstance(existing, zarr.Array) and existing.shape == shapes[index] \
+                    and existing.attrs["pyramid"] == dict(stamp, complete=True):
+                report["levels"].append(_level_report(name, index, shapes[index], method, 0, 0, level_start, True))
+                previous = level
+                continue
+            rebuilt = True
+            level_chunks = tuple(min(c, n) for c, n in zip(chunks, shapes[index]))
+            target = group.create_dataset(level, shape=shapes[index], chunks=level_chunks, dtype=dtype,
+                                          compressor=source.compressor, fill_value=source.fill_value,
+                                          overwrite=True, dimension_separator="/")
+            target.attrs["pyramid"] = dict(stamp, complete=False)
+            blocks = list(level_blocks(shapes[index], level_chunks, dtype.itemsize, block_bytes, factors))
+            n = len(blocks)
+            voxels = sum(executor.map(_downsample_block, [os.path.join(store, previous)] * n,
+                                      [os.path.join(store, level)] * n, blocks, [factors] * n, [method] * n))
+            target.attrs["pyramid"] = dict(stamp, complete=True)
+            report["levels"].append(_level_report(name, index, shapes[index], method, n, voxels, level_start))
+            previous = level
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    multiscales = multiscales_metadata(name, axes, scale, shapes, factors, method)
+    multiscales[0]["datasets"][0]["path"] = base
+    group.attrs["multiscales"] = multiscales
+    report["seconds"] = time.time() - start_time
+    return report
+
+
+def _level_report(name, index, shape, method, blocks, voxels, level_start, skipped=False):
+    seconds = time.time() - level_start
+    entry = {"level": index, "shape": tuple(shape), "method": method, "blocks": blocks, "voxels": voxels,
+             "seconds": seconds, "voxels_per_second": voxels / seconds if seconds > 0 else 0.0, "skipped": skipped}
+    if skipped:
+        logger.info(f"{name}: s{index} {tuple(shape)} up to date, kept")
+    else:
+        logger.info(f"{name}: s{index} {tuple(shape)} {method} from {voxels:,} voxels in {blocks} blocks, "
+                    f"{seconds:.1f} s ({entry['voxels_per_second'] / 1e6:.1f} Mvoxels/s)")
+    return entry
+
+
+def format_pyramid_report(report):
+    """
+    This function turns a build_pyramid() report into a log line.
+    """
+    built = [level for level in report["levels"] if not level["skipped"]]
+    voxels = sum(level["voxels"] for level in built)
+    seconds = sum(level["seconds"] for level in built)
+    return (f"{report['output']}: {len(built)} levels built, {len(report['levels']) - len(built)} kept "
+            f"({report['method']}), {voxels:,} voxels read in {seconds:.1f} s "
+            f"({voxels / seconds / 1e6 if seconds > 0 else 0.0:.1f} Mvoxels/s)")
+
+
+__all__ = ["build_pyramid", "format_pyramid_report", "downsample_mean", "downsample_max", "downsample_mode",
+           "DOWNSAMPLERS", "pyramid_shapes", "level_blocks", "multiscales_metadata", "is_label_volume",
+           "DEFAULT_BLOCK_BYTES", "PYRAMID_SUFFIX"]
@@ -0,0 +1,293 @@
+"""
+img_dataset_tools.scheduler
+
+This script contains the global work scheduler used by multiprocessing_image_datasets.py. Every
+dataset source is first expanded into file-level or chunk-level tasks (one file, one batch of
+Zarr chunks, one OMERO stack, one crop), and the tasks of all sources go into one shared queue
+served by a single pool of worker threads. The queue always hands out the largest waiting task,
+so big transfers start early and small ones fill the gaps at the end, and a worker that finishes
+takes the next task of whichever source still has work instead of idling once its own dataset
+is done. Total wall time then follows the total number of bytes rather than the slowest dataset.
+
+Tasks also declare their peak memory, estimated up front from the shapes and dtypes they
+will hold. A task is only admitted while the memory of the running tasks plus its own stays
+under the RAM budget; otherwise it is deferred (and reported) while smaller tasks go ahead.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCHEDULER_WORKERS = 16
+EXPAND_PRIORITY = float("inf")   # expansion runs before any transfer so queues fill early
+DEFAULT_MEMORY_FRACTION = 0.5    # share of physical RAM running tasks may hold by default
+
+
+def default_memory_budget(fraction=DEFAULT_MEMORY_FRACTION):
+    """
+    This function returns fraction of the node's physical memory in bytes, or None where
+    that can't be determined.
+    """
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * fraction)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class Task:
+    """
+    One unit of work in the shared queue. run() does the work and may return a result dict
+    (with "bytes" and "error", like DownloadEngine.download); size is the estimated number of
+    bytes and orders the queue. Tasks with the same group share that group's concurrency
+    limit, e.g. the connections of one OMERO server. memory is the estimated peak number of
+    bytes the task holds in RAM while it runs. present is the number of bytes of the output
+    already on disk from an earlier run, which size does not include.
+    """
+
+    def __init__(self, name, size, run, group=None, memory=0, present=0):
+        self.name = name
+        self.size = size or 0
+        self.present = present or 0
+        self.run = run
+        self.group = group
+        self.memory = memory or 0
+        self.source = None
+        self.deferred_at = None
+
+
+class Source:
+    """
+    A dataset as the scheduler sees it. expand() yields its Tasks and runs as a task itself,
+    so the first transfers start while the rest of the source is still being listed. close()
+    is called once every task of the source has finished. limits maps task groups to their
+    maximum number of concurrently running tasks. outputs lists the paths that are only
+    complete once every task has finished, such as a Zarr store copied in batches.
+    """
+
+    def __init__(self, name, expand, close=None, limits=None, outputs=None):
+        self.name = name
+        self.expand = expand
+        self.close = close
+        self.limits = dict(limits or {})
+        self.outputs = list(outputs or [])
+
+
+class WorkScheduler:
+    """
+    Shared largest-first task queue served by `workers` threads. Sources are added with
+    run(); tasks can also be submitted while it runs, from inside other tasks.
+
+    memory_budget caps the summed memory estimates of the running tasks, in bytes ("auto":
+    half of the physical RAM; None: no cap). A task that doesn't fit waits, and holds back
+    later tasks that would delay it, until enough memory is released; a task larger than
+    the whole budget runs on its own.
+    """
+
+    def __init__(self, workers=DEFAULT_SCHEDULER_WORKERS, memory_budget="auto"):
+        self.workers = max(1, workers)
+        self.memory_budget = default_memory_budget() if memory_budget == "auto" else memory_budget
+        self._memory_in_use = 0
+        self._memory = {"peak": 0, "deferred_tasks": 0, "deferred_seconds": 0.0}
+        self._heap = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._outstanding = 0
+        self._running = {}
+        self._limits = {}
+        self._sources = {}
+        self._progress = None
+
+    def submit(self, task, priority=None):
+        """
+        This function queues task; larger priority (default: task.size) runs first.
+        """
+        with self._cond:
+            if task.source in self._sources:
+                self._sources[task.source]["tasks"] += 1
+            self._push(task, task.size if priority is None else priority)
+
+    def _push(self, task, priority):
+        # called with the lock held
+        self._outstanding += 1
+        if task.source in self._sources:
+            self._sources[task.source]["pending"] += 1
+        heapq.heappush(self._heap, (-priority, next(self._order), task))
+        if self._progress is not None:
+            self._progress.total += task.size
+        self._cond.notify()
+
+    def _add_source(self, source):
+        with self._cond:
+            self._sources[source.name] = {"source": source, "pending": 0, "tasks": 0, "bytes": 0,
+                                          "failed": 0, "deferred": 0, "started": None, "finished": None}
+            self._limits.update(source.limits)
+
+        def expand():
+            for task in source.expand():
+                task.source = source.name
+                self.submit(task)
+
+        task = Task(f"expand {source.name}", 0, expand)
+        task.source = source.name
+        with self._cond:
+            self._push(task, EXPAND_PRIORITY)
+
+    def _runnable(self, task):
+        limit = self._limits.get(task.group)
+        return limit is None or self._running.get(task.group, 0) < limit
+
+    def _fits(self, task, reserved):
+        if self.memory_budget is None or not task.memory:
+            return True
+        if self._memory_in_use == 0 and reserved == 0:
+            # too big for the budget on any terms: let it run alone
+            return True
+        return self._memory_in_use + reserved + task.memory <= self.memory_budget
+
+    def _defer(self, task):
+        if task.deferred_at is not None:
+            return
+        task.deferred_at = time.time()
+        self._memory["deferred_tasks"] += 1
+        if task.source in self._sources:
+            self._sources[task.source]["deferred"] += 1
+        logger.info(f"Deferring {task.name} of {task.source}: needs {task.memory / 1e6:.0f} MB, "
+                    f"{self._memory_in_use / 1e6:.0f} of {self.memory_budget / 1e6:.0f} MB in use")
+
+    def _next_task(self):
+        # called with the lock held; skips tasks whose group is at its limit or that don't
+        # fit in memory. The first task deferred for memory reserves its share, so a stream
+        # of smaller tasks can't keep it waiting forever.
+        skipped, task, reserved = [], None, 0
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            candidate = entry[2]
+            skipped.append(entry)
+            if not self._runnable(candidate):
+                continue
+            if not self._fits(candidate, reserved):
+                self._defer(candidate)
+                if not reserved:
+                    reserved = candidate.memory
+                continue
+            task = candidate
+            skipped.pop()
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return task
+
+    def _worker(self, busy):
+        while True:
+            with self._cond:
+                while True:
+                    if self._outstanding == 0:
+                        return
+                    task = self._next_task()
+                    if task is not None:
+                        break
+                    self._cond.wait()
+                self._running[task.group] = self._running.get(task.group, 0) + 1
+                self._memory_in_use += task.memory
+                self._memory["peak"] = max(self._memory["peak"], self._memory_in_use)
+                if task.deferred_at is not None:
+                    self._memory["deferred_seconds"] += time.time() - task.deferred_at
+                stats = self._sources.get(task.source)
+                if stats is not None and stats["started"] is None:
+                    stats["started"] = time.time()
+
+            start_time = time.time()
+            try:
+                result = task.run()
+                error = result.get("error") if isinstance(result, dict) else None
+            except Exception as e:
+                logger.error(f"Task {task.name} of {task.source} failed: {e}", exc_info=True)
+                result, error = None, e
+            done_bytes = result.get("bytes", task.size) if isinstance(result, dict) else task.size
+            busy.append(time.time() - start_time)
+
+            close = None
+            with self._cond:
+                self._running[task.group] -= 1
+                self._memory_in_use -= task.memory
+                self._outstanding -= 1
+                if self._progress is not None:
+                    # the estimate is what went into the total, whatever was actually fetched
+                    self._progress.update(task.size)
+                if stats is not None:
+                    stats["pending"] -= 1
+                    stats["bytes"] += done_bytes or 0
+                    stats["failed"] += error is not None
+                    if stats["pending"] == 0:
+                        stats["finished"] = time.time()
+                        close = stats["source"].close
+                self._cond.notify_all()
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    logger.error(f"Failed to close source {task.source}: {e}", exc_info=True)
+
+    def run(self, sources, desc="Downloading"):
+        """
+        This function expands every Source, works through all their tasks on the shared
+        pool and returns a report: wall seconds, total bytes, aggregate bytes/sec, worker
+        utilisation, the memory budget with the peak estimate admitted and the tasks
+        deferred for memory, and per source the number of tasks, bytes, failures,
+        deferrals and the time from the start of the run until its last task finished.
+        """
+        start_time = time.time()
+        busy = []
+        self._progress = tqdm(total=0, desc=desc, unit="B", unit_scale=True)
+        try:
+            for source in sources:
+                self._add_source(source)
+            threads = [threading.Thread(target=self._worker, args=(busy,), daemon=True)
+                       for _ in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self._progress.close()
+            self._progress = None
+
+        wall = time.time() - start_time
+        report = {"seconds": wall, "bytes": 0, "utilisation": sum(busy) / (wall * self.workers) if wall else 0.0,
+                  "memory": dict(self._memory, budget=self.memory_budget), "sources": {}}
+        for name, stats in self._sources.items():
+            report["bytes"] += stats["bytes"]
+            report["sources"][name] = {
+                "tasks": stats["tasks"], "bytes": stats["bytes"], "failed": stats["failed"],
+                "deferred": stats["deferred"], "seconds": (stats["finished"] or time.time()) - start_time}
+        report["bytes_per_second"] = report["bytes"] / wall if wall else 0.0
+        return report
+
+
+def format_report(report):
+    """
+    This function turns a WorkScheduler.run() report into log lines, slowest source last.
+    """
+    lines = [f"{report['bytes'] / 1e9:.2f} GB in {report['seconds'] / 60:.2f} min "
+             f"({report['bytes_per_second'] / 1e6:.1f} MB/s), workers busy {report['utilisation']:.0%}"]
+    memory = report["memory"]
+    if memory["budget"] is not None:
+        lines.append(f"  memory: peak {memory['peak'] / 1e9:.2f} of {memory['budget'] / 1e9:.2f} GB, "
+                     f"{memory['deferred_tasks']} tasks deferred for {memory['deferred_seconds']:.1f} s in total")
+    for name, stats in sorted(report["sources"].items(), key=lambda item: item[1]["seconds"]):
+        lines.append(f"  {name}: {stats['tasks']} tasks, {stats['bytes'] / 1e9:.2f} GB, "
+                     f"{stats['failed']} failed, {stats['deferred']} deferred, done after {stats['seconds'] / 60:.2f} min")
+    return "\n".join(lines)
+
+
+__all__ = ["Task", "Source", "WorkScheduler", "format_report", "default_memory_budget",
+           "DEFAULT_SCHEDULER_WORKERS"]
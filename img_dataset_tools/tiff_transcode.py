@@ -0,0 +1,511 @@
+"""
+img_dataset_tools.tiff_transcode
+
+This script contains the download-and-transcode mode of the Selenium and static scrapers. While a
+TIFF stack is still downloading, its header and page directories are parsed from the bytes that
+have landed in the .part file, every page whose strips or tiles are complete is decoded, and full
+z-slabs are written into a chunked, compressed Zarr array. The block-accessible copy is ready when
+the last byte arrives, and the original TIFF can be kept or dropped.
+
+Stacks written by ImageJ (one directory up front, then all planes back to back) and by tifffile
+(directory before each page) stream page by page. Layouts that put every directory after the
+pixel data, or that use codecs and sample layouts the streaming decoder doesn't handle, are
+converted with tifffile once the download completes.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import bisect
+import logging
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+
+import numpy as np
+import tifffile
+import zarr
+
+from .downloaders import PART_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRANSCODE_CHUNKS = (64, 256, 256)   # (z, y, x) chunk shape of the Zarr copy
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+# TIFF field type -> struct format character
+_FIELD_TYPES = {1: "B", 2: "s", 3: "H", 4: "I", 5: "2I", 6: "b", 7: "B", 8: "h", 9: "i",
+                10: "2i", 11: "f", 12: "d", 13: "I", 16: "Q", 17: "q", 18: "Q"}
+_TAGS = {254: "subfiletype", 256: "width", 257: "length", 258: "bitspersample",
+         259: "compression", 270: "description", 273: "offsets", 277: "samplesperpixel",
+         278: "rowsperstrip", 279: "bytecounts", 284: "planarconfig", 317: "predictor",
+         322: "tilewidth", 323: "tilelength", 324: "offsets", 325: "bytecounts",
+         339: "sampleformat"}
+_SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}
+
+
+class _NeedBytes(Exception):
+    """Raised by the parser when the bytes it needs have not arrived yet."""
+
+
+class _Unsupported(Exception):
+    """Raised for TIFF layouts the streaming decoder does not handle."""
+
+
+def is_tiff(path):
+    return path.lower().endswith(TIFF_EXTENSIONS)
+
+
+class TiffZarrTranscoder:
+    """
+    Download observer (see DownloadEngine.download) that turns a TIFF stack arriving in
+    part_path into a (z, y, x[, samples]) Zarr array at zarr_path. Decoding runs on a
+    background thread so the download never waits on it; finish() completes the array once
+    the file is whole. Finished slabs are recorded in the array attrs, so a resumed download
+    only decodes the planes of slabs that are still missing.
+    """
+
+    def __init__(self, part_path, zarr_path, chunks=DEFAULT_TRANSCODE_CHUNKS, compressor="default"):
+        self.part_path = part_path
+        self.zarr_path = zarr_path
+        self.chunks = tuple(chunks)
+        self.compressor = compressor
+        self._lock = threading.Lock()
+        self._work_lock = threading.Lock()     # held by a decode pass; restart() waits for it
+        self._wake = threading.Condition(self._lock)
+        self._stopping = False
+        self._fd = None
+        self._reset_state()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _reset_state(self):
+        self._ranges = []           # merged [start, end) byte ranges on disk
+        self._arrivals = 0
+        self._header = None         # (byteorder, bigtiff)
+        self._next_ifd = None
+        self._first = None          # plane shape, dtype and codec of page 0
+        self._pages = []            # pages found but not decoded yet
+        self._page_count = 0
+        self._total = None          # number of planes, once known
+        self._slabs = {}            # slab index -> (buffer, filled z set)
+        self._array = None
+        self._slabs_done = set()
+        self._unsupported = None
+        self.planes_streamed = 0
+        self.planes_decoded = 0
+
+    # observer interface
+
+    def restart(self):
+        with self._work_lock, self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._reset_state()
+            if os.path.exists(self.zarr_path):
+                shutil.rmtree(self.zarr_path)
+
+    def received(self, start, end):
+        with self._lock:
+            if self._fd is None:
+                # opened here, not in the worker, so a rename of the .part can't race it
+                self._fd = os.open(self.part_path, os.O_RDONLY)
+            self._add_range(start, end)
+            self._arrivals += 1
+            self._wake.notify()
+
+    # byte bookkeeping
+
+    def _add_range(self, start, end):
+        if end <= start:
+            return
+        i = bisect.bisect_left(self._ranges, [start, start])
+        if i > 0 and self._ranges[i - 1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(self._ranges) and self._ranges[j][0] <= end:
+            start = min(start, self._ranges[j][0])
+            end = max(end, self._ranges[j][1])
+            j += 1
+        self._ranges[i:j] = [[start, end]]
+
+    def _have(self, start, end):
+        i = bisect.bisect_right(self._ranges, [start, float("inf")]) - 1
+        return i >= 0 and self._ranges[i][0] <= start and self._ranges[i][1] >= end
+
+    def _read(self, offset, size):
+        with self._lock:
+            if not self._have(offset, offset + size):
+                raise _NeedBytes()
+            fd = self._fd
+        data = os.pread(fd, size, offset)
+        if len(data) != size:
+            raise _NeedBytes()
+        return data
+
+    # parsing
+
+    def _unpack(self, fmt, offset, size):
+        return struct.unpack(self._header[0] + fmt, self._read(offset, size))
+
+    def _parse_header(self):
+        order = self._read(0, 4)
+        byteorder = {b"II": "<", b"MM": ">"}.get(order[:2])
+        if byteorder is None:
+            raise _Unsupported("not a TIFF file")
+        version = struct.unpack(byteorder + "H", order[2:4])[0]
+        self._header = (byteorder, version == 43)
+        if version == 43:
+            self._next_ifd = self._unpack("Q", 8, 8)[0]
+        elif version == 42:
+            self._next_ifd = self._unpack("I", 4, 4)[0]
+        else:
+            raise _Unsupported(f"unknown TIFF version {version}")
+
+    def _parse_ifd(self, offset):
+        """Return (tags, next_ifd_offset) of the directory at offset."""
+        bigtiff = self._header[1]
+        count_fmt, entry_size, value_size = ("Q", 20, 8) if bigtiff else ("H", 12, 4)
+        count = self._unpack(count_fmt, offset, struct.calcsize(count_fmt))[0]
+        start = offset + struct.calcsize(count_fmt)
+        raw = self._read(start, count * entry_size + value_size)
+        tags = {}
+        for n in range(count):
+            entry = raw[n * entry_size:(n + 1) * entry_size]
+            code, field_type = struct.unpack(self._header[0] + "HH", entry[:4])
+            if code not in _TAGS or field_type not in _FIELD_TYPES:
+                continue
+            value_count = struct.unpack(self._header[0] + ("Q" if bigtiff else "I"),
+                                        entry[4:4 + (8 if bigtiff else 4)])[0]
+            fmt = _FIELD_TYPES[field_type]
+            size = struct.calcsize(self._header[0] + fmt) * value_count
+            if size <= value_size:
+                data = entry[entry_size - value_size:entry_size - value_size + size]
+            else:
+                pointer = struct.unpack(self._header[0] + ("Q" if bigtiff else "I"),
+                                        entry[entry_size - value_size:])[0]
+                data = self._read(pointer, size)
+            if field_type == 2:
+                value = data.rstrip(b"\0").decode("latin-1")
+            else:
+                value = struct.unpack(self._header[0] + fmt[-1] * (value_count * len(fmt)), data)
+            tags[_TAGS[code]] = value
+        next_ifd = struct.unpack(self._header[0] + count_fmt.replace("H", "I"), raw[-value_size:])[0]
+        return tags, next_ifd
+
+    def _page_from_tags(self, tags):
+        if tags.get("subfiletype", (0,))[0] & 1:
+            return None   # reduced-resolution copy
+        spp = tags.get("samplesperpixel", (1,))[0]
+        bits = set(tags.get("bitspersample", (1,)))
+        kinds = set(tags.get("sampleformat", (1,)))
+        if len(bits) != 1 or not bits <= {8, 16, 32, 64}:
+            raise _Unsupported(f"bits per sample {tags.get('bitspersample')}")
+        if len(kinds) != 1 or not kinds <= set(_SAMPLE_KINDS):
+            raise _Unsupported(f"sample format {tags.get('sampleformat')}")
+        bits, kind = bits.pop(), kinds.pop()
+        if spp > 1 and tags.get("planarconfig", (1,))[0] != 1:
+            raise _Unsupported("separate sample planes")
+        compression = tags.get("compression", (1,))[0]
+        if compression != 1 and compression not in tifffile.TIFF.DECOMPRESSORS:
+            raise _Unsupported(f"compression {compression}")
+        predictor = tags.get("predictor", (1,))[0]
+        if predictor not in (1, 2):
+            raise _Unsupported(f"predictor {predictor}")
+        dtype = np.dtype(f"{self._header[0]}{_SAMPLE_KINDS[kind]}{bits // 8}")
+        height, width = tags["length"][0], tags["width"][0]
+        if "tilewidth" in tags:
+            block = (tags["tilelength"][0], tags["tilewidth"][0])
+        else:
+            block = (min(tags.get("rowsperstrip", (height,))[0], height), width)
+        return {"shape": (height, width, spp), "dtype": dtype, "compression": compression,
+                "predictor": predictor, "block": block, "tiled": "tilewidth" in tags,
+                "ranges": list(zip(tags["offsets"], tags["bytecounts"])),
+                "description": tags.get("description", "")}
+
+    def _imagej_planes(self, page):
+        """
+        Number of planes of an uncompressed ImageJ stack whose planes follow the first one
+        back to back (its other directories sit at the end of the file), else None.
+        """
+        match = re.search(r"^images=(\d+)", page["description"], re.MULTILINE)
+        if not page["description"].startswith("ImageJ=") or match is None or page["compression"] != 1:
+            return None
+        ranges = page["ranges"]
+        if any(a[0] + a[1] != b[0] for a, b in zip(ranges, ranges[1:])):
+            return None
+        return int(match.group(1))
+
+    def _discover(self):
+        if self._header is None:
+            self._parse_header()
+        while self._next_ifd:
+            tags, next_ifd = self._parse_ifd(self._next_ifd)
+            page = self._page_from_tags(tags)
+            self._next_ifd = next_ifd
+            if page is None:
+                continue
+            if self._first is None:
+                self._first = page
+                self._open_array(page)
+                planes = self._imagej_planes(page)
+                if planes is not None:
+                    # synthesise the page list instead of waiting for the trailing directories
+                    start = page["ranges"][0][0]
+                    plane_bytes = sum(count for _, count in page["ranges"])
+                    for z in range(planes):
+                        self._add_page(dict(page, ranges=[(start + z * plane_bytes, plane_bytes)]))
+                    self._total = planes
+                    self._next_ifd = 0
+                    break
+            elif (page["shape"], page["dtype"]) != (self._first["shape"], self._first["dtype"]):
+                logger.debug(f"Skipping page of shape {page['shape']} in {self.part_path}")
+                continue
+            self._add_page(page)
+        if self._total is None and self._header is not None and not self._next_ifd:
+            self._total = self._page_count
+
+    def _add_page(self, page):
+        z = self._page_count
+        self._page_count += 1
+        if z // self.chunks[0] not in self._slabs_done:
+            self._pages.append(dict(page, z=z))
+
+    # decoding
+
+    def _decode_block(self, raw, page, shape):
+        data = raw if page["compression"] == 1 else tifffile.TIFF.DECOMPRESSORS[page["compression"]](raw)
+        block = np.frombuffer(data, dtype=page["dtype"])[:int(np.prod(shape))].reshape(shape)
+        if page["predictor"] == 2:
+            block = np.cumsum(block, axis=1, dtype=block.dtype)
+        return block
+
+    def _decode_page(self, page):
+        height, width, spp = page["shape"]
+        block_h, block_w = page["block"]
+        plane = np.empty((height, width, spp), dtype=page["dtype"])
+        across = -(-width // block_w)
+        if page["compression"] == 1 and not page["tiled"] and len(page["ranges"]) == 1:
+            offset, _ = page["ranges"][0]
+            raw = self._read(offset, height * width * spp * page["dtype"].itemsize)
+            plane[:] = np.frombuffer(raw, dtype=page["dtype"]).reshape(plane.shape)
+        else:
+            for i, (offset, count) in enumerate(page["ranges"]):
+                raw = self._read(offset, count)
+                if page["tiled"]:
+                    y, x = (i // across) * block_h, (i % across) * block_w
+                    block = self._decode_block(raw, page, (block_h, block_w, spp))
+                    plane[y:y + block_h, x:x + block_w] = block[:height - y, :width - x]
+                else:
+                    y = i * block_h
+                    rows = min(block_h, height - y)
+                    plane[y:y + rows] = self._decode_block(raw, page, (rows, width, spp))
+        return plane[..., 0] if spp == 1 else plane
+
+    def _page_ready(self, page):
+        with self._lock:
+            return all(self._have(offset, offset + count) for offset, count in page["ranges"])
+
+    # output
+
+    def _open_array(self, page):
+        height, width, spp = page["shape"]
+        plane_shape = (height, width) if spp == 1 else (height, width, spp)
+        chunks = (self.chunks[0], min(self.chunks[1], height), min(self.chunks[2], width)) + plane_shape[2:]
+        kwargs = {} if self.compressor == "default" else {"compressor": self.compressor}
+        array = zarr.open_array(self.zarr_path, mode="a", shape=(0,) + plane_shape, chunks=chunks,
+                                dtype=page["dtype"].newbyteorder("="), **kwargs)
+        if array.shape[1:] != plane_shape or array.dtype != page["dtype"].newbyteorder("="):
+            array = zarr.open_array(self.zarr_path, mode="w", shape=(0,) + plane_shape, chunks=chunks,
+                                    dtype=page["dtype"].newbyteorder("="), **kwargs)
+        self._array = array
+        self._slabs_done = set(array.attrs.get("slabs_done", []))
+
+    def _put_plane(self, z, plane):
+        slab = z // self.chunks[0]
+        if slab not in self._slabs:
+            self._slabs[slab] = (np.empty((self.chunks[0],) + plane.shape, dtype=plane.dtype), set())
+        buffer, filled = self._slabs[slab]
+        buffer[z % self.chunks[0]] = plane
+        filled.add(z)
+
+    def _flush_slabs(self, final=False):
+        for slab in sorted(self._slabs):
+            buffer, filled = self._slabs[slab]
+            start = slab * self.chunks[0]
+            stop = start + self.chunks[0] if self._total is None else min(start + self.chunks[0], self._total)
+            if len(filled) < stop - start and not final:
+                continue
+            if len(filled) < stop - start:
+                raise IOError(f"{self.part_path}: planes missing from slab {slab}")
+            if stop > self._array.shape[0]:
+                self._array.resize((stop,) + self._array.shape[1:])
+            self._array[start:stop] = buffer[:stop - start]
+            self._slabs_done.add(slab)
+            self._array.attrs["slabs_done"] = sorted(self._slabs_done)
+            del self._slabs[slab]
+
+    def _advance(self, streaming):
+        try:
+            self._discover()
+        except _NeedBytes:
+            pass
+        remaining = []
+        for page in self._pages:
+            if self._page_ready(page):
+                self._put_plane(page["z"], self._decode_page(page))
+                self.planes_decoded += 1
+                self.planes_streamed += streaming
+            else:
+                remaining.append(page)
+        self._pages = remaining
+        if self._array is not None:
+            self._flush_slabs()
+
+    def _run(self):
+        seen = 0
+        while True:
+            with self._lock:
+                self._wake.wait_for(lambda: self._stopping or self._arrivals != seen)
+                if self._stopping:
+                    return
+                seen = self._arrivals
+            with self._work_lock:
+                try:
+                    self._advance(streaming=True)
+                except _Unsupported as e:
+                    self._unsupported = str(e)
+                except Exception as e:
+                    self._unsupported = f"{type(e).__name__}: {e}"
+            if self._unsupported is not None:
+                logger.info(f"Streaming transcode of {self.part_path} stopped ({self._unsupported}); "
+                            f"converting after the download")
+                return
+
+    def finish(self, source_path):
+        """
+        This function completes the Zarr array from the fully downloaded file at source_path
+        and returns {"planes", "planes_streamed", "shape", "fallback"}. Pages the streaming
+        pass could not reach are decoded now; unsupported layouts are converted with tifffile.
+        """
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+        self._thread.join()
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(source_path, os.O_RDONLY)
+            self._ranges = [[0, os.fstat(self._fd).st_size]]
+
+        fallback = self._unsupported is not None
+        if not fallback:
+            try:
+                self._advance(streaming=False)
+                if self._pages or self._total is None:
+                    raise _Unsupported("pages left undecoded")
+                self._flush_slabs(final=True)
+            except (_Unsupported, _NeedBytes) as e:
+                logger.info(f"Converting {source_path} with tifffile ({e})")
+                fallback = True
+        if fallback:
+            self._convert_with_tifffile(source_path)
+
+        self._array.resize((self._total,) + self._array.shape[1:])
+        self._array.attrs.update(complete=True, planes=self._total)
+        self.close()
+        return {"planes": self._total, "planes_streamed": self.planes_streamed,
+                "shape": self._array.shape, "fallback": fallback}
+
+    def _convert_with_tifffile(self, source_path):
+        with tifffile.TiffFile(source_path) as tif:
+            pages = [p for p in tif.pages if not (p.subfiletype & 1)]
+            first = pages[0]
+            pages = [p for p in pages if p.shape == first.shape and p.dtype == first.dtype]
+            plane_shape = first.shape
+            if self._array is None or self._array.shape[1:] != plane_shape:
+                if os.path.exists(self.zarr_path):
+                    shutil.rmtree(self.zarr_path)
+                height, width = plane_shape[:2]
+                spp = plane_shape[2] if len(plane_shape) == 3 else 1
+                self._open_array({"shape": (height, width, spp), "dtype": first.dtype})
+            self._slabs = {}
+            self._total = len(pages)
+            for z, page in enumerate(pages):
+                if z // self.chunks[0] not in self._slabs_done:
+                    self._put_plane(z, page.asarray())
+                    self._flush_slabs()
+            self._flush_slabs(final=True)
+
+    def close(self):
+        with self._lock:
+            self._stopping = True
+            self._wake.notify()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+def _transcode_current(zarr_path, url, head):
+    try:
+        attrs = zarr.open_array(zarr_path, mode="r").attrs
+    except Exception:
+        return False
+    if not attrs.get("complete") or attrs.get("source_url") != url:
+        return False
+    if head is None:
+        return True
+    if head["etag"] and attrs.get("source_etag"):
+        return head["etag"] == attrs["source_etag"]
+    return head["size"] is not None and head["size"] == attrs.get("source_size")
+
+
+def download_transcoded(engine, url, filepath, manifest=None, keep_original=True,
+                        chunks=DEFAULT_TRANSCODE_CHUNKS):
+    """
+    This function downloads url to filepath with the download engine and, for TIFF files,
+    writes a chunked, compressed Zarr copy next to it (same name, .zarr) while the bytes
+    arrive. keep_original=False deletes the TIFF once the Zarr copy is complete. A Zarr copy
+    that is complete and whose source still matches the remote ETag or size is not
+    downloaded again. Returns the engine's result dict with "zarr_path" and "transcode"
+    (the finish() stats) added.
+    """
+    if not is_tiff(filepath):
+        return engine.download(url, filepath, manifest)
+    zarr_path = os.path.splitext(filepath)[0] + ".zarr"
+    if os.path.exists(zarr_path) and (not keep_original or os.path.exists(filepath)):
+        if _transcode_current(zarr_path, url, engine.head(url)):
+            return {"url": url, "path": filepath, "bytes": 0, "transferred": 0, "resumed_from": 0,
+                    "segments": 0, "skipped": True, "checksum": None, "checksum_algorithm": None,
+                    "etag": None, "last_modified": None, "seconds": 0.0, "error": None,
+                    "zarr_path": zarr_path, "transcode": None}
+
+    start_time = time.time()
+    transcoder = TiffZarrTranscoder(filepath + PART_SUFFIX, zarr_path, chunks)
+    result = engine.download(url, filepath, manifest, observer=transcoder)
+    result["zarr_path"] = zarr_path
+    result["transcode"] = None
+    if result["error"] is not None:
+        transcoder.close()
+        return result
+    try:
+        stats = transcoder.finish(filepath)
+        attrs = zarr.open_array(zarr_path, mode="r+").attrs
+        attrs.update(source_url=url, source_etag=result["etag"], source_size=result["bytes"] or None,
+                     source_checksum=result["checksum"])
+        stats["seconds_after_download"] = time.time() - start_time - result["seconds"]
+        result["transcode"] = stats
+        if not keep_original:
+            os.remove(filepath)
+    except Exception as e:
+        transcoder.close()
+        result["error"] = e
+        logger.error(f"Failed to transcode {filepath} to {zarr_path}: {e}", exc_info=True)
+    return result
+
+
+__all__ = ["TiffZarrTranscoder", "download_transcoded", "is_tiff", "DEFAULT_TRANSCODE_CHUNKS"]
@@ -0,0 +1,75 @@
+"""
+img_dataset_tools.tiff_writer
+
+This script contains the TIFF output settings shared by every scraper that writes TIFF. Planes
+are written in tiles so later reads can address a sub-region without decoding whole planes, the
+tiles are compressed with zstd, deflate or LZW, and tifffile encodes them on a pool of threads.
+Files larger than a classic TIFF can hold are written as BigTIFF.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import logging
+import os
+
+import numpy as np
+import tifffile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIFF_COMPRESSION = "zstd"
+DEFAULT_TIFF_TILE = 256
+TIFF_COMPRESSIONS = ("zstd", "deflate", "lzw", None)
+BIGTIFF_THRESHOLD = 2 ** 32 - 2 ** 25   # bytes; classic TIFF offsets are 32 bit
+
+
+def _codec_available(compression):
+    # deflate falls back to zlib inside tifffile; zstd and lzw encoders come from imagecodecs
+    if compression in (None, "deflate"):
+        return True
+    try:
+        import imagecodecs
+    except ImportError:
+        return False
+    return hasattr(imagecodecs, f"{compression}_encode")
+
+
+def tiff_write_options(plane_shape, compression=DEFAULT_TIFF_COMPRESSION, level=None,
+                       tile=DEFAULT_TIFF_TILE, workers=None):
+    """
+    This function returns the keyword arguments for tifffile's write/imwrite for planes of
+    plane_shape (..., y, x): square tiles of up to tile pixels (multiples of 16, as TIFF
+    requires; strips for planes smaller than that), the compression codec at level and
+    workers encoder threads (default: every core). A codec whose encoder is not installed
+    is replaced by deflate.
+    """
+    if compression not in TIFF_COMPRESSIONS:
+        raise ValueError(f"Unknown TIFF compression {compression!r}, choose from {TIFF_COMPRESSIONS}")
+    if not _codec_available(compression):
+        logger.warning(f"No {compression} encoder installed (pip install imagecodecs), using deflate")
+        compression = "deflate"
+
+    y_size, x_size = plane_shape[-2:]
+    options = {"maxworkers": workers or os.cpu_count() or 1}
+    if y_size >= 16 and x_size >= 16:
+        options["tile"] = (min(tile, y_size // 16 * 16), min(tile, x_size // 16 * 16))
+    if compression is not None:
+        options["compression"] = compression
+        if level is not None:
+            options["compressionargs"] = {"level": level}
+    return options
+
+
+def write_tiff(path, data, compression=DEFAULT_TIFF_COMPRESSION, level=None,
+               tile=DEFAULT_TIFF_TILE, workers=None):
+    """
+    This function saves a (..., y, x) array as a tiled, compressed TIFF with one page per
+    plane, switching to BigTIFF for data beyond the 4 GB TIFF limit.
+    """
+    data = np.asarray(data)
+    options = tiff_write_options(data.shape, compression, level, tile, workers)
+    tifffile.imwrite(path, data, bigtiff=data.nbytes >= BIGTIFF_THRESHOLD, **options)
+
+
+__all__ = ["tiff_write_options", "write_tiff", "DEFAULT_TIFF_COMPRESSION", "DEFAULT_TIFF_TILE",
+           "TIFF_COMPRESSIONS"]
@@ -0,0 +1,326 @@
+"""
+img_dataset_tools.transfer_budget
+
+This script contains the transfer budget that every scraper draws its network connections from.
+One budget per process caps the total number of open connections and the number per host, and
+an optional token bucket caps bytes per second. With a lock directory the same caps are shared
+by every process on the node through slot files held with file locks, so several downloader
+processes together stay inside the limits a remote server tolerates.
+
+HTTP transfers take a slot per request, Zarr stores per stored object read, OMERO per
+connection in use and CloudVolume cutouts reserve as many slots as CloudVolume opens threads
+for them, a share of the host's slots that leaves room for the other cutouts in flight. The
+time spent waiting for a slot or for tokens is recorded in stats().
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import numpy as np
+
+from .neuroglancer_utils import volume_grid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET_DIR = os.path.join(os.path.expanduser("~"), ".cache", "img_dataset_tools", "budget")
+DEFAULT_MAX_CONNECTIONS = 32
+DEFAULT_HOST_CONNECTIONS = 8
+CLOUDVOLUME_THREADS = 20     # threads CloudVolume starts by default for the chunks of one cutout
+POLL_INTERVAL = 0.05         # seconds between attempts on busy slot files
+BUCKET_STATE_NAME = "bucket.state"
+
+
+def _release_files(fds):
+    for fd in fds:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def budget_host(url):
+    """
+    This function returns the key hosts are budgeted by: the network location of url
+    (server, or bucket for s3:// and gs:// paths).
+    """
+    parsed = urlparse(url)
+    return parsed.netloc or parsed.path.split("/")[0] or url
+
+
+class TransferBudget:
+    """
+    Connection and bandwidth budget. At most max_connections connections are open at once,
+    at most per_host of them to one host, and with bytes_per_second set, transfers are slowed
+    to that rate (bursts of up to one second of traffic). lock_dir shares all three limits
+    with the other processes using the same directory; None keeps them within this process.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, per_host=DEFAULT_HOST_CONNECTIONS,
+                 bytes_per_second=None, lock_dir=DEFAULT_BUDGET_DIR):
+        self.max_connections = max(1, max_connections)
+        self.per_host = max(1, per_host)
+        self.bytes_per_second = bytes_per_second
+        self.lock_dir = lock_dir
+        if lock_dir is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+        self._cond = threading.Condition()
+        self._in_use = 0
+        self._host_in_use = defaultdict(int)
+        self._bucket_lock = threading.Lock()
+        self._tokens = float(bytes_per_second or 0)
+        self._refilled = time.monotonic()
+        self._counters = {"connections": 0, "wait_seconds": 0.0, "max_wait": 0.0,
+                          "throttled_bytes": 0, "throttle_seconds": 0.0}
+        self._hosts = defaultdict(lambda: {"connections": 0, "wait_seconds": 0.0})
+
+    def _clamp(self, count):
+        return max(1, min(count, self.max_connections, self.per_host))
+
+    def _gather_slot_files(self, gate, names, count):
+        """
+        Hold count of the slot files in names. Slots are kept as they come free, so a
+        request for several is not starved by a stream of single-slot users; the gate file
+        lets one thread of one process gather at a time, which rules out two partly held
+        sets waiting on each other.
+        """
+        gate_fd = os.open(os.path.join(self.lock_dir, gate), os.O_RDWR | os.O_CREAT, 0o644)
+        held = {}
+        try:
+            fcntl.flock(gate_fd, fcntl.LOCK_EX)
+            while True:
+                for name in names:
+                    if name in held:
+                        continue
+                    fd = os.open(os.path.join(self.lock_dir, name), os.O_RDWR | os.O_CREAT, 0o644)
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        os.close(fd)
+                        continue
+                    held[name] = fd
+                    if len(held) == count:
+                        return list(held.values())
+                time.sleep(POLL_INTERVAL)
+        except BaseException:
+            _release_files(held.values())
+            raise
+        finally:
+            fcntl.flock(gate_fd, fcntl.LOCK_UN)
+            os.close(gate_fd)
+
+    def _acquire_files(self, host, count):
+        # host slots first: whoever waits for total slots then holds no partial total set
+        host_tag = hashlib.sha1(host.encode()).hexdigest()[:12]
+        hosts = self._gather_slot_files(f"host.{host_tag}.gate", [f"host.{host_tag}.{i}.lock"
+                                                                  for i in range(self.per_host)], count)
+        try:
+            return hosts + self._gather_slot_files("total.gate", [f"total.{i}.lock"
+                                                                  for i in range(self.max_connections)], count)
+        except BaseException:
+            _release_files(hosts)
+            raise
+
+    @contextmanager
+    def connection(self, url, count=1):
+        """
+        This context manager holds count connection slots (clamped to the caps) for the
+        host of url while the block runs, waiting as long as the budget is exhausted.
+        """
+        host = budget_host(url)
+        count = self._clamp(count)
+        start_time = time.monotonic()
+        with self._cond:
+            while (self._in_use + count > self.max_connections
+                   or self._host_in_use[host] + count > self.per_host):
+                self._cond.wait()
+            self._in_use += count
+            self._host_in_use[host] += count
+        fds = []
+        try:
+            if self.lock_dir is not None:
+                fds = self._acquire_files(host, count)
+            waited = time.monotonic() - start_time
+            with self._cond:
+                self._counters["connections"] += 1
+                self._counters["wait_seconds"] += waited
+                self._counters["max_wait"] = max(self._counters["max_wait"], waited)
+                self._hosts[host]["connections"] += 1
+                self._hosts[host]["wait_seconds"] += waited
+            yield
+        finally:
+            _release_files(fds)
+            with self._cond:
+                self._in_use -= count
+                self._host_in_use[host] -= count
+                self._cond.notify_all()
+
+    def _take_tokens(self, nbytes):
+        # returns how long the caller has to wait for nbytes; the bucket may go into debt
+        rate = self.bytes_per_second
+        if self.lock_dir is None:
+            with self._bucket_lock:
+                now = time.monotonic()
+                self._tokens = min(rate, self._tokens + (now - self._refilled) * rate) - nbytes
+                self._refilled = now
+                return max(0.0, -self._tokens / rate)
+
+        with open(os.path.join(self.lock_dir, BUCKET_STATE_NAME), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                data = f.read(16)
+                now = time.time()
+                tokens, refilled = struct.unpack("<dd", data) if len(data) == 16 else (rate, now)
+                tokens = min(rate, tokens + max(0.0, now - refilled) * rate) - nbytes
+                f.truncate(0)
+                f.write(struct.pack("<dd", tokens, now))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return max(0.0, -tokens / rate)
+
+    def throttle(self, nbytes):
+        """
+        This function charges nbytes against the bytes/sec limit and sleeps until the
+        bucket allows them. Without a limit it returns at once.
+        """
+        if not self.bytes_per_second or nbytes <= 0:
+            return
+        delay = self._take_tokens(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+        with self._cond:
+            self._counters["throttled_bytes"] += nbytes
+            self._counters["throttle_seconds"] += delay
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats["hosts"] = {host: dict(counts) for host, counts in self._hosts.items()}
+        stats["mean_wait"] = stats["wait_seconds"] / stats["connections"] if stats["connections"] else 0.0
+        return stats
+
+
+_default_budget = None
+_default_lock = threading.Lock()
+
+
+def default_budget():
+    """
+    This function returns the process-wide TransferBudget, created with the default
+    limits on first use.
+    """
+    global _default_budget
+    with _default_lock:
+        if _default_budget is None:
+            _default_budget = TransferBudget()
+        return _default_budget
+
+
+def configure_budget(**kwargs):
+    """
+    This function replaces the process-wide TransferBudget with one built from kwargs
+    (max_connections, per_host, bytes_per_second, lock_dir) and returns it. Call it before
+    the scrapers start.
+    """
+    global _default_budget
+    with _default_lock:
+        _default_budget = TransferBudget(**kwargs)
+        return _default_budget
+
+
+class BudgetedMapping(Mapping):
+    """
+    Wraps an fsspec mapper so that every stored object read takes a connection slot for
+    url's host and is charged against the bytes/sec limit.
+    """
+
+    def __init__(self, mapper, url, budget=None):
+        self.mapper = mapper
+        self.url = url
+        self.budget = budget or default_budget()
+
+    def __getitem__(self, key):
+        with self.budget.connection(self.url):
+            data = self.mapper[key]
+        self.budget.throttle(len(data))
+        return data
+
+    def __iter__(self):
+        return iter(self.mapper)
+
+    def __len__(self):
+        return len(self.mapper)
+
+    def __contains__(self, key):
+        return key in self.mapper
+
+
+def limit_cloudvolume_threads(threads):
+    """
+    This function sets how many threads CloudVolume downloads the chunks of one cutout
+    with. CloudVolume reads the count from a module constant, so it applies to every
+    cutout in the process.
+    """
+    try:
+        from cloudvolume.datasource.precomputed.image import rx
+    except ImportError:
+        return
+    rx.DEFAULT_THREADS = max(1, int(threads))
+
+
+class BudgetedVolume:
+    """
+    Wraps a CloudVolume so that each cutout (slicing or download()) reserves as many
+    connection slots as CloudVolume will use threads for it, and is charged against the
+    bytes/sec limit by its decoded size, which over-counts compressed encodings. With
+    workers cutouts in flight at once (e.g. the fetch threads of stream_crop), each one
+    gets an equal share of the host's slots, and CloudVolume's thread count is set to that
+    share.
+    """
+
+    def __init__(self, volume, budget=None, workers=1):
+        self.volume = volume
+        self.budget = budget or default_budget()
+        slots = min(CLOUDVOLUME_THREADS, self.budget.per_host, self.budget.max_connections)
+        self.threads = max(1, slots // max(1, workers))
+        limit_cloudvolume_threads(self.threads)
+
+    def __getattr__(self, name):
+        return getattr(self.volume, name)
+
+    def _chunks(self, slices):
+        try:
+            chunk_size, voxel_offset, upper = volume_grid(self.volume)
+            lo = np.array([s.start for s in slices], dtype=int)
+            hi = np.array([s.stop for s in slices], dtype=int)
+            return int(np.prod((hi - 1 - voxel_offset) // chunk_size - (lo - voxel_offset) // chunk_size + 1))
+        except (AttributeError, TypeError, ValueError):
+            return self.threads
+
+    def _read(self, count, read):
+        with self.budget.connection(self.volume.cloudpath, min(count, self.threads)):
+            data = read()
+        self.budget.throttle(getattr(data, "nbytes", 0))
+        return data
+
+    def __getitem__(self, slices):
+        count = self._chunks(slices) if isinstance(slices, tuple) and len(slices) >= 3 else self.threads
+        return self._read(count, lambda: self.volume[slices])
+
+    def download(self, *args, **kwargs):
+        return self._read(self.threads, lambda: self.volume.download(*args, **kwargs))
+
+
+__all__ = ["TransferBudget", "BudgetedMapping", "BudgetedVolume", "default_budget", "configure_budget",
+           "budget_host", "limit_cloudvolume_threads", "DEFAULT_BUDGET_DIR", "DEFAULT_MAX_CONNECTIONS",
+           "DEFAULT_HOST_CONNECTIONS"]
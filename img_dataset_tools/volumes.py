@@ -0,0 +1,446 @@
+"""
+img_dataset_tools.volumes
+
+This script contains open_volume(), one lazy access path for every dataset format the project
+saves or catalogs. The returned volume has shape, dtype, chunks and resolution_nm and can be
+sliced like a NumPy array, reading only the bytes the slice needs: uncompressed TIFF and DM3
+image data is memory-mapped, compressed or tiled TIFF pages are read and decoded strip by strip
+or tile by tile, Zarr arrays (including OME-Zarr and COSEM multiscale groups) read their native
+chunks, and precomputed volumes fetch their chunks through the transfer budget and chunk cache.
+A consumer can walk metadata_table.csv and open every file_path the same way.
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import atexit
+import logging
+import os
+
+import numpy as np
+import tifffile
+import zarr
+from cloudvolume import CloudVolume
+
+from . import dm3_lib as dm3
+from .chunk_cache import CachedVolume, DEFAULT_CHUNK_CACHE_DIR, open_chunk_cache
+from .metadata_utils import dm3_image_layout, dm3_resolution_nm, flatten_dm3_dict, tiff_resolution_nm
+from .neuroglancer_utils import cutout_to_zyx
+from .transfer_budget import BudgetedVolume
+
+logger = logging.getLogger(__name__)
+
+REMOTE_SCHEMES = ("precomputed://", "gs://", "s3://", "http://", "https://")
+UNIT_TO_NM = {"nanometer": 1.0, "nm": 1.0, "micrometer": 1e3, "um": 1e3, "µm": 1e3, "angstrom": 0.1}
+
+# resolutions (nm, x y z) of Zarr arrays known from outside sources, matched against the path
+KNOWN_ZARR_RESOLUTIONS_NM = {
+    "recon-2": (4, 4, 2.96),
+}
+
+
+def _index_box(key, shape):
+    # splits a basic NumPy index into the bounding box to read (lo, hi per axis) and the
+    # index that cuts the result out of that box
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        at = next(i for i, k in enumerate(key) if k is Ellipsis)
+        key = key[:at] + (slice(None),) * (len(shape) - len(key) + 1) + key[at + 1:]
+    if len(key) > len(shape):
+        raise IndexError(f"too many indices for a volume of {len(shape)} dimensions")
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    lo, hi, post = [], [], []
+    for k, n in zip(key, shape):
+        if isinstance(k, (int, np.integer)):
+            i = int(k) + n if k < 0 else int(k)
+            if not 0 <= i < n:
+                raise IndexError(f"index {k} is out of bounds for axis with size {n}")
+            lo.append(i), hi.append(i + 1), post.append(0)
+        elif isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            count = len(range(start, stop, step))
+            if count == 0:
+                lo.append(0), hi.append(0), post.append(slice(0, 0))
+                continue
+            last = start + (count - 1) * step
+            a, b = min(start, last), max(start, last) + 1
+            lo.append(a), hi.append(b)
+            post.append(slice(start - a, last - a + 1, step) if step > 0 else slice(start - a, None, step))
+        else:
+            raise TypeError(f"volumes support integer and slice indexing only, not {type(k).__name__}")
+    return lo, hi, tuple(post)
+
+
+class Volume:
+    """
+    Lazy, chunked, NumPy-indexable view of one stored image. shape, dtype and chunks follow
+    the stored layout; resolution_nm has one entry per axis in the same order (None where
+    the axis isn't spatial or its resolution isn't known). Slicing with integers and slices
+    returns a NumPy array and reads only what the slice covers.
+    """
+    format = None
+
+    def __init__(self, path, shape, dtype, chunks, resolution_nm):
+        self.path = path
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.chunks = tuple(int(c) for c in chunks)
+        self.resolution_nm = tuple(resolution_nm)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def _read(self, lo, hi):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        lo, hi, post = _index_box(key, self.shape)
+        if any(b <= a for a, b in zip(lo, hi)):
+            return np.empty(tuple(b - a for a, b in zip(lo, hi)), dtype=self.dtype)[post]
+        return self._read(lo, hi)[post]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def chunk_slices(self, chunks=None):
+        """
+        This function yields the slices of every block of the chunk grid (chunks, default:
+        the stored chunks) in C order, clipped to the volume.
+        """
+        chunks = tuple(chunks or self.chunks)
+        grid = [range(0, n, c) for n, c in zip(self.shape, chunks)]
+        for start in np.ndindex(*(len(g) for g in grid)):
+            yield tuple(slice(g[i], min(g[i] + c, n)) for g, i, c, n in zip(grid, start, chunks, self.shape))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return (f"<{type(self).__name__} {self.format} {self.shape} {self.dtype} chunks={self.chunks} "
+                f"resolution_nm={self.resolution_nm} {self.path}>")
+
+
+class MemmapVolume(Volume):
+    """
+    Uncompressed, contiguous image data read through a read-only memory map.
+    """
+
+    def __init__(self, path, format, offset, shape, dtype, chunks, resolution_nm, native_dtype=None):
+        super().__init__(path, shape, native_dtype or dtype, chunks, resolution_nm)
+        self.format = format
+        self.offset = offset
+        self._map = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=self.shape)
+
+    def _read(self, lo, hi):
+        data = self._map[tuple(slice(a, b) for a, b in zip(lo, hi))]
+        return np.array(data, dtype=self.dtype)
+
+    def close(self):
+        mmap = getattr(self._map, "_mmap", None)
+        self._map = None
+        if mmap is not None:
+            mmap.close()
+
+
+class TiffVolume(Volume):
+    """
+    A TIFF series read page by page and, within a page, strip by strip or tile by tile:
+    only the segments a slice touches are read (with pread) and decoded. Each page is
+    one chunk along the leading axes.
+    """
+    format = "TIFF"
+
+    def __init__(self, path, tif, series, resolution_nm):
+        keyframe = series.keyframe
+        self._pages = [page for page in series.pages if page is not None]
+        page_shape = tuple(keyframe.shape)
+        lead = tuple(series.shape[:len(series.shape) - len(page_shape)])
+        if tuple(series.shape[len(lead):]) != page_shape or int(np.prod(lead)) != len(self._pages):
+            raise ValueError(f"{path}: series {series.shape} isn't a stack of {len(self._pages)} pages "
+                             f"of {page_shape}")
+        self._lead = lead
+        self._keyframe = keyframe
+        self._decode = keyframe.decode
+        self._shaped = tuple(keyframe.shaped)           # (samples, depth, length, width, contig samples)
+        names = [name for name, n in zip("SDLWC", self._shaped) if name in "LW" or n > 1]
+        if len(names) != len(page_shape):
+            raise ValueError(f"{path}: can't map page shape {page_shape} onto {self._shaped}")
+        self._names = names
+        if keyframe.is_tiled:
+            segment = {"D": keyframe.tiledepth, "L": keyframe.tilelength, "W": keyframe.tilewidth}
+        else:
+            segment = {"D": 1, "L": min(keyframe.rowsperstrip or self._shaped[2], self._shaped[2]),
+                       "W": self._shaped[3]}
+        self._segment = segment
+        chunks = (1,) * len(lead) + tuple(segment.get(name, n) if name != "S" else 1
+                                          for name, n in zip(names, page_shape))
+        super().__init__(path, series.shape, series.dtype, chunks, resolution_nm)
+        self._jpegtables = getattr(keyframe, "jpegtables", None)
+        self._fd = os.open(path, os.O_RDONLY)
+        self._tif = tif
+
+    def _segment_indices(self, box):
+        # segment index of every strip / tile that intersects the normalized page box
+        S, D, L, W, C = self._shaped
+        sd, sl, sw = self._segment["D"], self._segment["L"], self._segment["W"]
+        nd, nl, nw = -(-D // sd), -(-L // sl), -(-W // sw)
+        (s0, s1), (d0, d1), (l0, l1), (w0, w1) = box[:4]
+        for s in range(s0, s1):
+            for d in range(d0 // sd, (d1 - 1) // sd + 1):
+                for y in range(l0 // sl, (l1 - 1) // sl + 1):
+                    for x in range(w0 // sw, (w1 - 1) // sw + 1):
+                        yield ((s * nd + d) * nl + y) * nw + x
+
+    def _read_page(self, page, box):
+        out = np.zeros(tuple(b - a for a, b in box), dtype=self.dtype)
+        for index in self._segment_indices(box):
+            offset, count = page.dataoffsets[index], page.databytecounts[index]
+            data = os.pread(self._fd, count, offset) if count else None
+            segment, position, shape = self._decode(data, index, jpegtables=self._jpegtables)
+            if segment is None:
+                continue
+            segment = segment.reshape((1,) + tuple(shape))
+            start = (position[0], position[1], position[2], position[3], 0)
+            lo = [max(a, p) for (a, _), p in zip(box, start)]
+            hi = [min(b, p + n) for (_, b), p, n in zip(box, start, segment.shape)]
+            if any(h <= l for l, h in zip(lo, hi)):
+                continue
+            out[tuple(slice(l - a, h - a) for l, h, (a, _) in zip(lo, hi, box))] = \
+                segment[tuple(slice(l - p, h - p) for l, h, p in zip(lo, hi, start))]
+        return out
+
+    def _read(self, lo, hi):
+        n_lead = len(self._lead)
+        page_lo, page_hi = lo[n_lead:], hi[n_lead:]
+        box = [[0, n] for n in self._shaped]
+        for name, a, b in zip(self._names, page_lo, page_hi):
+            box["SDLWC".index(name)] = [a, b]
+        out = np.empty(tuple(b - a for a, b in zip(lo, hi)), dtype=self.dtype)
+        page_out_shape = out.shape[n_lead:]
+        for lead_index in np.ndindex(*(b - a for a, b in zip(lo[:n_lead], hi[:n_lead]))):
+            number = int(np.ravel_multi_index(tuple(a + i for a, i in zip(lo, lead_index)), self._lead)) \
+                if n_lead else 0
+            out[lead_index] = self._read_page(self._pages[number], box).reshape(page_out_shape)
+        return out
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+
+
+class ZarrVolume(Volume):
+    """
+    A Zarr array; slices read only the native chunks they cover.
+    """
+    format = "ZARR"
+
+    def __init__(self, path, array, resolution_nm):
+        super().__init__(path, array.shape, array.dtype, array.chunks, resolution_nm)
+        self.array = array
+
+    def _read(self, lo, hi):
+        return self.array[tuple(slice(a, b) for a, b in zip(lo, hi))]
+
+
+class PrecomputedVolume(Volume):
+    """
+    A Neuroglancer precomputed volume at one mip, in (z, y, x) order, or (c, z, y, x) for
+    multi-channel data, like the crops saved from it. Reads take connections from the
+    transfer budget and go through the chunk cache.
+    """
+    format = "PRECOMPUTED"
+
+    def __init__(self, url, mip=0, chunk_cache=DEFAULT_CHUNK_CACHE_DIR):
+        volume = CloudVolume(url, mip=mip, use_https=True, fill_missing=True, progress=False)
+        self._offset = np.array(volume.voxel_offset[:3], dtype=int)
+        x, y, z = (int(n) for n in volume.shape[:3])
+        cx, cy, cz = (int(n) for n in volume.chunk_size[:3])
+        rx, ry, rz = (float(r) for r in volume.resolution[:3])
+        channels = int(volume.num_channels)
+        shape, chunks, resolution = (z, y, x), (cz, cy, cx), (rz, ry, rx)
+        if channels > 1:
+            shape, chunks, resolution = (channels,) + shape, (channels,) + chunks, (None,) + resolution
+        super().__init__(url, shape, volume.dtype, chunks, resolution)
+        self._channels = channels
+        volume = BudgetedVolume(volume)
+        cache = open_chunk_cache(chunk_cache)
+        self.volume = CachedVolume(volume, cache) if cache is not None else volume
+
+    def _read(self, lo, hi):
+        if self._channels > 1:
+            channels, lo, hi = slice(lo[0], hi[0]), lo[1:], hi[1:]
+        start = self._offset + np.array(lo[::-1])
+        stop = self._offset + np.array(hi[::-1])
+        data = cutout_to_zyx(self.volume[int(start[0]):int(stop[0]), int(start[1]):int(stop[1]),
+                                         int(start[2]):int(stop[2])])
+        return data[channels] if self._channels > 1 else data
+
+
+def _axes_resolution(axes, x_res, y_res, z_res):
+    # one entry per tifffile axis: X, Y and the plane axis (Z, or a single unnamed one) are spatial
+    planes = [a for a in axes if a not in "XYSCT"]
+    resolution = []
+    for axis in axes:
+        if axis == "X":
+            resolution.append(x_res)
+        elif axis == "Y":
+            resolution.append(y_res)
+        elif axis == "Z" or (len(planes) == 1 and axis == planes[0]):
+            resolution.append(z_res)
+        else:
+            resolution.append(None)
+    return tuple(resolution)
+
+
+def _open_tiff(path):
+    tif = tifffile.TiffFile(path)
+    try:
+        series = tif.series[0]
+        x_res, y_res, z_res = tiff_resolution_nm(path, series.keyframe)
+        resolution = _axes_resolution(series.axes, x_res, y_res, z_res)
+        page_shape = tuple(series.keyframe.shape)
+        if series.dataoffset is not None and series.keyframe.compression == 1:
+            chunks = (1,) * (len(series.shape) - len(page_shape)) + page_shape
+            file_dtype = np.dtype(series.dtype).newbyteorder(tif.byteorder)
+            volume = MemmapVolume(path, "TIFF", series.dataoffset, series.shape, file_dtype, chunks, resolution,
+                                  native_dtype=series.dtype)
+            tif.close()
+            return volume
+        return TiffVolume(path, tif, series, resolution)
+    except Exception:
+        tif.close()
+        raise
+
+
+def _open_dm3(path):
+    dm3_data = dm3.DM3(path)
+    try:
+        shape, dtype, offset, _ = dm3_image_layout(dm3_data)
+        x_res, y_res = dm3_resolution_nm(path, flatten_dm3_dict(dm3_data.tags))
+    finally:
+        dm3_data.close()
+    resolution = (y_res, x_res) if len(shape) == 2 else (None, y_res, x_res)
+    chunks = shape if len(shape) == 2 else (1,) + shape[1:]
+    return MemmapVolume(path, "DM3", offset, shape, dtype, chunks, resolution)
+
+
+def _zarr_level(group, level):
+    multiscales = group.attrs.get("multiscales")
+    if multiscales:
+        datasets = multiscales[0]["datasets"]
+        return datasets[level]["path"], datasets[level], multiscales[0].get("axes")
+    arrays = sorted(name for name, _ in group.arrays())
+    if len(arrays) == 1 and level == 0:
+        return arrays[0], None, None
+    raise ValueError(f"{group.store.path if hasattr(group.store, 'path') else group}: "
+                     f"not a multiscale group, open one of its arrays: {arrays}")
+
+
+def _zarr_resolution(path, array, dataset=None, axes=None):
+    # OME-Zarr scale transform of the level, COSEM/N5 attrs on the array, or a known value
+    ndim = array.ndim
+    if dataset is not None:
+        for transform in dataset.get("coordinateTransformations", []):
+            if transform.get("type") == "scale":
+                axes = [axis if isinstance(axis, dict) else {"name": axis, "type": "space"}
+                        for axis in (axes or [{"type": "space"}] * ndim)]
+                return tuple(float(scale) * UNIT_TO_NM.get(axis.get("unit"), 1.0)
+                             if axis.get("type") == "space" else None
+                             for scale, axis in zip(transform["scale"], axes))
+    attrs = array.attrs
+    transform = attrs.get("transform")
+    if isinstance(transform, dict) and "scale" in transform:
+        units = transform.get("units") or ["nm"] * ndim
+        return tuple(float(s) * UNIT_TO_NM.get(u, 1.0) for s, u in zip(transform["scale"], units))
+    pixel = attrs.get("pixelResolution")
+    if isinstance(pixel, dict) and "dimensions" in pixel:
+        factor = UNIT_TO_NM.get(pixel.get("unit"), 1.0)
+        return (None,) * (ndim - len(pixel["dimensions"])) + tuple(float(d) * factor for d in pixel["dimensions"][::-1])
+    for pattern, resolution in KNOWN_ZARR_RESOLUTIONS_NM.items():
+        if pattern in path:
+            return (None,) * (ndim - len(resolution)) + tuple(resolution[::-1])
+    return (None,) * ndim
+
+
+def _open_zarr(path, level):
+    node = zarr.open(path, mode="r")
+    dataset = axes = None
+    if isinstance(node, zarr.hierarchy.Group):
+        name, dataset, axes = _zarr_level(node, level)
+        path = os.path.join(path, name)
+        node = node[name]
+    return ZarrVolume(path, node, _zarr_resolution(path, node, dataset, axes))
+
+
+def open_volume(path, level=0, chunk_cache=DEFAULT_CHUNK_CACHE_DIR):
+    """
+    This function opens the image at path (a file_path of metadata_table.csv) as a lazy
+    Volume. TIFF (.tif/.tiff) and DM3 files, Zarr arrays and multiscale groups and
+    precomputed urls (gs://, s3://, http(s)://, precomputed://) are supported; level picks
+    the scale of a multiscale Zarr group or the mip of a precomputed volume.
+    """
+    if isinstance(path, str) and path.startswith(REMOTE_SCHEMES):
+        return PrecomputedVolume(path, mip=level, chunk_cache=chunk_cache)
+    path = os.fspath(path)
+    if os.path.isdir(path):
+        return _open_zarr(path, level)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".tif", ".tiff"):
+        return _open_tiff(path)
+    if ext == ".dm3":
+        return _open_dm3(path)
+    raise ValueError(f"Unsupported volume: {path}")
+
+
+_worker_volume = {}
+
+
+def worker_volume(path, level=0):
+    """
+    This function returns an open Volume of path for the blocks a pool process reads
+    one after another. The volume stays open while the blocks are of the same file;
+    asking for another file closes it first, so a process that works through a whole
+    catalog holds one file open at a time. It is not thread-safe.
+    """
+    key = (os.fspath(path), level)
+    if _worker_volume.get("key") != key:
+        close_worker_volume()
+        _worker_volume.update(key=key, volume=open_volume(path, level=level))
+    return _worker_volume["volume"]
+
+
+def close_worker_volume():
+    """
+    This function closes the volume worker_volume() keeps open, if any.
+    """
+    volume = _worker_volume.pop("volume", None)
+    _worker_volume.pop("key", None)
+    if volume is not None:
+        volume.close()
+
+
+atexit.register(close_worker_volume)
+
+
+__all__ = ["open_volume", "worker_volume", "close_worker_volume", "Volume", "MemmapVolume", "TiffVolume", "ZarrVolume", "PrecomputedVolume"]
@@ -7,36 +7,59 @@ to be used in multiprocessing_image_datasets.py.
 The overall goal of this project is to download 3D microscopy image datasets from different
 sources accessible and create an entry table of the various image metadata. 
 """
+import hashlib
 import logging
 import os 
 import time
-import requests
-from bs4 import BeautifulSoup
+from functools import partial
 from idr.connections import connection
-from tifffile import imwrite
 import numpy as np
 import zarr
 from zarr.convenience import copy_store
 import fsspec
-from selenium import webdriver
 import shutil
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
 from cloudvolume import CloudVolume
+from .downloaders import DownloadEngine, format_result
+from .manifest import DownloadManifest
+from .link_discovery import discover_links, LINK_CACHE_NAME, DEFAULT_TTL
+from .crawler import crawl_and_download
+from .omero_fetch import OmeroConnectionPool, fetch_image_stacks, stream_image_stacks, pixels_dtype
+from .plane_writers import PLANE_WRITERS, open_plane_writer
+from .neuroglancer_utils import DEFAULT_FETCH_WORKERS, DEFAULT_MEMORY_BUDGET, cutout_to_zyx, random_crop_origin, \
+    stream_crop, unfinished_crop_origin
+from .tiff_writer import DEFAULT_TIFF_COMPRESSION, write_tiff
+from .tiff_transcode import download_transcoded
+from .occupancy import OCCUPANCY_CACHE_NAME, load_or_build_occupancy
+from .chunk_cache import CachedMapping, CachedVolume, DEFAULT_CHUNK_CACHE_DIR, open_chunk_cache
+from .transfer_budget import BudgetedMapping, BudgetedVolume, default_budget
 
 logger = logging.getLogger(__name__)
 
 # FUNCTION 1: FOR DYNAMIC IMAGES
-def url_image_scrape_dynamic(url, save_directory):
+def _idr_connection():
+    # open IDR connection that can see every group
+    conn = connection(host='idr.openmicroscopy.org') 
+    conn.SERVICE_OPTS.setOmeroGroup(-1)
+    return conn
+
+
+def url_image_scrape_dynamic(url, save_directory, num_workers=3, batch_size=16, output="stack",
+                             compression=DEFAULT_TIFF_COMPRESSION):
     """
     This function downloads image datasets from the Omero dynamic website 
-    using the idr-py package. 
+    using the idr-py package. Up to num_workers (t, c) stacks are fetched at once over
+    separate connections, batch_size planes per request, in the image's native pixel type.
+
+    output="stack" assembles each stack in memory and saves it as one TIFF. output="zarr"
+    or "bigtiff" streams every plane to a chunked Zarr array or a BigTIFF page as it
+    arrives, so memory stays at a few planes and an interrupted stack is resumed.
+    TIFF output is tiled and compressed with compression ("zstd", "deflate", "lzw" or None).
     """
     start_time = time.time()
     try:
         # open IDR connection
-        conn = connection(host='idr.openmicroscopy.org') 
-        conn.SERVICE_OPTS.setOmeroGroup(-1)
+        conn = _idr_connection()
 
         # create dataset object and dataset id
         dataset_id = url.split("=")[-1]
@@ -45,6 +68,9 @@ def url_image_scrape_dynamic(url, save_directory):
         # create dataset folder to save output in
         dataset_folder = os.path.join(save_directory, "omero_" + dataset_id)
         os.makedirs(dataset_folder, exist_ok=True)
+        manifest = DownloadManifest(dataset_folder)
+
+        pool = OmeroConnectionPool(_idr_connection, size=num_workers)
 
     # Iterate through images in the dataset
         for img in tqdm(dataset.listChildren(), 
@@ -55,37 +81,75 @@ def url_image_scrape_dynamic(url, save_directory):
             c_size = img.getSizeC()
             x_size = img.getSizeX()
             y_size = img.getSizeY()
+            dtype = pixels_dtype(img)
+            shape = [z_size, y_size, x_size]
 
-            logger.info(f"Image: {name} ({z_size}Z x {c_size}C x {t_size}T)")
+            logger.info(f"Image: {name} ({z_size}Z x {c_size}C x {t_size}T, {dtype})")
 
+            def stack_path(t, c):
+                stem = f"{name.replace('/', '_')}_t{t:03}_c{c:02}"
+                ext = ".tiff" if output == "stack" else PLANE_WRITERS[output][1]
+                source = f"omero://idr.openmicroscopy.org/Image/{img.getId()}?t={t}&c={c}"
+                return os.path.join(dataset_folder, stem + ext), source
+
+            # skip stacks that a previous run already saved completely
+            todo = []
             for t in range(t_size):
                 for c in range(c_size):
-                    stack = np.zeros((z_size, y_size, x_size), dtype=np.uint8)
-                    for z in range(z_size):
-                        plane = img.getPrimaryPixels().getPlane(z,c,t)
-                        stack[z,:,:] = plane
-
-                    out_path = f"{name.replace('/', '_')}_t{t:03}_c{c:02}.tiff"
-                    filepath = os.path.join(dataset_folder, out_path)
-                    imwrite(filepath, stack)
+                    filepath, source = stack_path(t, c)
+                    if manifest.is_current(filepath, url=source, shape=shape, dtype=str(dtype)):
+                        logger.info(f"Up to date, skipped: {filepath}")
+                    else:
+                        todo.append((t, c))
+
+            if output == "stack":
+                for t, c, stack in fetch_image_stacks(pool, img, todo, batch_size=batch_size):
+                    filepath, source = stack_path(t, c)
+                    write_tiff(filepath, stack, compression)
+                    manifest.record(filepath, url=source, shape=shape, dtype=str(stack.dtype),
+                                    file_size=os.path.getsize(filepath),
+                                    checksum=hashlib.sha256(stack).hexdigest(),
+                                    checksum_algorithm="sha256-pixels")
+                    logger.info(f"Saved: {filepath}")
+            else:
+                def open_writer(t, c, stack_shape, stack_dtype):
+                    stem = os.path.splitext(stack_path(t, c)[0])[0]
+                    kwargs = {"compression": compression} if output == "bigtiff" else {}
+                    return open_plane_writer(output, stem, stack_shape, stack_dtype, **kwargs)
+
+                for t, c, writer, checksum in stream_image_stacks(pool, img, open_writer, todo,
+                                                                  batch_size=batch_size):
+                    filepath, source = stack_path(t, c)
+                    manifest.record(filepath, url=source, shape=shape, dtype=str(dtype),
+                                    file_size=writer.file_size(), checksum=checksum,
+                                    checksum_algorithm="sha256-pixels")
                     logger.info(f"Saved: {filepath}")
 
         # disconnect from IDR
+        pool.close()
         conn.close() 
 
         end_time = time.time()
         elapsed_time = (end_time - start_time)/60
 
-        logger.info(f"Download of dataset omero_{dataset_id} complete and saved to {filepath} in {elapsed_time:.2f} min")
+        logger.info(f"Download of dataset omero_{dataset_id} complete and saved to {dataset_folder} in {elapsed_time:.2f} min")
+        logger.info(f"Transfer budget: {default_budget().stats()}")
     except Exception as e:
         logger.error(f"Failed dynamic scrape from {url}: {e}", exc_info=True)
 
     
 # FUNCTION 2: FOR STATIC IMAGES 
-def url_image_scrape_static(url, save_directory): 
+def url_image_scrape_static(url, save_directory, num_workers=4, max_depth=3, patterns=("*.dm3",),
+                            transcode=False, keep_original=True): 
     """
-    This function downloads a .tif image dataset from the static Empiar webpage 
-    using beautiful soup and requests. 
+    This function downloads a .dm3 image dataset from the static Empiar webpage 
+    using beautiful soup and requests. The listing is crawled recursively (up to max_depth
+    subdirectories) and each file matching patterns is fetched through the shared download
+    engine, num_workers at a time, as soon as it is found.
+
+    With transcode, TIFF files among them are also written to a chunked, compressed Zarr
+    array (same name, .zarr) page by page while they download; keep_original=False deletes
+    the TIFF once its Zarr copy is complete.
     """
 
     start_time = time.time()
@@ -95,33 +159,22 @@ def url_image_scrape_static(url, save_directory):
         dataset_folder = os.path.join(save_directory, "empiar_" + dataset_id )
         os.makedirs(dataset_folder, exist_ok=True)
 
-        resp = requests.get(url)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-
-        hrefs = []
-        for link in soup.find_all("a"):
-            href = link.get("href")
-            if href and href.lower().endswith(".dm3"):
-            
-                hrefs.append(href)
+        # crawl the listing and download over one pooled session while it is being crawled
+        manifest = DownloadManifest(dataset_folder)
+        with DownloadEngine(max_workers=num_workers) as engine:
+            download = partial(download_transcoded, engine, keep_original=keep_original) if transcode else None
+            results = crawl_and_download(url, dataset_folder, patterns=patterns,
+                                         max_depth=max_depth, engine=engine, manifest=manifest,
+                                         desc=f"Downloading dataset empiar_{dataset_id}",
+                                         download=download)
 
-        for href in tqdm(hrefs, desc= f"Downloading dataset empiar_{dataset_id}", unit="File"):
-            
-            file_url = os.path.join(url, href)
-            filepath = os.path.join(dataset_folder, href)
-            try:
-                with requests.get(file_url, stream=True) as r:
-                    r.raise_for_status()
-                    with open(filepath, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                logger.info(f"Downloaded: {filepath}")
-            except Exception as e:
-                logger.error(f"Failed to download {file_url}: {e}", exc_info=True)
+        for result in results:
+            logger.info(format_result(result))
 
         end_time = time.time()
         elapsed_time = (end_time - start_time)/60 
         logger.info(f"Download of Empiar dataset {dataset_id} complete and saved to {dataset_folder} in {elapsed_time:.2f} min")
+        logger.info(f"Transfer budget: {default_budget().stats()}")
 
     except Exception as e:
         logger.error(f"Failed static scrape from {url}: {e}", exc_info=True)
@@ -129,69 +182,49 @@ def url_image_scrape_static(url, save_directory):
     
 # FUNCTION 3: FOR JAVASCRIPT DYNAMIC LINKS
 
-def url_image_scrape_selenium(url, save_directory, num_workers=4): 
+def url_image_scrape_selenium(url, save_directory, num_workers=4, use_browser="auto",
+                              link_cache_ttl=DEFAULT_TTL, transcode=False, keep_original=True): 
     """
-    This function retrieves the .tif image dataset on the webpage using selenium because the 
-    webpage has dynamic links. Incorporates multithreading to speed up downloads.
+    This function retrieves the .tif image dataset on the webpage, which has dynamic links.
+    The links are read from the plain HTML and embedded JavaScript first and selenium is
+    only started if that finds nothing; the link list is cached for link_cache_ttl seconds.
+    Incorporates multithreading to speed up downloads: num_workers files at a time, within
+    the connection limits of the process-wide transfer budget.
+
+    With transcode, each TIFF is also written to a chunked, compressed Zarr array (same
+    name, .zarr) page by page while it downloads, so it can be read block-wise as soon as
+    the download ends; keep_original=False deletes the TIFF once its Zarr copy is complete.
     """
 
     start_time = time.time()
     try:
-        # count number of cpus
-        cpu_count = os.cpu_count()
-        processes = cpu_count - 1
-
         # create dataset folder to save output in
         dataset_id = "mitochondria-" + url.split("/")[-2]
         dataset_folder = os.path.join(save_directory, dataset_id)
         os.makedirs(dataset_folder, exist_ok=True)
 
-        # launch headless browser
-        driver = webdriver.Chrome()
-        driver.get(url)
-        html = driver.page_source
-        soup = BeautifulSoup(html, "html.parser") # make it a searchable object
-        driver.quit()
-
-        # get all tif links without any duplicate urls or empty spaces
-        tif_links_all = []
-        
-        for link in soup.find_all("a"):
-                href = link.get("href")
-                if href and href.lower().endswith(".tif"):
-                    tif_links_all.append(href)
-
-        # cleaning up the links list (getting rid of duplicates and empty spaces)
-        tif_links_final = list(set(link.strip().replace(' ', '%20') for link in tif_links_all))
+        # get all tif links without any duplicate urls or empty spaces, browser only if needed
+        tif_links_final = discover_links(url, (".tif",),
+                                         cache_path=os.path.join(save_directory, LINK_CACHE_NAME),
+                                         ttl=link_cache_ttl, use_browser=use_browser)
 
         # create task list for multithreading
         tasks = [(link, os.path.join(dataset_folder, os.path.basename(link))) for link in tif_links_final]
 
-        
-        def tif_downloader(link_and_path):
-            link, filepath = link_and_path
-            try:
-                with requests.get(link, stream=True) as r:
-                    with open(filepath, 'wb') as f:
-                        shutil.copyfileobj(r.raw, f)
-                return f"{os.path.basename(filepath)}"
-            except Exception as e:
-                return f"{os.path.basename(filepath)}: {e}"
-
-        # save to local directory using multithreading
-        with ThreadPoolExecutor(max_workers=processes) as executor:
-            results = list(tqdm(
-                executor.map(tif_downloader, tasks),
-                total= len(tasks),
-                desc= f"Downloading {dataset_id}"
-            ))
+        # save to local directory using the pooled download engine
+        manifest = DownloadManifest(dataset_folder)
+        with DownloadEngine(max_workers=num_workers) as engine:
+            download = partial(download_transcoded, engine, keep_original=keep_original) if transcode else None
+            results = engine.download_many(tasks, desc=f"Downloading {dataset_id}", manifest=manifest,
+                                           download=download)
 
         for result in results:
-            logger.info(result)
+            logger.info(format_result(result))
     
         end_time = time.time()
         elapsed_time = (end_time - start_time)/60 
         logger.info(f"Download of dataset {dataset_id} complete and saved to {dataset_folder} in {elapsed_time:.2f} min")
+        logger.info(f"Transfer budget: {default_budget().stats()}")
     
     except Exception as e:
         logger.error(f"Failed selenium scrape from {url}: {e}", exc_info=True)
@@ -199,11 +232,17 @@ def url_image_scrape_selenium(url, save_directory, num_workers=4):
    
 # FUNCTION 4: FOR ZARR FILES
 
-def url_image_scrape_zarr(url, save_directory):
+def url_image_scrape_zarr(url, save_directory, chunk_cache=None):
 
     """
     This function downloads an image dataset from Janelia in zarr format saved in an s3 bucket
     using fsspec and zarr.
+
+    With chunk_cache (a directory or ChunkCache) stored chunks are read through the shared
+    on-disk chunk cache, so copying the same arrays again is served locally. It is off by
+    default: the whole store is copied, so the cache would hold a second copy of it on disk
+    and evict the chunks of other datasets to make room. Chunks that go to S3 take their
+    connections from the process-wide transfer budget.
     """
 
     start_time = time.time()
@@ -213,6 +252,7 @@ def url_image_scrape_zarr(url, save_directory):
         dataset_folder = os.path.join(save_directory, dataset_id)
         os.makedirs(dataset_folder, exist_ok=True)
         
+        cache = open_chunk_cache(chunk_cache)
         fs = fsspec.filesystem("s3", anon=True)
         base = url.replace("s3://", "").rstrip("/")
         all_files = fs.find(url)
@@ -240,7 +280,9 @@ def url_image_scrape_zarr(url, save_directory):
                 if os.path.exists(local_path):
                     shutil.rmtree(local_path)
 
-                online_mapper = fsspec.get_mapper(online_path, anon=True)
+                online_mapper = BudgetedMapping(fsspec.get_mapper(online_path, anon=True), online_path)
+                if cache is not None:
+                    online_mapper = CachedMapping(online_mapper, cache, online_path)
                 local_mapper = zarr.DirectoryStore(local_path)
 
                 logger.info(f"Copying: {key}")
@@ -251,6 +293,9 @@ def url_image_scrape_zarr(url, save_directory):
         end_time = time.time()
         elapsed = (end_time - start_time) / 60
         logger.info(f"Downloaded all arrays from {dataset_id} in {elapsed:.2f} minutes")
+        logger.info(f"Transfer budget: {default_budget().stats()}")
+        if cache is not None:
+            logger.info(f"Chunk cache: {cache.stats()}")
     
     except Exception as e:
         logger.error(f"Failed Zarr scrape from {url}: {e}", exc_info=True)
@@ -259,10 +304,29 @@ def url_image_scrape_zarr(url, save_directory):
 
 # FUNCTION 5: FOR PIXEL CROP REGION OF NEUROGLANCER DATASET
 
-def url_image_scrape_neuroglancer(url, save_directory, crop_region=(1000,1000,1000)):
+def url_image_scrape_neuroglancer(url, save_directory, crop_region=(1000,1000,1000), output="tiff",
+                                  memory_budget=DEFAULT_MEMORY_BUDGET, snap_to_chunks=False, seed=None,
+                                  content_aware=True, chunk_cache=DEFAULT_CHUNK_CACHE_DIR,
+                                  compression=DEFAULT_TIFF_COMPRESSION):
     """
     This function downloads a random crop region of size 1000x1000x1000 from a 
     Neuroglancer dataset with the CloudVolume package. 
+
+    output="tiff" loads the crop in one slice and saves it as a single (z, y, x) TIFF, tiled and
+    compressed with compression ("zstd", "deflate", "lzw" or None). output="zarr" or
+    "bigtiff" streams it in chunk-aligned blocks kept under memory_budget bytes into a chunked
+    Zarr array or tiled BigTIFF. snap_to_chunks puts the crop origin on the volume's chunk grid
+    so no partly used chunks are downloaded; seed makes the crop position reproducible.
+    Without a seed, an unfinished streamed Zarr crop of the same size is resumed at its
+    origin; a finished one is replaced by a new random crop.
+
+    With content_aware the crop is placed inside tissue: an occupancy index built from a
+    coarse mip (cached in the dataset folder) limits the draw to regions with data and
+    intensity variance, instead of anywhere in the bounding box.
+
+    Chunks are read through the shared on-disk chunk cache at chunk_cache (a directory or
+    ChunkCache; None turns it off), so a repeat crop of the same region is served locally.
+    Reads that miss it reserve connections from the process-wide transfer budget.
     """
     start_time = time.time()
 
@@ -276,31 +340,56 @@ def url_image_scrape_neuroglancer(url, save_directory, crop_region=(1000,1000,10
         os.makedirs(dataset_folder, exist_ok=True)
 
         # get the highest resolution of the image
-        volume = CloudVolume(url, mip=0, use_https=True, fill_missing=True)
-        volume_shape = volume.shape[:3]
-
-        # image and crop region dimensions
-        z_dim, y_dim, x_dim = volume_shape
-        z_crop, y_crop, x_crop = crop_region
-
-        if z_dim >= z_crop and y_dim >= y_crop and x_dim >= x_crop:
-                random_z = np.random.randint(0, z_dim - z_crop + 1)
-                random_y = np.random.randint(0, y_dim - y_crop + 1)
-                random_x = np.random.randint(0, x_dim - x_crop + 1)
-        
-        # random pixel crop regin
-        chunk = volume[random_z:random_z + z_crop, random_y:random_y + y_crop, 
-                    random_x:random_x + x_crop]
-        
-        # save to local directory
-        filename = f"{dataset_id}_crop.tif"
-        output_path = os.path.join(dataset_folder, filename)
-        imwrite(output_path, chunk)
+        # streamed crops fetch DEFAULT_FETCH_WORKERS blocks at once, each with its share of the host's slots
+        volume = BudgetedVolume(CloudVolume(url, mip=0, use_https=True, fill_missing=True),
+                                workers=1 if output == "tiff" else DEFAULT_FETCH_WORKERS)
+        cache = open_chunk_cache(chunk_cache)
+        if cache is not None:
+            volume = CachedVolume(volume, cache)
+
+        # random pixel crop region (CloudVolume indexes x, y, z); without a seed an interrupted
+        # streamed Zarr crop is resumed where it was drawn instead
+        rng = np.random.default_rng(seed)
+        origin = None
+        if seed is None and output == "zarr":
+            origin = unfinished_crop_origin(os.path.join(dataset_folder, f"{dataset_id}_crop.zarr"), crop_region)
+            if origin is not None:
+                logger.info(f"Resuming the unfinished crop at {tuple(map(int, origin))}")
+        occupancy = None
+        if origin is None and content_aware:
+            try:
+                occupancy = load_or_build_occupancy(volume, os.path.join(dataset_folder, OCCUPANCY_CACHE_NAME))
+            except Exception as e:
+                logger.warning(f"Could not build occupancy index for {url}, cropping uniformly: {e}")
+        if origin is None and occupancy is not None:
+            origin = occupancy.sample_origin(volume, crop_region, rng, snap=snap_to_chunks)
+        elif origin is None:
+            origin = random_crop_origin(volume, crop_region, rng, snap=snap_to_chunks)
+        x0, y0, z0 = origin
+        x_crop, y_crop, z_crop = crop_region
+
+        if output == "tiff":
+            chunk = volume[x0:x0 + x_crop, y0:y0 + y_crop, z0:z0 + z_crop]
+
+            # save to local directory
+            filename = f"{dataset_id}_crop.tif"
+            output_path = os.path.join(dataset_folder, filename)
+            write_tiff(output_path, cutout_to_zyx(chunk), compression)
+        else:
+            filename = f"{dataset_id}_crop" + (".zarr" if output == "zarr" else ".tif")
+            output_path = os.path.join(dataset_folder, filename)
+            stats = stream_crop(volume, origin, crop_region, output_path, output=output,
+                                memory_budget=memory_budget, compression=compression)
+            logger.info(f"Streamed crop at {tuple(map(int, origin))} in {stats['blocks']} blocks of "
+                        f"{stats['block_shape_xyz']} voxels")
 
         end_time = time.time()
         elapsed_time = (end_time - start_time)/60
 
         logger.info(f"Downloaded {filename} in {elapsed_time} minutes")
+        logger.info(f"Transfer budget: {default_budget().stats()}")
+        if cache is not None:
+            logger.info(f"Chunk cache: {cache.stats()}")
     except Exception as e:
         logger.error(f"Failed neuroglancer scrape from {url}: {e}", exc_info=True)
 
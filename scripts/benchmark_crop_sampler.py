@@ -0,0 +1,65 @@
+"""
+This script compares cutting many crops from a Neuroglancer precomputed volume with N independent
+CloudVolume slices against the shared-chunk batch sampler in neuroglancer_utils. It builds a
+synthetic precomputed volume on local disk, so no remote dataset is touched.
+
+Usage:
+    python scripts/benchmark_crop_sampler.py --crops 200 --seed 0
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from cloudvolume import CloudVolume
+from img_dataset_tools.neuroglancer_utils import (crop_chunks, random_crop_specs, sample_crops,
+                                                  volume_grid)
+
+
+def make_volume(path, shape, chunk_size):
+    info = CloudVolume.create_new_info(num_channels=1, layer_type="image", data_type="uint8",
+                                       encoding="raw", resolution=[8, 8, 8], voxel_offset=[0, 0, 0],
+                                       chunk_size=list(chunk_size), volume_size=list(shape))
+    volume = CloudVolume("file://" + path, info=info, progress=False)
+    volume.commit_info()
+    rng = np.random.default_rng(0)
+    volume[:, :, :] = rng.integers(0, 255, shape, dtype=np.uint8)
+    return CloudVolume("file://" + path, progress=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--crops", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shape", type=int, nargs=3, default=(512, 512, 256))
+    parser.add_argument("--chunk", type=int, nargs=3, default=(64, 64, 64))
+    args = parser.parse_args()
+
+    sizes = [(64, 64, 64), (128, 128, 64), (96, 96, 96), (200, 150, 100)]
+    with tempfile.TemporaryDirectory() as tmp:
+        url = "file://" + os.path.join(tmp, "volume")
+        volume = make_volume(os.path.join(tmp, "volume"), args.shape, args.chunk)
+        specs = random_crop_specs(volume, args.crops, sizes, seed=args.seed)
+        chunk_size, voxel_offset, _ = volume_grid(volume)
+        print(f"{args.crops} crops from a {tuple(args.shape)} uint8 volume, {tuple(args.chunk)} chunks")
+
+        # N independent calls, a new CloudVolume for each as url_image_scrape_neuroglancer does
+        start_time = time.time()
+        independent_bytes = 0
+        for origin, size in specs:
+            vol = CloudVolume(url, progress=False)
+            end = origin + size
+            vol[origin[0]:end[0], origin[1]:end[1], origin[2]:end[2]]
+            independent_bytes += len(crop_chunks(origin, size, chunk_size, voxel_offset)) * int(np.prod(chunk_size))
+        independent_seconds = time.time() - start_time
+
+        crops, stats = sample_crops(volume, specs, workers=8)
+        print(f"  independent: {independent_bytes / 1e6:.1f} MB of chunks fetched in {independent_seconds:.2f} s")
+        print(f"  batch:       {stats['bytes_fetched'] / 1e6:.1f} MB of chunks fetched in {stats['seconds']:.2f} s "
+              f"({stats['chunks_fetched']} unique chunks vs {stats['independent_chunks']})")
+        print(f"  -> {stats['independent_bytes'] / stats['bytes_fetched']:.1f}x fewer bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+This script measures download throughput of the shared download engine against the original
+one-file-at-a-time requests loop. It serves synthetic files from a local HTTP stand-in server
+that injects a fixed latency before every response, so no remote dataset is touched.
+
+Usage:
+    python scripts/benchmark_downloads.py --files 32 --size-mb 4 --latency-ms 100
+    python scripts/benchmark_downloads.py --mode segmented --size-mb 400 --rate-mb 20
+"""
+import argparse
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+
+import requests
+from img_dataset_tools.downloaders import DownloadEngine
+
+logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+class LatencyHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler that sleeps before answering, like a distant server. It honours
+    single Range requests and can cap the rate of each connection, which is what makes
+    one long transfer slow on a real wide-area link.
+    """
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    rate = None   # bytes/sec per connection, None for unlimited
+
+    def send_head(self):
+        time.sleep(self.latency)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match[1])
+            end = min(int(match[2]), size - 1) if match[2] else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        f = open(path, "rb")
+        f.seek(start)
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        step = 64 * 1024
+        while self._remaining > 0:
+            data = source.read(min(step, self._remaining))
+            if not data:
+                break
+            outputfile.write(data)
+            self._remaining -= len(data)
+            if self.rate:
+                time.sleep(len(data) / self.rate)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(directory, latency, rate=None):
+    handler = type("Handler", (LatencyHandler,), {"latency": latency, "rate": rate})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def naive_download(tasks):
+    # the loop url_image_scrape_static used before the engine: new connection, 8 KB chunks
+    for url, filepath in tasks:
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            with open(filepath, "wb") as f:
+                for chunk in r.iter_content(chunk_size=8192):
+                    f.write(chunk)
+
+
+def engine_download(tasks, workers, per_host, segments=1, segment_threshold=None):
+    with DownloadEngine(max_workers=workers, per_host=per_host, segments=segments,
+                        segment_threshold=segment_threshold) as engine:
+        results = engine.download_many(tasks, desc="engine")
+    failed = [r for r in results if r["error"] is not None]
+    if failed:
+        raise RuntimeError(f"{len(failed)} downloads failed")
+
+
+def benchmark_many_files(args):
+    with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+        size = int(args.size_mb * 1e6)
+        for i in range(args.files):
+            with open(os.path.join(src, f"file_{i:03}.dm3"), "wb") as f:
+                f.write(os.urandom(size))
+
+        server = start_server(src, args.latency_ms / 1000)
+        base = f"http://127.0.0.1:{server.server_address[1]}/"
+        total_mb = args.files * size / 1e6
+
+        runs = [("sequential requests.get", naive_download),
+                (f"DownloadEngine ({args.workers} workers, {args.per_host}/host)",
+                 partial(engine_download, workers=args.workers, per_host=args.per_host))]
+        for label, fn in runs:
+            tasks = [(base + f"file_{i:03}.dm3", os.path.join(dst, f"file_{i:03}.dm3"))
+                     for i in range(args.files)]
+            start_time = time.time()
+            fn(tasks)
+            elapsed = time.time() - start_time
+            print(f"{label}: {total_mb:.1f} MB in {elapsed:.2f} s -> {total_mb / elapsed:.1f} MB/s")
+
+        server.shutdown()
+
+
+def benchmark_one_large_file(args):
+    with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+        size = int(args.size_mb * 1e6)
+        with open(os.path.join(src, "volumedata.tif"), "wb") as f:
+            f.write(os.urandom(size))
+
+        server = start_server(src, args.latency_ms / 1000, rate=args.rate_mb * 1e6)
+        url = f"http://127.0.0.1:{server.server_address[1]}/volumedata.tif"
+        print(f"one {size / 1e6:.0f} MB file, {args.rate_mb:.0f} MB/s per connection")
+
+        for segments in (1, 2, 4, 8):
+            filepath = os.path.join(dst, "volumedata.tif")
+            start_time = time.time()
+            engine_download([(url, filepath)], workers=1, per_host=segments, segments=segments,
+                            segment_threshold=1 if segments > 1 else None)
+            elapsed = time.time() - start_time
+            os.remove(filepath)
+            print(f"  {segments} connection(s): {elapsed:.2f} s -> {size / 1e6 / elapsed:.1f} MB/s")
+
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("files", "segmented"), default="files",
+                        help="many small files, or one large file split over connections")
+    parser.add_argument("--files", type=int, default=32)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--rate-mb", type=float, default=20,
+                        help="per-connection bandwidth cap for --mode segmented")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--per-host", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.mode == "files":
+        benchmark_many_files(args)
+    else:
+        benchmark_one_large_file(args)
+
+
+if __name__ == "__main__":
+    main()
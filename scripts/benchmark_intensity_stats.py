@@ -0,0 +1,46 @@
+"""
+This script compares the sampled (approximate) intensity statistics of local volumes with the
+exact streaming pass: for every file it prints the time of both, and for the mean and each
+percentile the estimate, its confidence interval, the exact value and whether the interval
+holds it. Any volume open_volume reads can be given (volumedata.tif, a COSEM s0 array, ...).
+
+Usage:
+    python scripts/benchmark_intensity_stats.py saved_datasets/mitochondria-data-em/volumedata.tif --fraction 0.01
+"""
+import argparse
+import time
+
+from img_dataset_tools.intensity_stats import CATALOG_PERCENTILES, DEFAULT_SAMPLE_FRACTION, sampled_stats, \
+    volume_stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="TIFF / DM3 files or Zarr arrays")
+    parser.add_argument("--fraction", type=float, default=DEFAULT_SAMPLE_FRACTION)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    for path in args.paths:
+        sampled = sampled_stats(path, args.fraction, args.seed, workers=args.workers)
+        start_time = time.time()
+        exact = volume_stats(path, workers=args.workers)
+        exact_seconds = time.time() - start_time
+        print(f"{path}: {sampled.units_sampled}/{sampled.units_total} units sampled "
+              f"({100 * sampled.sampled_fraction:.2f} %) in {sampled.seconds:.2f} s, exact pass {exact_seconds:.2f} s "
+              f"({exact_seconds / max(sampled.seconds, 1e-9):.0f}x)")
+        rows = [("mean", sampled.mean, sampled.mean_bounds(), exact.mean)]
+        rows += [(f"p{q:g}", sampled.percentile(q), sampled.percentile_bounds(q), exact.percentile(q))
+                 for q in CATALOG_PERCENTILES]
+        span = (exact.max - exact.min) or 1
+        for name, estimate, (low, high), value in rows:
+            # a fully sampled volume has zero-width intervals, up to float rounding
+            tolerance = 1e-9 * max(1.0, abs(value))
+            print(f"  {name:>6}: {estimate:12.4f}  [{low:12.4f}, {high:12.4f}]  exact {value:12.4f}  "
+                  f"error {100 * abs(estimate - value) / span:6.3f} % of range  "
+                  f"{'inside' if low - tolerance <= value <= high + tolerance else 'OUTSIDE'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+This script adds coarse levels to chunked Zarr data saved by the other scripts: a local Zarr
+array (a COSEM array, a streamed Neuroglancer crop) gets a new multiscale group next to it,
+and an OME-Zarr group from convert_to_ome_zarr.py is extended in place. Levels that are
+already complete are kept, so an interrupted run can simply be started again.
+
+Usage:
+    python scripts/build_pyramid.py saved_datasets/neuroglancer-janelia-flyem-hemibrain/neuroglancer-janelia-flyem-hemibrain_crop.zarr
+        --method mean
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import argparse
+import logging
+
+from img_dataset_tools.pyramid import DEFAULT_BLOCK_BYTES, DOWNSAMPLERS, build_pyramid, format_pyramid_report
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="Zarr arrays or multiscale OME-Zarr groups")
+    parser.add_argument("--output", default=None,
+                        help="group to write the pyramid to (one path only; default: next to the array, "
+                             "or in place for a multiscale group)")
+    parser.add_argument("--method", choices=sorted(DOWNSAMPLERS), default=None,
+                        help="window reduction (default: mode for label volumes, mean otherwise)")
+    parser.add_argument("--levels", type=int, default=None, help="number of levels including s0 "
+                                                                 "(default: down to one chunk)")
+    parser.add_argument("--factors", type=int, nargs="+", default=None, help="downsampling per axis (default 2)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: every core)")
+    parser.add_argument("--block-mb", type=int, default=DEFAULT_BLOCK_BYTES // 1024 ** 2,
+                        help="largest block of source voxels a worker holds, in MiB")
+    parser.add_argument("--overwrite", action="store_true", help="rebuild levels that are already complete")
+    args = parser.parse_args()
+    if args.output and len(args.paths) > 1:
+        parser.error("--output takes a single path")
+
+    for path in args.paths:
+        try:
+            report = build_pyramid(path, args.output, method=args.method, levels=args.levels, factors=args.factors,
+                                   workers=args.workers, block_bytes=args.block_mb * 1024 ** 2,
+                                   overwrite=args.overwrite)
+        except Exception as e:
+            logging.error(f"Failed to build the pyramid of {path}: {e}", exc_info=True)
+            continue
+        logging.info(format_pyramid_report(report))
+
+
+if __name__ == "__main__":
+    main()
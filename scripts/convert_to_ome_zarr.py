@@ -0,0 +1,59 @@
+"""
+This script converts the downloaded TIFF volumes (cvlab mitochondria, the Neuroglancer crop, the
+OMERO stacks) into chunked, multiscale OME-Zarr groups, each written next to its TIFF. Label
+volumes such as testing_groundtruth.tif are downsampled with the most frequent value, images
+with the mean. Files that were already converted are skipped.
+
+Usage:
+    python scripts/convert_to_ome_zarr.py saved_datasets --chunks 64 256 256 --codec zstd
+
+The overall goal of this project is to download 3D microscopy image datasets from different
+sources accessible and create an entry table of the various image metadata.
+"""
+import argparse
+import logging
+import os
+
+from img_dataset_tools.ome_zarr import DEFAULT_CODEC, DEFAULT_OME_ZARR_CHUNKS, OME_ZARR_SUFFIX, convert_dataset, \
+    convert_tiff_to_ome_zarr
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default=os.path.join(os.getcwd(), "saved_datasets"),
+                        help="dataset directory (searched recursively) or a single TIFF file")
+    parser.add_argument("--output-directory", default=None,
+                        help="write the OME-Zarr groups here instead of next to each TIFF")
+    parser.add_argument("--chunks", type=int, nargs=3, default=DEFAULT_OME_ZARR_CHUNKS, help="z y x chunk shape")
+    parser.add_argument("--codec", default=DEFAULT_CODEC, help="zstd, lz4, lz4hc, zlib, blosclz, gzip or none")
+    parser.add_argument("--level", type=int, default=5, help="compression level")
+    parser.add_argument("--levels", type=int, default=None, help="number of pyramid levels (default: down to one chunk)")
+    parser.add_argument("--labels", choices=("auto", "yes", "no"), default="auto",
+                        help="downsample with the mode (yes) or the mean (no); auto guesses from the file name")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: every core)")
+    parser.add_argument("--overwrite", action="store_true", help="convert again even if up to date")
+    args = parser.parse_args()
+
+    kwargs = {"chunks": tuple(args.chunks), "codec": args.codec, "level": args.level, "levels": args.levels,
+              "labels": {"auto": None, "yes": True, "no": False}[args.labels], "workers": args.workers,
+              "overwrite": args.overwrite}
+    if os.path.isfile(args.path):
+        output_path = None
+        if args.output_directory:
+            os.makedirs(args.output_directory, exist_ok=True)
+            output_path = os.path.join(args.output_directory,
+                                       os.path.splitext(os.path.basename(args.path))[0] + OME_ZARR_SUFFIX)
+        reports = [convert_tiff_to_ome_zarr(args.path, output_path, **kwargs)]
+    else:
+        reports = convert_dataset(args.path, args.output_directory, **kwargs)
+
+    converted = [r for r in reports if not r["skipped"] and r["error"] is None]
+    failed = [r for r in reports if r["error"] is not None]
+    logging.info(f"{len(converted)} converted, {len(reports) - len(converted) - len(failed)} up to date, "
+                 f"{len(failed)} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,29 @@ The datasets are assumed to have been previously downloaded to a local directory
 the download_image_datasets.py script.
 
 The goal is to generate a unified metadata table containing image format, shape, resolution,
-data type, and other useful information for downstream AI/ML pipelines.
+data type, and other useful information for downstream AI/ML pipelines. With --stats every
+local volume also gets intensity statistics (min, max, mean, std, percentiles and display
+range), computed chunk by chunk over a process pool; --sample-fraction estimates them in
+seconds from a random, stratified sample of each volume instead.
 """
 
+import argparse
+import logging
 import os
-import tifffile
 import glob
-import pandas as pd
-from img_dataset_tools.metadata_utils import flatten_dm3_dict, extract_zarr_metadata
-from img_dataset_tools import dm3_lib as dm3
+from img_dataset_tools.metadata_utils import extract_tiff_metadata, extract_dm3_metadata, extract_zarr_metadata, \
+    extract_precomputed_metadata, metadata_table
+from img_dataset_tools.intensity_stats import add_intensity_stats
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--stats", action="store_true", help="add intensity statistics of every local volume")
+parser.add_argument("--workers", type=int, default=None, help="processes for --stats (default: every core)")
+parser.add_argument("--sample-fraction", type=float, default=None,
+                    help="with --stats, estimate from this fraction of every volume (e.g. 0.01) instead of reading it all")
+parser.add_argument("--seed", type=int, default=0, help="seed of the --sample-fraction sample")
+args = parser.parse_args()
 
 load_directory = os.path.join(os.getcwd(), "saved_datasets")
 
@@ -30,93 +44,29 @@ metadata_list = []
 for folder in dataset_folders:
     # extracting .tif/.tiff metadata
     for tif_file in glob.glob(f"{folder}/*.tif") + glob.glob(f"{folder}/*.tiff"):
-        with tifffile.TiffFile(tif_file) as tif:
-            page = tif.pages[0]  
-            series = tif.series[0]
-            tags = page.tags
-
-            # for resolution
-            x_tag = tags.get("XResolution")
-            y_tag = tags.get("YResolution")
-            unit_tag = tags.get("ResolutionUnit")
-
-            # Safe resolution extraction
-            x_res = (x_tag.value[0] / x_tag.value[1]) if x_tag and isinstance(x_tag.value, tuple) else (x_tag.value if x_tag else None)
-            y_res = (y_tag.value[0] / y_tag.value[1]) if y_tag and isinstance(y_tag.value, tuple) else (y_tag.value if y_tag else None)
-
-            if "neuroglancer-janelia-flyem-hemibrain/neuroglancer-janelia-flyem-hemibrain_crop.tif" in tif_file:
-                x_res = y_res = z_res = 8
-            
-            elif "omero_10740" in tif_file:
-                x_res = y_res = z_res = 20
-            
-            elif "mitochondria-data-em" in tif_file:
-                x_res = y_res = z_res = 5
-            else:
-                z_res = None
-
-
-            tif_rows_dict = {
-                "dataset_id": os.path.basename(os.path.dirname(tif_file)), 
-                "format": "TIFF",
-                "shape": series.shape,
-                "dtype": series.dtype,
-                "ndims": series.ndim,
-                "resolution_nm": (x_res, y_res, z_res),
-                "file_size_MB": f"{os.path.getsize(tif_file)/(1e6):.2f}",
-                "samples_per_pixel": page.samplesperpixel,
-                "file_path": tif_file
-            }
-
-            metadata_list.append(tif_rows_dict)
-
-    # extracting .dm3 metadata
-    for dm3_file in glob.glob(f"{folder}/*.dm3"):
-        dm3_data = dm3.DM3(dm3_file)
-        dm3_array = dm3_data.imagedata
-        dm3_flattened = flatten_dm3_dict(dm3_data.tags)
-
-        # resolution
-        pixel_size = dm3_flattened.get("Pixel size")
-        try:
-            resolution_nm = (int(float(pixel_size)), int(float(pixel_size)))
-        except (TypeError, ValueError):
-            resolution_nm = (None, None)
-
-        # manual override if we know from external source
-        if "empiar_11759" in dm3_file:
-            resolution_nm = (8, 8)
-           
-        dm3_rows_dict = {
-            "dataset_id": os.path.basename(os.path.dirname(tif_file)),
-            "format": "DM3",
-            "shape": dm3_data.imagedata.shape,
-            "dtype": str(dm3_array.dtype),
-            "resolution_nm": resolution_nm,
-            "file_size_MB": f"{os.path.getsize(dm3_file)/(1e6)}",
-            "size": dm3_flattened.get("Size"),
-            "channel": dm3_array.shape[-1] if dm3_array.ndim >= 3 else 1,
-            "zoom_ratio": dm3_flattened.get("Zoom ratio"),
-            "ndims": dm3_data.imagedata.ndim,
-            "chunks": dm3_flattened.get("chunking"),
-            "file_path": dm3_file
-        }  
-
-        metadata_list.append(dm3_rows_dict)
+        metadata_list.append(extract_tiff_metadata(tif_file))
+
+    # extracting .dm3 metadata (from the tags, without reading the image data)
+    for dm3_file in glob.glob(f"{folder}/**/*.dm3", recursive=True):
+        metadata_list.append(extract_dm3_metadata(dm3_file, dataset_id=os.path.basename(folder)))
 
 
 # extract zarr metadata
 zarr_path = os.path.join(os.getcwd(), "saved_datasets", "jrc_mus-nacc-2.zarr")
 metadata_list.extend(extract_zarr_metadata(zarr_path))
 
-# convert to dataframe
-metadata_table = pd.DataFrame(metadata_list)
-print(metadata_table)
+# extract precomputed (neuroglancer) metadata from the remote info files, one row per scale
+precomputed_urls = ["gs://neuroglancer-janelia-flyem-hemibrain/emdata/raw/jpeg"]
+for url in precomputed_urls:
+    metadata_list.extend(extract_precomputed_metadata(url))
+
+# intensity statistics of the local volumes, read chunk by chunk
+if args.stats:
+    add_intensity_stats(metadata_list, workers=args.workers, sample_fraction=args.sample_fraction, seed=args.seed)
 
-# move 'file_path' to the last column 
-if "file_path" in metadata_table.columns:
-    cols = [col for col in metadata_table.columns if col != "file_path"] + ["file_path"]
-    metadata_table = metadata_table[cols] 
+# convert to dataframe, with 'file_path' as the last column
+table = metadata_table(metadata_list)
+print(table)
 
 # save as csv
-metadata_table.to_csv("metadata_table.csv", index=False)
+table.to_csv("metadata_table.csv", index=False)
@@ -1,58 +1,50 @@
 
 """
 This script downloads image datasets stored in different formats in a parallelized, multi-threaded
-manner.
+manner. Every dataset is planned first (files, sizes, free disk space); --dry-run stops after
+printing the plan. With --pipeline every file is verified and cataloged as soon as it has
+downloaded, and the metadata table is written when the last download is done; --stats adds
+the intensity statistics of every file to it.
 
 The overall goal of this project is to download 3D microscopy image datasets from different
 sources accessible and create an entry table of the various image metadata. 
 """
+import argparse
 import os
+import sys
 import time
 import logging
-from tqdm.contrib.concurrent import process_map
-from functools import partial
-from img_dataset_tools.webscrapers import (url_image_scrape_dynamic, url_image_scrape_static,
-                                  url_image_scrape_selenium, url_image_scrape_zarr, 
-                                  url_image_scrape_neuroglancer)
+from img_dataset_tools.downloaders import DownloadEngine
+from img_dataset_tools.dataset_tasks import dataset_source
+from img_dataset_tools.metadata_pipeline import MetadataPipeline, format_pipeline_report
+from img_dataset_tools.metadata_utils import extract_precomputed_metadata, metadata_table
+from img_dataset_tools.planner import plan_sources
+from img_dataset_tools.scheduler import DEFAULT_SCHEDULER_WORKERS, WorkScheduler, format_report
+from img_dataset_tools.transfer_budget import configure_budget
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 
-# create wrapper function for the functions that download the different datasets
-def download_dataset_wrapper(url, save_directory):
-    try:
-        start_time = time.time()
-        logging.info(f"Starting download for: {url}")
-
-        if "idr.openmicroscopy.org" in url:
-            url_image_scrape_dynamic(url, save_directory)
-        elif "ftp.ebi.ac.uk" in url:
-            url_image_scrape_static(url, save_directory)
-        elif "cvlab.epfl.ch" in url:
-            url_image_scrape_selenium(url, save_directory)
-        elif "neuroglancer" in url:
-            url_image_scrape_neuroglancer(url, save_directory)
-        elif "janelia-cosem-datasets" in url:
-            url_image_scrape_zarr(url, save_directory)
-        else:
-            raise ValueError(f"This function does not support this url: {url}")
-        
-        end_time = time.time()
-        elapsed_time = (end_time - start_time)/60
-        logging.info(f"Finished {url} in {elapsed_time:.2f} minutes.")
-
-    except Exception as e:
-        logging.error(f"Failed {url}: {e}", exc_info=True)
-        return f"Failed {url}: {e}"
-        
-
 if __name__ == "__main__":
-    start_time = time.time()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="plan the downloads (files, sizes, disk space) and exit without downloading")
+    parser.add_argument("--save-directory", default=os.path.join(os.getcwd(), "saved_datasets"),
+                        help="folder the datasets are saved in (default: ./saved_datasets)")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="expected download bandwidth in MB/s, for the duration estimate")
+    parser.add_argument("--plan-json", default=None, help="also write the plan to this JSON file")
+    parser.add_argument("--force", action="store_true", help="download even if the plan doesn't fit on disk")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="verify and catalog each file as it lands and write the metadata table")
+    parser.add_argument("--catalog", default="metadata_table.csv",
+                        help="metadata table written in --pipeline mode (default: metadata_table.csv)")
+    parser.add_argument("--stats", action="store_true",
+                        help="in --pipeline mode, also add the intensity statistics of every file to the table")
+    args = parser.parse_args()
+    bandwidth = args.bandwidth * 1e6 if args.bandwidth else None
 
-    # count number of cpus
-    cpu_count = os.cpu_count()
-    logging.info(f"Number of logical CPUs: {cpu_count}")
-    processes = cpu_count - 1
+    start_time = time.time()
 
     # list of urls containing the five different datasets
     list_of_urls = ["https://idr.openmicroscopy.org/webclient/img_detail/9846137/?dataset=10740",
@@ -62,12 +54,55 @@ if __name__ == "__main__":
                 "gs://neuroglancer-janelia-flyem-hemibrain/emdata/raw/jpeg"
                 ]
     
-    # create a "saved_datasets" folder in user's current working directory
-    save_directory = os.path.join(os.getcwd(), "saved_datasets")
+    save_directory = args.save_directory
     os.makedirs(save_directory, exist_ok=True)
 
-    process_map(partial(download_dataset_wrapper, save_directory=save_directory), 
-                           list_of_urls, max_workers=processes)
+    # one connection budget for every scraper (and any other downloader process on this node);
+    # set bytes_per_second to cap the bandwidth as well
+    budget = configure_budget(max_connections=32, per_host=8, bytes_per_second=None)
+
+    # every dataset is split into file- or chunk-level tasks, sized up front by the planner,
+    # that share one worker pool largest first, so no worker idles while another dataset
+    # still has work left
+    with DownloadEngine(max_workers=DEFAULT_SCHEDULER_WORKERS) as engine:
+        sources = []
+        for url in list_of_urls:
+            try:
+                sources.append(dataset_source(url, save_directory, engine))
+            except Exception as e:
+                logging.error(f"Failed {url}: {e}", exc_info=True)
+
+        plan = plan_sources(sources, save_directory)
+        logging.info("Download plan:\n" + plan.summary(bandwidth))
+        if args.plan_json:
+            plan.save(args.plan_json, bandwidth)
+        if args.dry_run:
+            plan.close()
+            sys.exit(0)
+        if not plan.fits_on_disk and not args.force:
+            plan.close()
+            logging.error("Not enough free disk space for the plan, rerun with --force to download anyway")
+            sys.exit(1)
+
+        # in pipeline mode each finished file goes through verification and metadata
+        # extraction on the pipeline's own threads while the other downloads continue
+        pipeline = MetadataPipeline(intensity_stats=args.stats) if args.pipeline else None
+        sources = plan.sources() if pipeline is None else pipeline.attach(plan.sources())
+        report = WorkScheduler(workers=DEFAULT_SCHEDULER_WORKERS).run(sources, desc="Downloading datasets")
+    logging.info(format_report(report))
+    if pipeline is not None:
+        logging.info(format_pipeline_report(pipeline.close()))
+        # precomputed volumes are also cataloged from their remote info file, as in extract_metadata.py
+        rows = list(pipeline.rows)
+        for url in list_of_urls:
+            if "neuroglancer" in url:
+                rows.extend(extract_precomputed_metadata(url))
+        metadata_table(rows).to_csv(args.catalog, index=False)
+        logging.info(f"Metadata table written to {args.catalog}")
+    stats = budget.stats()
+    logging.info(f"Transfer budget: {stats['connections']} connections, waited {stats['wait_seconds']:.1f} s "
+                 f"in total (mean {stats['mean_wait']:.3f} s, max {stats['max_wait']:.1f} s), "
+                 f"throttled {stats['throttle_seconds']:.1f} s")
             
     end_time = time.time()
     elapsed_time = (end_time - start_time)/3600